@@ -1,3 +1,57 @@
+"""
+AGI protocol implementation.
 
-from .asyncagi import *
-from .protocol import *
+Public names are imported lazily from their submodules, on first access
+(see PEP 562), to keep the import cost of the package low.
+"""
+
+import sys
+
+
+# Public name => submodule defining it
+_lazy_names = {
+    'AsyncAGIExecutor': 'asyncagi',
+    'ShardedAsyncAGIExecutor': 'asyncagi',
+    'PlaybackResult': 'commands',
+    'DataResult': 'commands',
+    'AGIChannel': 'protocol',
+    'AGIChannelGone': 'protocol',
+    'AGICommandFailure': 'protocol',
+    'AGIError': 'protocol',
+    'AGIForbiddenCommand': 'protocol',
+    'AGIProtocol': 'protocol',
+    'AGISyntaxError': 'protocol',
+    'AGITimeoutError': 'protocol',
+    'AGIUnknownCommand': 'protocol',
+    'Handler': 'protocol',
+    'LineReceiver': 'protocol',
+    'ProtocolAGIChannel': 'protocol',
+    'Response': 'protocol',
+    'Router': 'routing',
+    'RouteMatch': 'routing',
+    'AGISession': 'session',
+    }
+
+__all__ = sorted(_lazy_names)
+
+
+def __getattr__(name):
+    try:
+        module_name = _lazy_names[name]
+    except KeyError:
+        raise AttributeError("module %r has no attribute %r"
+                             % (__name__, name))
+    module = __import__(__name__ + '.' + module_name, fromlist=[name])
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_names))
+
+
+if sys.version_info < (3, 7):
+    # No module __getattr__ support: import everything eagerly
+    for _name in __all__:
+        __getattr__(_name)
@@ -1,16 +1,22 @@
 
+import collections
 import hashlib
 import logging
 import os
+import zlib
 try:
     # Python 3
-    from urllib.parse import unquote_to_bytes
+    from urllib.parse import unquote, unquote_to_bytes
+    def _unquote_text(value, encoding):
+        return unquote(value, encoding)
 except ImportError:
     # Python 2
     from urllib import unquote as unquote_to_bytes
+    def _unquote_text(value, encoding):
+        return unquote_to_bytes(value)
 
 from ..common import Handler
-from .protocol import AGIChannel
+from .protocol import AGIChannel, AGIChannelGone
 
 
 class _AsyncAGIChannel(AGIChannel):
@@ -19,11 +25,33 @@ class _AsyncAGIChannel(AGIChannel):
 
     def __init__(self, executor):
         self.executor = executor
-        # Command ID => Handler
+        # Command ID => Handler, for commands acknowledged by Asterisk
         self._commands = {}
+        # Command ID => Handler, for commands whose 'AGI' action wasn't
+        # answered yet
+        self._unacked = {}
+        # Whether Asterisk ended the Async AGI session
+        self._ended = False
 
     def send_command_line(self, line):
-        return self.executor._send_command_line(self.proto, line)
+        return self.executor._send_command_lines(self.proto, [line])[0]
+
+    def send_command_lines(self, lines):
+        return self.executor._send_command_lines(self.proto, lines)
+
+    def has_outstanding_commands(self):
+        return bool(self._commands or self._unacked)
+
+    def close(self):
+        if not self._ended:
+            self.executor._break_channel(self.proto)
+
+    def pop_pending_commands(self):
+        handlers = list(self._unacked.values())
+        handlers.extend(self._commands.values())
+        self._unacked.clear()
+        self._commands.clear()
+        return handlers
 
 
 class AsyncAGIExecutor(object):
@@ -34,13 +62,24 @@ class AsyncAGIExecutor(object):
     *protocol_factory* should be a callable returning a AGIProtocol
     instance.  It will be called each time a new Async AGI channel is
     started by Asterisk through the AMI.
+
+    If given, *call_later* is passed to the protocols for them to
+    implement their timeouts.  The :attr:`stats` Counter is shared
+    with the protocols.
+
+    If *pipelined* is true, sessions can send commands without waiting
+    for the results of the previous ones: Asterisk queues them on the
+    channel, and results are matched using command ids.
     """
 
     logger = logging.getLogger(__name__)
     ami = None
 
-    def __init__(self, protocol_factory):
+    def __init__(self, protocol_factory, call_later=None, pipelined=False):
         self.protocol_factory = protocol_factory
+        self.call_later = call_later
+        self.pipelined = pipelined
+        self.stats = collections.Counter()
         # Channel ID => _AsyncAGIChannel
         self._channels = {}
         # Compute a reasonably random stem for command ids
@@ -98,27 +137,91 @@ class AsyncAGIExecutor(object):
         else:
             return data
 
-    def _send_command_line(self, proto, line):
+    def _ami_for(self, channel):
+        """
+        Return the AMI protocol instance to send *channel*'s actions on.
+        """
+        return self.ami
+
+    def _send_command_lines(self, proto, lines):
         self._check_bound()
         channel = proto.channel
-        handler = Handler()
-        command_id = self._new_command_id()
-        headers = {
-            'Command': self._encode_agi_data(proto, line.rstrip()),
-            'CommandID': command_id,
-            'Channel': proto._channel_id,
-            }
+        ami = self._ami_for(channel)
+        command_ids = []
+        actions = []
+        for line in lines:
+            command_id = self._new_command_id()
+            command_ids.append(command_id)
+            actions.append(('AGI', {
+                'Command': self._encode_agi_data(proto, line.rstrip()),
+                'CommandID': command_id,
+                'Channel': proto._channel_id,
+                }))
         # The 'AGI' action has a synchronous response, and then the actual
         # result of the AGI command comes as an AsyncAGI event (subevent
         # 'Exec').
-        action_handler = self.ami.send_action('AGI', headers)
+        if len(actions) == 1:
+            action_handlers = [ami.send_action(*actions[0])]
+        else:
+            action_handlers = ami.send_actions(actions)
+        handlers = []
+        for command_id, action_handler in zip(command_ids, action_handlers):
+            handler = Handler()
+            channel._unacked[command_id] = handler
+            self._watch_action(channel, command_id, handler, action_handler)
+            handlers.append(handler)
+        return handlers
+
+    def _watch_action(self, channel, command_id, handler, action_handler):
         def _on_action_success(resp):
-            channel._commands[command_id] = handler
+            if channel._unacked.pop(command_id, None) is not None:
+                # (not aborted in the meantime)
+                channel._commands[command_id] = handler
         def _on_action_failure(exc):
-            handler.on_exception(exc)
+            if channel._unacked.pop(command_id, None) is not None:
+                self._update_state(channel)
+                handler.set_exception(exc)
         action_handler.on_result = _on_action_success
         action_handler.on_exception = _on_action_failure
-        return handler
+
+    def _update_state(self, channel):
+        """
+        Make the protocol's state reflect whether commands are still
+        awaiting their results.
+        """
+        proto = channel.proto
+        if proto._state in ('idle', 'awaiting-response') and not proto._commands:
+            if channel.has_outstanding_commands():
+                proto._state = 'awaiting-response'
+            else:
+                proto._state = 'idle'
+
+    def gauges(self):
+        """
+        Return a dict of the current numbers of Async AGI channels and
+        of commands awaiting their results.
+        """
+        return {
+            'active_channels': len(self._channels),
+            'pending_commands': sum(len(c._commands) + len(c._unacked)
+                                    for c in self._channels.values()),
+            }
+
+    def _break_channel(self, proto):
+        """
+        Ask Asterisk to end the Async AGI session on *proto*'s channel.
+        """
+        if not self.is_bound():
+            return
+        action_handler = self._ami_for(proto.channel).send_action('AGI', {
+            'Command': 'ASYNCAGI BREAK',
+            'Channel': proto._channel_id,
+            })
+        def _on_action_failure(exc):
+            self.logger.warning("Failed breaking Async AGI on channel %r: %s",
+                                proto._channel_id, exc)
+        action_handler.on_result = lambda resp: None
+        action_handler.on_exception = _on_action_failure
 
     def _asyncagi_event_received(self, event):
         subevent = event.headers['SubEvent']
@@ -149,18 +252,33 @@ class AsyncAGIExecutor(object):
                 "Received 'AsyncAGI exec' event for unknown command %r "
                 "in channel %r", command_id, channel_id)
             return
-        # Ensure the AGI protocol is expecting a response for this command.
         proto = channel.proto
+        result = event.headers['Result']
+        if (result.startswith('200%20') and not proto._commands and
+            result.find('%0A') == len(result) - 3):
+            # Fast path for the common single-line successful response:
+            # check the status and line end on the %-encoded value, unquote
+            # and decode its body in one call, and deliver it directly
+            # instead of going through line_received().
+            body = _unquote_text(result[6:-3], proto.encoding).rstrip()
+            if proto.command_timeout is not None:
+                proto._cancel_command_timer(handler)
+            self._update_state(channel)
+            proto._deliver_success(handler, body)
+            return
+        result_block = self._decode_agi_data(proto, result)
+        # Ensure the AGI protocol is expecting a response for this command.
         proto._push_command(handler)
-        result_block = self._decode_agi_data(proto, event.headers['Result'])
         result_lines = result_block.splitlines(True)
         for line in result_lines:
             proto.line_received(line)
-        if proto._state != 'idle':
+        if proto._commands or proto._state == 'in-response':
             self.logger.error(
                 "Invalid AGI protocol state after AsyncAGI Exec "
-                "(bad 'Env' line?): %r" % (proto._state,))
+                "(bad 'Result' header?): %r" % (proto._state,))
             return
+        # Other commands may still be awaiting their results
+        self._update_state(channel)
 
     def _asyncagi_start(self, event):
         channel_id = event.headers['Channel']
@@ -169,9 +287,14 @@ class AsyncAGIExecutor(object):
                 "Received new 'AsyncAGI start' event for bound channel %r",
                 channel_id)
             return
-        channel = _AsyncAGIChannel(self)
+        channel = self._new_channel(channel_id)
         proto = self.protocol_factory(channel)
         proto._channel_id = channel_id
+        if self.call_later is not None:
+            proto.call_later = self.call_later
+        if self.pipelined:
+            proto.pipelined = True
+        proto.stats = self.stats
         proto.bind_session()
         # The 'Env' header contains a %-encoded sequence of lines
         # containing the AGI environment, feed it to the protocol.
@@ -186,8 +309,10 @@ class AsyncAGIExecutor(object):
             return
         self._channels[channel_id] = channel
 
+    def _new_channel(self, channel_id):
+        return _AsyncAGIChannel(self)
+
     def _asyncagi_end(self, event):
-        # TODO error out all the pending commands
         channel_id = event.headers['Channel']
         try:
             channel = self._channels.pop(channel_id)
@@ -197,5 +322,306 @@ class AsyncAGIExecutor(object):
                 "Received 'AsyncAGI end' event for unknown channel %r",
                 channel_id)
             return
-        channel.proto.unbind_session()
+        self.stats['ended_channels'] += 1
+        proto = channel.proto
+        pending = len(channel._commands) + len(channel._unacked)
+        if pending:
+            self.logger.warning(
+                "Async AGI channel %r ended with %d pending commands",
+                channel_id, pending)
+            self.stats['orphaned_commands'] += pending
+        # Fail the pending commands, without trying to break the channel
+        channel._ended = True
+        proto._abort(AGIChannelGone("channel %r ended" % (channel_id,)), ())
+        proto.unbind_session()
         del channel.proto
+
+
+class ShardedAsyncAGIExecutor(AsyncAGIExecutor):
+    """
+    An AsyncAGIExecutor which can be bound to up to *shards* AMI protocol
+    instances (typically, one per manager connection to the same
+    Asterisk server), so as to spread the Async AGI traffic over them.
+
+    Each bound AMI protocol instance takes one of the *shards* slots, and
+    each channel belongs to one slot, chosen by hashing its channel id
+    modulo *shards* (or to the next bound slot, if that one is free).
+    The channel's commands are sent on the connection of its slot, and
+    its AsyncAGI events are only handled when received on that
+    connection.  Asterisk sends AsyncAGI events to all manager sessions:
+    the other connections skip them right after their Channel header,
+    without parsing them further (see
+    :meth:`~obelus.ami.protocol.BaseAMIProtocol.set_event_filter`).
+
+    Each connection receives its copy of an event at its own pace, so
+    binding or unbinding a connection can't change the slot assignment
+    on all connections at once.  Instead, the executor sends a UserEvent
+    action, and each connection switches to the new assignment when it
+    receives the resulting event: every AsyncAGI event is then handled
+    exactly once, and in order for any given channel.  The AMI users
+    must be allowed to send and receive user events.  Until then, a
+    newly bound connection handles no events, and a connection being
+    unbound keeps handling the events of its former slot.
+    """
+
+    # Name of the user event synchronizing slot assignment changes
+    sync_event_name = 'ObelusShardSync'
+
+    def __init__(self, protocol_factory, shards, call_later=None,
+                 pipelined=False):
+        super(ShardedAsyncAGIExecutor, self).__init__(
+            protocol_factory, call_later=call_later, pipelined=pipelined)
+        if shards < 1:
+            raise ValueError("Need at least one shard, got %r" % (shards,))
+        # Bound AMI protocol instances, in binding order
+        self.amis = []
+        # Slot index => bound AMI protocol instance, or None
+        self._slots = [None] * shards
+        # Assignment epoch => slots tuple, for the epochs still in use
+        self._epoch = 0
+        self._assignments = {0: tuple(self._slots)}
+        # AMI protocol instance => assignment epoch it has reached, for
+        # bound instances and instances being unbound
+        self._ami_epochs = {}
+        # AMI protocol instance being unbound => epoch it must reach
+        self._unbinding = {}
+        # AMI protocol instance => the UserEvent handler it had before
+        self._user_event_handlers = {}
+        # (epoch, channel id, event) tuples held until the connections
+        # previously handling the channel have caught up
+        self._held = []
+
+    def _check_bound(self):
+        if not self.amis:
+            raise ValueError("Operation on non-bound executor")
+
+    def is_bound(self):
+        """
+        Whether this executor is bound to at least one AMI protocol
+        instance.
+        """
+        return bool(self.amis)
+
+    def bind(self, ami):
+        """
+        Bind this executor to an AMI protocol instance, in the first free
+        slot.  Existing channels keep sending their commands on their
+        AMI protocol instance.
+        """
+        if ami in self.amis:
+            raise ValueError("Executor already bound to this AMI protocol")
+        try:
+            slot = self._slots.index(None)
+        except ValueError:
+            raise ValueError("All %d shards are already bound"
+                             % len(self._slots))
+        if ami in self._unbinding:
+            self._release(ami)
+        others = bool(self._ami_epochs)
+        self._hook(ami)
+        self._slots[slot] = ami
+        self.amis.append(ami)
+        self._ami_epochs[ami] = self._epoch
+        self._new_epoch()
+        if others:
+            self._send_sync_event(ami)
+        else:
+            # No other connection handles events: switch right away
+            self._ami_epochs[ami] = self._epoch
+
+    def unbind(self, ami=None, lost=False):
+        """
+        Unbind this executor from the *ami* protocol instance, or from
+        all of them if None.  The channels pinned to an unbound instance
+        are moved to the remaining ones.
+
+        Pass *lost* if the connection was lost: its slot is then taken
+        over right away, rather than once the remaining connections
+        receive the synchronization event.
+        """
+        self._check_bound()
+        if ami is None:
+            amis = list(self.amis)
+        elif ami in self.amis:
+            amis = [ami]
+        else:
+            raise ValueError("Executor not bound to this AMI protocol")
+        for ami in amis:
+            self.amis.remove(ami)
+            self._slots[self._slots.index(ami)] = None
+        if lost or not self.amis:
+            # No other connection would take over (or this one won't
+            # receive anything anymore): forget it in all assignments
+            for ami in amis:
+                self._forget(ami)
+        else:
+            self._new_epoch()
+            for ami in amis:
+                self._unbinding[ami] = self._epoch
+            self._send_sync_event(self.amis[0])
+        if self.amis:
+            for channel_id, channel in self._channels.items():
+                if channel._ami in amis:
+                    channel._ami = self._shard_for(channel_id)
+
+    def _hook(self, ami):
+        previous = ami._event_handlers.get('UserEvent')
+        if previous is not None:
+            ami.unregister_event_handler('UserEvent')
+        self._user_event_handlers[ami] = previous
+        ami.register_event_handler(
+            'AsyncAGI', lambda event: self._shard_event_received(ami, event))
+        ami.register_event_handler(
+            'UserEvent', lambda event: self._user_event_received(ami, event))
+        ami.set_event_filter(
+            'AsyncAGI', 'Channel',
+            lambda channel_id: self._owns(ami, self._hash(channel_id)))
+
+    def _release(self, ami):
+        ami.unregister_event_handler('AsyncAGI')
+        ami.unregister_event_handler('UserEvent')
+        previous = self._user_event_handlers.pop(ami)
+        if previous is not None:
+            ami.register_event_handler('UserEvent', previous)
+        ami.set_event_filter('AsyncAGI', 'Channel', None)
+        del self._ami_epochs[ami]
+        self._unbinding.pop(ami, None)
+        self._flush_held()
+        self._prune()
+
+    def _forget(self, ami):
+        for epoch, slots in list(self._assignments.items()):
+            self._assignments[epoch] = tuple(None if slot is ami else slot
+                                             for slot in slots)
+        self._release(ami)
+
+    def _new_epoch(self):
+        self._epoch += 1
+        self._assignments[self._epoch] = tuple(self._slots)
+
+    def _prune(self):
+        oldest = min(list(self._ami_epochs.values()) + [self._epoch])
+        for epoch in list(self._assignments):
+            if epoch < oldest:
+                del self._assignments[epoch]
+
+    def _send_sync_event(self, ami):
+        epoch = self._epoch
+        action_handler = ami.send_action('UserEvent', {
+            'UserEvent': self.sync_event_name,
+            'Executor': self._command_id_stem,
+            'Epoch': str(epoch),
+            })
+        def _on_action_failure(exc):
+            self.logger.error("Failed synchronizing Async AGI shards, "
+                              "switching all connections now: %s", exc)
+            for other in list(self._ami_epochs):
+                self._reach_epoch(other, epoch)
+        action_handler.on_result = lambda resp: None
+        action_handler.on_exception = _on_action_failure
+
+    def _user_event_received(self, ami, event):
+        h = event.headers
+        if h.get('UserEvent') == self.sync_event_name:
+            if h.get('Executor') == self._command_id_stem:
+                self._reach_epoch(ami, int(h['Epoch']))
+            return
+        previous = self._user_event_handlers.get(ami)
+        if previous is not None:
+            previous(event)
+        else:
+            ami.unhandled_event_received(event)
+
+    def _reach_epoch(self, ami, epoch):
+        current = self._ami_epochs.get(ami)
+        if current is None or epoch <= current:
+            return
+        self._ami_epochs[ami] = epoch
+        release_at = self._unbinding.get(ami)
+        if release_at is not None and epoch >= release_at:
+            self._release(ami)
+        else:
+            self._flush_held()
+            self._prune()
+
+    def _hash(self, channel_id):
+        if not isinstance(channel_id, bytes):
+            channel_id = channel_id.encode('utf-8')
+        return zlib.crc32(channel_id) & 0xffffffff
+
+    def _owner(self, slots, h):
+        nslots = len(slots)
+        for i in range(nslots):
+            ami = slots[(h + i) % nslots]
+            if ami is not None:
+                return ami
+        return None
+
+    def _owns(self, ami, h):
+        # Whether *ami* handles the events of the channel hashed to *h*,
+        # in the assignment it has reached
+        epoch = self._ami_epochs.get(ami)
+        return (epoch is not None
+                and self._owner(self._assignments[epoch], h) is ami)
+
+    def _blocked(self, h, epoch):
+        # Whether a connection still in an assignment older than *epoch*
+        # handles the events of the channel hashed to *h*
+        for ami, ami_epoch in self._ami_epochs.items():
+            if (ami_epoch < epoch
+                and self._owner(self._assignments[ami_epoch], h) is ami):
+                return True
+        return False
+
+    def _shard_for(self, channel_id):
+        return self._owner(self._slots, self._hash(channel_id))
+
+    def _new_channel(self, channel_id):
+        channel = _AsyncAGIChannel(self)
+        channel._ami = self._shard_for(channel_id)
+        return channel
+
+    def _ami_for(self, channel):
+        return channel._ami
+
+    def _shard_event_received(self, ami, event):
+        channel_id = event.headers.get('Channel')
+        if channel_id is None:
+            self._asyncagi_event_received(event)
+            return
+        h = self._hash(channel_id)
+        if not self._owns(ami, h):
+            # A copy of an event handled on another connection
+            return
+        epoch = self._ami_epochs[ami]
+        if (self._blocked(h, epoch)
+            or any(held_epoch <= epoch and held_channel_id == channel_id
+                   for held_epoch, held_channel_id, _ in self._held)):
+            # Wait for the previous connection to handle the channel's
+            # earlier events
+            self._held.append((epoch, channel_id, event))
+            return
+        self._asyncagi_event_received(event)
+
+    def _flush_held(self):
+        held = self._held
+        if not held:
+            return
+        self._held = []
+        blocked = set()
+        for epoch, channel_id, event in held:
+            if (channel_id in blocked
+                or self._blocked(self._hash(channel_id), epoch)):
+                blocked.add(channel_id)
+                self._held.append((epoch, channel_id, event))
+            else:
+                self._asyncagi_event_received(event)
+
+    def shard_sizes(self):
+        """
+        Return a list of the numbers of channels pinned to each bound AMI
+        protocol instance, in binding order.
+        """
+        counts = collections.Counter(channel._ami
+                                     for channel in self._channels.values())
+        return [counts[ami] for ami in self.amis]
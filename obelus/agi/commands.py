@@ -0,0 +1,261 @@
+"""
+Typed helpers for common AGI commands.
+"""
+
+import collections
+
+
+_BasePlaybackResult = collections.namedtuple('_BasePlaybackResult',
+                                             ('digit', 'endpos'))
+
+class PlaybackResult(_BasePlaybackResult):
+    """
+    The result of a playback command: the *digit* pressed to interrupt
+    the playback (or None), and the *endpos* sample offset at which the
+    playback stopped (or None if not reported).
+    """
+    __slots__ = ()
+
+
+_BaseDataResult = collections.namedtuple('_BaseDataResult',
+                                         ('digits', 'timeout'))
+
+class DataResult(_BaseDataResult):
+    """
+    The result of a GET DATA command: the *digits* entered (a str,
+    possibly empty), and whether input ended due to a *timeout*.
+    """
+    __slots__ = ()
+
+
+# Result decoders.  Each takes the body of a successful response
+# (e.g. "result=1 (foo) endpos=1234") and returns the value the
+# command's Handler will fire with.  Failures (negative results) are
+# handled by the protocol before calling the decoder.
+
+def _split_result(body):
+    if not body.startswith('result='):
+        raise ValueError("Invalid AGI result %r" % (body,))
+    result, _, rest = body[7:].partition(' ')
+    return result, rest
+
+def _decode_none(body):
+    return None
+
+def _decode_int(body):
+    return int(_split_result(body)[0], 10)
+
+def _decode_digit(body):
+    code = int(_split_result(body)[0], 10)
+    return chr(code) if code else None
+
+def _decode_playback(body):
+    result, rest = _split_result(body)
+    code = int(result, 10)
+    endpos = None
+    for part in rest.split():
+        if part.startswith('endpos='):
+            endpos = int(part[7:], 10)
+    return PlaybackResult(chr(code) if code else None, endpos)
+
+def _decode_data(body):
+    result, rest = _split_result(body)
+    return DataResult(result, rest.strip() == '(timeout)')
+
+def _decode_variable(body):
+    result, rest = _split_result(body)
+    if result != '1':
+        return None
+    rest = rest.strip()
+    if rest.startswith('(') and rest.endswith(')'):
+        return rest[1:-1]
+    return rest
+
+
+class Command(object):
+    """
+    An AGI command with a constant verb (e.g. "STREAM FILE"), which is
+    encoded only once, and a *decoder* for its result.
+    """
+
+    __slots__ = ('verb', 'prefix', 'bare_line', 'decoder')
+
+    def __init__(self, verb, decoder=_decode_none):
+        self.verb = verb
+        verb = verb.encode('ascii')
+        self.prefix = verb + b' '
+        self.bare_line = verb + b'\n'
+        self.decoder = decoder
+
+    def __repr__(self):
+        return "Command(%r)" % (self.verb,)
+
+
+ANSWER = Command('ANSWER')
+CHANNEL_STATUS = Command('CHANNEL STATUS', _decode_int)
+EXEC = Command('EXEC', _decode_int)
+GET_DATA = Command('GET DATA', _decode_data)
+GET_FULL_VARIABLE = Command('GET FULL VARIABLE', _decode_variable)
+GET_VARIABLE = Command('GET VARIABLE', _decode_variable)
+HANGUP = Command('HANGUP')
+NOOP = Command('NOOP')
+SAY_DIGITS = Command('SAY DIGITS', _decode_digit)
+SAY_NUMBER = Command('SAY NUMBER', _decode_digit)
+SET_CONTEXT = Command('SET CONTEXT')
+SET_EXTENSION = Command('SET EXTENSION')
+SET_PRIORITY = Command('SET PRIORITY')
+SET_VARIABLE = Command('SET VARIABLE')
+STREAM_FILE = Command('STREAM FILE', _decode_playback)
+VERBOSE = Command('VERBOSE')
+WAIT_FOR_DIGIT = Command('WAIT FOR DIGIT', _decode_digit)
+
+
+class AGICommandsMixin(object):
+    """
+    Typed methods for common AGI commands.  Each method returns a Handler
+    firing with a decoded result, rather than a generic Response.
+    """
+
+    def send_typed_command(self, command, args=()):
+        """
+        Send the given :class:`Command` with the *args* sequence of strings.
+        """
+        raise NotImplementedError
+
+    def answer(self):
+        """
+        Answer the channel.  The Handler fires with None.
+        """
+        return self.send_typed_command(ANSWER)
+
+    def hangup(self, channel=None):
+        """
+        Hang up the current channel, or the given *channel*.
+        The Handler fires with None.
+        """
+        if channel is None:
+            return self.send_typed_command(HANGUP)
+        return self.send_typed_command(HANGUP, (channel,))
+
+    def noop(self):
+        """
+        Do nothing.  The Handler fires with None.
+        """
+        return self.send_typed_command(NOOP)
+
+    def channel_status(self, channel=None):
+        """
+        Get the state of the current channel, or the given *channel*.
+        The Handler fires with the numeric channel state.
+        """
+        if channel is None:
+            return self.send_typed_command(CHANNEL_STATUS)
+        return self.send_typed_command(CHANNEL_STATUS, (channel,))
+
+    def exec_app(self, application, *options):
+        """
+        Execute the dialplan *application* with the given *options*.
+        The Handler fires with the application's numeric return value.
+        """
+        if options:
+            return self.send_typed_command(
+                EXEC, (application, ','.join(options)))
+        return self.send_typed_command(EXEC, (application,))
+
+    def get_variable(self, name):
+        """
+        Get the value of channel variable *name*.
+        The Handler fires with the value, or None if it isn't set.
+        """
+        return self.send_typed_command(GET_VARIABLE, (name,))
+
+    def get_full_variable(self, expression, channel=None):
+        """
+        Evaluate *expression* (e.g. "${CALLERID(num)}") in the context of
+        the current channel, or the given *channel*.
+        The Handler fires with the value, or None if it isn't set.
+        """
+        if channel is None:
+            return self.send_typed_command(GET_FULL_VARIABLE, (expression,))
+        return self.send_typed_command(GET_FULL_VARIABLE,
+                                       (expression, channel))
+
+    def set_variable(self, name, value):
+        """
+        Set channel variable *name* to *value*.  The Handler fires with None.
+        """
+        return self.send_typed_command(SET_VARIABLE, (name, value))
+
+    def set_context(self, context):
+        """
+        Set the dialplan context to continue at when the AGI ends.
+        """
+        return self.send_typed_command(SET_CONTEXT, (context,))
+
+    def set_extension(self, extension):
+        """
+        Set the dialplan extension to continue at when the AGI ends.
+        """
+        return self.send_typed_command(SET_EXTENSION, (extension,))
+
+    def set_priority(self, priority):
+        """
+        Set the dialplan priority to continue at when the AGI ends.
+        """
+        return self.send_typed_command(SET_PRIORITY, (str(priority),))
+
+    def stream_file(self, filename, escape_digits='', offset=None):
+        """
+        Play *filename*, allowing interruption by one of *escape_digits*.
+        The Handler fires with a :class:`PlaybackResult`.
+        """
+        if offset is None:
+            return self.send_typed_command(STREAM_FILE,
+                                           (filename, escape_digits))
+        return self.send_typed_command(STREAM_FILE,
+                                       (filename, escape_digits, str(offset)))
+
+    def get_data(self, filename, timeout=None, max_digits=None):
+        """
+        Play *filename* and collect DTMF digits, waiting at most *timeout*
+        milliseconds and reading at most *max_digits* digits.
+        The Handler fires with a :class:`DataResult`.
+        """
+        args = [filename]
+        if timeout is not None or max_digits is not None:
+            args.append(str(timeout if timeout is not None else 0))
+        if max_digits is not None:
+            args.append(str(max_digits))
+        return self.send_typed_command(GET_DATA, args)
+
+    def wait_for_digit(self, timeout=-1):
+        """
+        Wait at most *timeout* milliseconds (-1 for infinity) for a DTMF
+        digit.  The Handler fires with the digit, or None on timeout.
+        """
+        return self.send_typed_command(WAIT_FOR_DIGIT, (str(timeout),))
+
+    def say_digits(self, digits, escape_digits=''):
+        """
+        Say the given *digits*, allowing interruption by one of
+        *escape_digits*.  The Handler fires with the digit pressed,
+        or None.
+        """
+        return self.send_typed_command(SAY_DIGITS,
+                                       (str(digits), escape_digits))
+
+    def say_number(self, number, escape_digits=''):
+        """
+        Say the given *number*, allowing interruption by one of
+        *escape_digits*.  The Handler fires with the digit pressed,
+        or None.
+        """
+        return self.send_typed_command(SAY_NUMBER,
+                                       (str(number), escape_digits))
+
+    def verbose(self, message, level=1):
+        """
+        Log *message* at the given verbosity *level* on the Asterisk
+        console.
+        """
+        return self.send_typed_command(VERBOSE, (message, str(level)))
@@ -1,5 +1,9 @@
+import collections
+import logging
 import weakref
 
+from ..common import Handler
+from ..metrics import monotonic
 from .protocol import AGIProtocol, ProtocolAGIChannel
 
 
@@ -7,28 +11,330 @@ TCP_PORT = 4573
 
 
 class FastAGIExecutor(object):
+    """
+    FastAGIExecutor creates protocol instances for incoming FastAGI
+    connections, using *protocol_factory*.
 
-    def __init__(self, protocol_factory):
+    If given, *call_later* is passed to the protocols for them to
+    implement their timeouts.  The :attr:`stats` Counter is shared
+    with the protocols.
+
+    Admission control: at most *max_sessions* sessions run concurrently,
+    and at most *max_accept_rate* connections per second are accepted
+    (with bursts of up to *accept_burst* connections).  When the session
+    limit is reached, up to *max_queued* connections wait for a free
+    slot, for at most *queue_timeout* seconds (this requires
+    *call_later*).  Other connections are shed: instead of running a
+    session, the *fallback_commands* (a sequence of argument tuples)
+    are sent and the connection is closed.  If Asterisk doesn't complete
+    that exchange within *shed_timeout* seconds, the connection is
+    closed anyway (this is only enforced with *call_later*).
+
+    If *router* is given, a :class:`~obelus.agi.routing.Router` instance,
+    the session factory is chosen according to the requested script path
+    once the AGI variables header has been received.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    # Let the dialplan know that the AGI application was overloaded
+    default_fallback_commands = (
+        ("SET", "VARIABLE", "AGIOVERLOAD", "1"),
+        )
+
+    def __init__(self, protocol_factory, call_later=None,
+                 max_sessions=None, max_accept_rate=None, accept_burst=None,
+                 max_queued=0, queue_timeout=None, fallback_commands=None,
+                 shed_timeout=10.0, router=None, clock=monotonic):
+        if queue_timeout is not None and call_later is None:
+            raise ValueError("queue_timeout requires call_later")
         self._conns = weakref.WeakSet()
         self.protocol_factory = protocol_factory
+        self.call_later = call_later
+        self.stats = collections.Counter()
+        self.max_sessions = max_sessions
+        self.max_accept_rate = max_accept_rate
+        if accept_burst is None and max_accept_rate is not None:
+            accept_burst = max(1.0, max_accept_rate)
+        self.accept_burst = accept_burst
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        if fallback_commands is None:
+            fallback_commands = self.default_fallback_commands
+        self.fallback_commands = tuple(fallback_commands)
+        self.shed_timeout = shed_timeout
+        self.router = router
+        self.clock = clock
+        # Token bucket for accept rate limiting
+        self._tokens = accept_burst
+        self._tokens_updated = clock()
+        # Connections waiting for a free session slot, oldest first
+        self._queue = collections.deque()
+        self._closing = False
+        # Handler for drain completion, while draining
+        self._drained = None
+        self._drain_timer = None
 
     def make_protocol(self):
+        self.stats['connections'] += 1
+        if self._drained is not None:
+            # Connections accepted while draining are shed
+            return self._shed_protocol()
+        if not self._take_accept_token():
+            self.stats['rate_limited_sessions'] += 1
+            return self._shed_protocol()
+        if self.max_sessions is None or len(self._conns) < self.max_sessions:
+            proto = self._new_protocol()
+            self._conns.add(proto)
+        elif len(self._queue) < self.max_queued:
+            proto = self._new_protocol()
+            proto._queued = True
+            self._queue.append(proto)
+            if self.queue_timeout is not None:
+                proto._queue_timer = self.call_later(
+                    self.queue_timeout, self._queue_timed_out, proto)
+        else:
+            return self._shed_protocol()
+        return proto
+
+    def _new_protocol(self):
         proto = self.protocol_factory(ProtocolAGIChannel())
-        self._conns.add(proto)
+        if self.call_later is not None:
+            proto.call_later = self.call_later
+        proto.stats = self.stats
+        proto.executor = self
         return proto
 
+    def _shed_protocol(self):
+        # A plain protocol which will only send the fallback commands
+        self.stats['rejected_sessions'] += 1
+        proto = FastAGIProtocol(ProtocolAGIChannel())
+        if self.call_later is not None:
+            proto.call_later = self.call_later
+        proto.stats = self.stats
+        proto._fallback = self.fallback_commands
+        proto._shed_timeout = self.shed_timeout
+        return proto
+
+    def _take_accept_token(self):
+        if self.max_accept_rate is None:
+            return True
+        now = self.clock()
+        self._tokens = min(self.accept_burst, self._tokens +
+                           (now - self._tokens_updated) * self.max_accept_rate)
+        self._tokens_updated = now
+        if self._tokens < 1.0:
+            return False
+        self._tokens -= 1.0
+        return True
+
+    def _queue_timed_out(self, proto):
+        proto._queue_timer = None
+        try:
+            self._queue.remove(proto)
+        except ValueError:
+            return
+        self.logger.warning("FastAGI connection waited too long for a "
+                            "session slot, shedding it")
+        self.stats['queue_timeouts'] += 1
+        self._shed_queued(proto)
+
+    def _shed_queued(self, proto):
+        timer = proto._queue_timer
+        if timer is not None:
+            proto._queue_timer = None
+            timer.cancel()
+        self.stats['rejected_sessions'] += 1
+        proto._shed(self.fallback_commands, self.shed_timeout)
+
+    def _admit_queued(self):
+        while self._queue and (self.max_sessions is None or
+                               len(self._conns) < self.max_sessions):
+            proto = self._queue.popleft()
+            timer = proto._queue_timer
+            if timer is not None:
+                proto._queue_timer = None
+                timer.cancel()
+            self._conns.add(proto)
+            proto._admit()
+
+    def gauges(self):
+        """
+        Return a dict of the current numbers of active and queued sessions.
+        """
+        return {
+            'active_sessions': len(self._conns),
+            'queued_sessions': len(self._queue),
+            }
+
+    def active_connections(self):
+        """
+        The number of currently open FastAGI connections, excluding
+        shed connections.
+        """
+        return len(self._conns) + len(self._queue)
+
+    def _connection_lost(self, proto):
+        if proto._queued:
+            try:
+                self._queue.remove(proto)
+            except ValueError:
+                pass
+            if proto._queue_timer is not None:
+                proto._queue_timer.cancel()
+                proto._queue_timer = None
+        else:
+            self._conns.discard(proto)
+            if not self._closing:
+                self._admit_queued()
+        self._check_drained()
+
+    def drain(self, timeout=None):
+        """
+        Stop starting new sessions, and let the running sessions finish.
+        Return a Handler which fires (with None) once all sessions have
+        finished.  If *timeout* is given (this requires *call_later*),
+        the remaining sessions are closed after that many seconds.
+
+        Connections still made while draining (the listening socket
+        should normally be closed by the caller) are shed, and so are
+        the queued connections.
+        """
+        if self._drained is not None:
+            raise RuntimeError("Executor is already draining")
+        if timeout is not None and self.call_later is None:
+            raise ValueError("drain timeout requires call_later")
+        self._drained = Handler()
+        while self._queue:
+            self._shed_queued(self._queue.popleft())
+        if timeout is not None:
+            self._drain_timer = self.call_later(timeout, self._drain_timed_out)
+        self._check_drained()
+        return self._drained
+
+    def _drain_timed_out(self):
+        self._drain_timer = None
+        if self._conns:
+            self.logger.warning("Drain timed out, closing %d FastAGI "
+                                "sessions", len(self._conns))
+            self.stats['drain_timeouts'] += 1
+            self.close()
+
+    def _check_drained(self):
+        drained = self._drained
+        if drained is None or drained._triggered or self._conns:
+            return
+        if self._drain_timer is not None:
+            self._drain_timer.cancel()
+            self._drain_timer = None
+        drained.set_result(None)
+
     def close(self):
-        for proto in list(self._conns):
+        """
+        Close all connections right away.
+        """
+        self._closing = True
+        for proto in list(self._conns) + list(self._queue):
             proto.transport.close()
             proto.connection_lost(None)
 
 
 class FastAGIProtocol(AGIProtocol):
 
+    # The FastAGIExecutor which created this protocol, if any
+    executor = None
+    # Whether the connection is waiting for a session slot
+    _queued = False
+    _queue_timer = None
+    # If not None, the commands to send instead of running a session,
+    # and the delay after which to close the connection anyway
+    _fallback = None
+    _shed_timeout = None
+    _shed_timer = None
+    # The RouteMatch for this session, if routed
+    route = None
+
+    @property
+    def _routed(self):
+        return self.executor is not None and self.executor.router is not None
+
     def connection_made(self, transport):
         super(FastAGIProtocol, self).connection_made(transport)
-        self.bind_session()
+        if self._fallback is not None:
+            self._arm_shed_timer()
+        elif not (self._queued or self._routed):
+            self.bind_session()
 
     def connection_lost(self, exc):
         super(FastAGIProtocol, self).connection_lost(exc)
+        timer = self._shed_timer
+        if timer is not None:
+            self._shed_timer = None
+            timer.cancel()
         self.unbind_session()
+        if self.executor is not None:
+            self.executor._connection_lost(self)
+
+    def header_received(self):
+        if self._fallback is not None:
+            self._send_fallback()
+        elif self._queued:
+            # The session will be started once admitted
+            return
+        elif not self._routed or self._bind_routed_session():
+            super(FastAGIProtocol, self).header_received()
+
+    def _bind_routed_session(self):
+        script = self.env.get('network_script', '')
+        match = self.executor.router.resolve(script)
+        if match is None:
+            self.logger.warning("No route for FastAGI script %r", script)
+            self.stats['unrouted_sessions'] += 1
+            self.transport.close()
+            return False
+        self.route = match
+        self.bind_session(match.session_factory)
+        return True
+
+    def _admit(self):
+        """
+        Start the session of a queued connection.
+        """
+        self._queued = False
+        if not self._routed:
+            self.bind_session()
+        if self._state == 'idle':
+            # The header was received while queued
+            self.header_received()
+
+    def _shed(self, commands, timeout=None):
+        """
+        Send *commands* and close the connection instead of running
+        a session, closing it anyway after *timeout* seconds.
+        """
+        self._queued = False
+        self._fallback = commands
+        self._shed_timeout = timeout
+        self._arm_shed_timer()
+        if self._state == 'idle':
+            self._send_fallback()
+
+    def _arm_shed_timer(self):
+        if self._shed_timeout is not None and self.call_later is not None:
+            self._shed_timer = self.call_later(self._shed_timeout,
+                                               self._shed_timed_out)
+
+    def _shed_timed_out(self):
+        self._shed_timer = None
+        self.logger.warning("Shed FastAGI connection still open after %s s, "
+                            "closing it", self._shed_timeout)
+        self._count('shed_timeouts')
+        self.transport.close()
+
+    def _send_fallback(self):
+        if not self._fallback:
+            self.transport.close()
+            return
+        handler = self.send_commands(self._fallback, stop_on_error=False)
+        handler.on_result = lambda results: self.transport.close()
+        handler.on_exception = lambda exc: self.transport.close()
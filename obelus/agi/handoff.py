@@ -0,0 +1,144 @@
+"""
+Handoff of listening sockets between processes, for zero-downtime
+restarts of FastAGI servers.
+
+The running server listens on a Unix socket (see :class:`HandoffListener`).
+The replacement process calls :func:`request_listening_socket`, which
+receives a duplicate of the server's listening socket (using SCM_RIGHTS
+ancillary data), and starts accepting connections on it.  The old server
+then stops accepting and drains its sessions.  Since the listening socket
+is never closed, no connection is refused during the restart.
+
+This requires a POSIX platform and Python 3.3 or later.
+"""
+
+import array
+import os
+import socket
+
+
+_HANDOFF_MESSAGE = b'OBELUS-HANDOFF'
+_MAX_FDS = 16
+
+def _get_logger():
+    # logging is imported lazily: the AGI scripts handing their standard
+    # input and output over to a zygote (see scriptagi.run_in_zygote)
+    # only need send_fds(), and must start fast
+    import logging
+    return logging.getLogger(__name__)
+
+
+def _check_supported():
+    if not hasattr(socket, 'AF_UNIX') or not hasattr(socket.socket,
+                                                     'sendmsg'):
+        raise NotImplementedError("socket handoff isn't supported "
+                                  "on this platform")
+
+
+def send_fds(sock, fds):
+    """
+    Send the file descriptors *fds* over the connected Unix socket *sock*.
+    """
+    _check_supported()
+    sock.sendmsg([_HANDOFF_MESSAGE],
+                 [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                   array.array('i', fds).tobytes())])
+
+
+def recv_fds(sock, maxfds=_MAX_FDS):
+    """
+    Receive a list of file descriptors from the connected Unix socket
+    *sock*.
+    """
+    _check_supported()
+    fds = array.array('i')
+    msg, ancdata, flags, addr = sock.recvmsg(
+        len(_HANDOFF_MESSAGE), socket.CMSG_LEN(maxfds * fds.itemsize))
+    if msg != _HANDOFF_MESSAGE:
+        raise ValueError("Invalid handoff message: %r" % (msg,))
+    for level, type, data in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            # Ignore any truncated integer at the end
+            data = data[:len(data) - (len(data) % fds.itemsize)]
+            fds.frombytes(data)
+    return list(fds)
+
+
+def request_listening_socket(path, timeout=10.0):
+    """
+    Connect to the :class:`HandoffListener` at *path* and return the
+    listening socket it hands off.
+    """
+    _check_supported()
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.settimeout(timeout)
+        conn.connect(path)
+        fds = recv_fds(conn)
+    finally:
+        conn.close()
+    if not fds:
+        raise ValueError("No socket received from %r" % (path,))
+    for fd in fds[1:]:
+        os.close(fd)
+    sock = socket.socket(fileno=fds[0])
+    sock.setblocking(False)
+    return sock
+
+
+class HandoffListener(object):
+    """
+    A Unix socket listening at *path*, which hands off *listening_sock*
+    to any process connecting to it.  A stale socket file at *path* is
+    removed.
+
+    The listener is non-blocking: call :meth:`handle_request` when its
+    :meth:`fileno` is readable.
+    """
+
+    def __init__(self, path, listening_sock):
+        _check_supported()
+        self.path = path
+        self.listening_sock = listening_sock
+        if os.path.exists(path):
+            os.unlink(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen(1)
+        self._sock.setblocking(False)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def handle_request(self):
+        """
+        Accept a pending handoff request and send the listening socket.
+        Return True if the socket was handed off.
+        """
+        try:
+            conn, _ = self._sock.accept()
+        except socket.error:
+            return False
+        try:
+            conn.setblocking(True)
+            send_fds(conn, [self.listening_sock.fileno()])
+        except socket.error as e:
+            _get_logger().warning("Failed handing off listening socket: %s", e)
+            return False
+        finally:
+            conn.close()
+        _get_logger().info("Listening socket handed off through %r", self.path)
+        return True
+
+    def close(self, unlink=True):
+        """
+        Close the listener, and remove its socket file if *unlink* is true.
+        """
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if unlink:
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
@@ -0,0 +1,428 @@
+"""
+Multi-process FastAGI server for the asyncio network programming framework.
+
+A master process forks a number of worker processes, each running its
+own event loop and FastAGIExecutor.  Incoming connections are spread
+over the workers by the kernel, either because each worker listens on
+its own SO_REUSEPORT socket, or because all workers accept() on a
+listening socket inherited from the master.
+
+The master restarts workers which die unexpectedly, and aggregates the
+stats periodically reported by the workers.  On SIGTERM (or SIGINT),
+workers stop accepting connections and wait for the ongoing sessions
+to finish, up to a configurable delay.
+
+For zero-downtime restarts, the master can hand off its listening socket
+to a replacement server (see :mod:`obelus.agi.handoff`), and then drain.
+"""
+
+# The asyncio adapter requires the stdlib asyncio module, so there's no
+# fallback on tulip here
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+if not asyncio:
+    raise ImportError("asyncio is required for this module to work: "
+                      "https://pypi.python.org/pypi/asyncio")
+
+import collections
+import errno
+import json
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import time
+
+from ..asynciosupport import AsyncioAdapter
+from .fastagi import TCP_PORT
+from .handoff import HandoffListener
+
+
+HAS_REUSEPORT = hasattr(socket, 'SO_REUSEPORT')
+
+
+def create_listening_socket(host, port, reuse_port=False, backlog=128):
+    """
+    Create a non-blocking TCP socket listening on (*host*, *port*).
+    If *reuse_port* is true, the SO_REUSEPORT option is set so that
+    several processes can listen on the same port.
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        sock.listen(backlog)
+        sock.setblocking(False)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+class _Worker(object):
+    """
+    The master's view of a worker process.
+    """
+
+    def __init__(self, pid, slot, read_fd):
+        self.pid = pid
+        self.slot = slot
+        self.read_fd = read_fd
+        self.started_at = time.time()
+        self.buffer = b''
+        # Latest stats snapshot (cumulative counters) and gauges
+        self.stats = collections.Counter()
+        self.gauges = collections.Counter()
+
+
+class PreforkServer(object):
+    """
+    A pre-forking FastAGI server.
+
+    *executor_factory* is called in each worker process to create the
+    worker's FastAGIExecutor (it is passed the worker's event loop, for
+    example to give the executor a *call_later* function).
+
+    *workers* is the number of worker processes (the number of CPUs
+    by default).  If *reuse_port* is true (the default when supported),
+    each worker has its own SO_REUSEPORT listening socket; otherwise the
+    workers share a socket created by the master.
+
+    On shutdown, each worker waits at most *drain_timeout* seconds for
+    its sessions to finish.  Workers report their stats every
+    *stats_interval* seconds.  A worker dying less than *restart_delay*
+    seconds after being started is restarted only after that delay.
+
+    *listening_socket*, if given, is used instead of creating a new
+    socket (for example one received with
+    :func:`~obelus.agi.handoff.request_listening_socket`).  If
+    *handoff_path* is given, the master hands off its listening socket
+    to any process connecting to that Unix socket path, and then shuts
+    down gracefully.  Both imply that *reuse_port* is false.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, executor_factory, host='127.0.0.1', port=TCP_PORT,
+                 workers=None, reuse_port=None, drain_timeout=30.0,
+                 stats_interval=5.0, restart_delay=1.0,
+                 listening_socket=None, handoff_path=None):
+        shared_socket = (listening_socket is not None or
+                         handoff_path is not None)
+        if reuse_port is None:
+            reuse_port = HAS_REUSEPORT and not shared_socket
+        elif reuse_port and not HAS_REUSEPORT:
+            raise ValueError("SO_REUSEPORT isn't supported on this platform")
+        elif reuse_port and shared_socket:
+            raise ValueError("socket handoff requires reuse_port=False")
+        self.executor_factory = executor_factory
+        self.host = host
+        self.port = port
+        self.num_workers = workers or multiprocessing.cpu_count()
+        self.reuse_port = reuse_port
+        self.drain_timeout = drain_timeout
+        self.stats_interval = stats_interval
+        self.restart_delay = restart_delay
+        self.handoff_path = handoff_path
+        self._sock = listening_socket
+        self._handoff = None
+        # pid => _Worker
+        self._workers = {}
+        # Stats of workers which have exited
+        self._retired_stats = collections.Counter()
+        # Worker slots to (re)start, with the time they can be started at
+        self._pending_slots = {}
+        self._stopping = False
+        self._workers_signalled = False
+
+    def aggregated_stats(self):
+        """
+        Return a Counter summing the stats reported by all workers,
+        including the workers which have exited.  Gauges (such as
+        'active_sessions') are summed over the running workers only.
+        """
+        stats = collections.Counter(self._retired_stats)
+        for worker in self._workers.values():
+            stats.update(worker.stats)
+            stats.update(worker.gauges)
+        stats['workers'] = len(self._workers)
+        return stats
+
+    def stop(self):
+        """
+        Ask the server to shut down gracefully.
+        """
+        self._stopping = True
+
+    def serve_forever(self):
+        """
+        Start the workers and supervise them until the server is stopped
+        and all workers have exited.
+        """
+        if not self.reuse_port and self._sock is None:
+            self._sock = create_listening_socket(self.host, self.port)
+        if self.handoff_path is not None:
+            self._handoff = HandoffListener(self.handoff_path, self._sock)
+        old_handlers = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            old_handlers[signum] = signal.signal(
+                signum, lambda signum, frame: self.stop())
+        try:
+            now = time.time()
+            for slot in range(self.num_workers):
+                self._pending_slots[slot] = now
+            self._supervise()
+        finally:
+            for signum, handler in old_handlers.items():
+                signal.signal(signum, handler)
+            if self._handoff is not None:
+                self._handoff.close()
+                self._handoff = None
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+
+    def _supervise(self):
+        while True:
+            if self._stopping:
+                self._pending_slots.clear()
+                if not self._workers_signalled:
+                    self.logger.info("Stopping %d workers",
+                                     len(self._workers))
+                    self._signal_workers(signal.SIGTERM)
+                    self._workers_signalled = True
+                if not self._workers:
+                    return
+            else:
+                self._start_pending_workers()
+            self._read_reports(timeout=0.5)
+            self._reap_workers()
+
+    def _signal_workers(self, signum):
+        for pid in self._workers:
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _start_pending_workers(self):
+        now = time.time()
+        for slot, start_at in list(self._pending_slots.items()):
+            if start_at <= now:
+                del self._pending_slots[slot]
+                self._spawn_worker(slot)
+
+    def _spawn_worker(self, slot):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Child
+            code = 1
+            try:
+                os.close(read_fd)
+                for worker in self._workers.values():
+                    if worker.read_fd is not None:
+                        os.close(worker.read_fd)
+                self._workers.clear()
+                if self._handoff is not None:
+                    self._handoff.close(unlink=False)
+                    self._handoff = None
+                for signum in (signal.SIGTERM, signal.SIGINT):
+                    signal.signal(signum, signal.SIG_DFL)
+                self._run_worker(write_fd)
+                code = 0
+            except BaseException:
+                self.logger.exception("Error in FastAGI worker")
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        self._workers[pid] = _Worker(pid, slot, read_fd)
+        self.logger.info("Started FastAGI worker %d (pid %d)", slot, pid)
+
+    def _read_reports(self, timeout):
+        fds = dict((w.read_fd, w) for w in self._workers.values()
+                   if w.read_fd is not None)
+        if self._handoff is not None:
+            fds[self._handoff.fileno()] = None
+        if not fds:
+            time.sleep(timeout)
+            return
+        try:
+            readable, _, _ = select.select(list(fds), [], [], timeout)
+        except (OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd in readable:
+            worker = fds[fd]
+            if worker is None:
+                self._handle_handoff()
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                os.close(fd)
+                worker.read_fd = None
+                continue
+            lines = (worker.buffer + data).split(b'\n')
+            worker.buffer = lines.pop()
+            for line in lines:
+                self._handle_report(worker, line)
+
+    def _handle_handoff(self):
+        if self._handoff.handle_request():
+            # The replacement server now accepts connections on our
+            # socket, we can drain (the handoff path now belongs to
+            # the replacement server)
+            self._handoff.close(unlink=False)
+            self._handoff = None
+            self._retired_stats['handoffs'] += 1
+            self.stop()
+
+    def _handle_report(self, worker, line):
+        try:
+            report = json.loads(line.decode('utf-8'))
+        except ValueError:
+            self.logger.warning("Invalid report from worker %d: %r",
+                                worker.pid, line)
+            return
+        worker.stats = collections.Counter(report['stats'])
+        worker.gauges = collections.Counter(report['gauges'])
+
+    def _reap_workers(self):
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            worker = self._workers.pop(pid, None)
+            if worker is None:
+                continue
+            self._worker_exited(worker, status)
+
+    def _worker_exited(self, worker, status):
+        if worker.read_fd is not None:
+            os.close(worker.read_fd)
+            worker.read_fd = None
+        self._retired_stats.update(worker.stats)
+        self._retired_stats['worker_exits'] += 1
+        if self._stopping:
+            self.logger.info("FastAGI worker %d (pid %d) exited",
+                             worker.slot, worker.pid)
+            return
+        self.logger.error("FastAGI worker %d (pid %d) died unexpectedly "
+                          "(status %d), restarting it",
+                          worker.slot, worker.pid, status)
+        self._retired_stats['worker_restarts'] += 1
+        # Throttle restarts of workers which die right away
+        self._pending_slots[worker.slot] = max(
+            time.time(), worker.started_at + self.restart_delay)
+
+    def _run_worker(self, write_fd):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        executor = self.executor_factory(loop)
+        if self.reuse_port:
+            sock = create_listening_socket(self.host, self.port,
+                                           reuse_port=True)
+        else:
+            sock = self._sock
+        server = loop.run_until_complete(
+            loop.create_server(
+                lambda: AsyncioAdapter(executor.make_protocol()), sock=sock))
+
+        def report():
+            line = json.dumps({
+                'stats': dict(executor.stats),
+                'gauges': executor.gauges(),
+                }) + '\n'
+            try:
+                os.write(write_fd, line.encode('utf-8'))
+            except OSError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+
+        def report_periodically():
+            report()
+            loop.call_later(self.stats_interval, report_periodically)
+
+        def drain():
+            loop.remove_signal_handler(signal.SIGTERM)
+            # Stop accepting new connections
+            server.close()
+            executor.drain().on_result = lambda _: loop.stop()
+            loop.call_later(self.drain_timeout, executor.close)
+
+        loop.add_signal_handler(signal.SIGTERM, drain)
+        # The master handles Ctrl-C
+        loop.add_signal_handler(signal.SIGINT, lambda: None)
+        report_periodically()
+        try:
+            loop.run_forever()
+        finally:
+            executor.close()
+            report()
+            os.close(write_fd)
+            loop.close()
+
+
+if __name__ == "__main__":
+    from .fastagi import FastAGIProtocol, FastAGIExecutor
+    from . import examplecli
+
+    parser = examplecli.create_parser(
+        description="Multi-process asyncio-based FastAGI server example")
+    parser.add_argument('-p', '--port', type=int, default=TCP_PORT,
+                        help='port to listen on')
+    parser.add_argument('-L', '--listen', default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes '
+                             '(default: number of CPUs)')
+    parser.add_argument('--drain-timeout', type=float, default=30.0,
+                        help='how long to wait for sessions to finish '
+                             'on shutdown')
+    parser.add_argument('--handoff-path', default=None,
+                        help='Unix socket path to hand off the listening '
+                             'socket to a replacement server')
+    parser.add_argument('--take-over', action='store_true',
+                        help='take over the listening socket of the server '
+                             'running with the same --handoff-path')
+
+    options, args = examplecli.parse_args(parser)
+    # asyncio's logger is very chatty, dampen it
+    logging.getLogger(asyncio.__name__).setLevel('WARNING')
+
+    class CLIProtocol(examplecli.CLIProtocol, FastAGIProtocol):
+        pass
+
+    def executor_factory(loop):
+        return FastAGIExecutor(CLIProtocol, call_later=loop.call_later)
+
+    sock = None
+    if args.take_over:
+        from .handoff import request_listening_socket
+        sock = request_listening_socket(args.handoff_path)
+
+    server = PreforkServer(executor_factory, args.listen, args.port,
+                           workers=args.workers,
+                           drain_timeout=args.drain_timeout,
+                           listening_socket=sock,
+                           handoff_path=args.handoff_path)
+    server.serve_forever()
+    logging.getLogger(__name__).info("Final stats: %s",
+                                     dict(server.aggregated_stats()))
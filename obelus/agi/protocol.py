@@ -6,7 +6,8 @@ import collections
 import logging
 import re
 
-from ..common import Handler, LineReceiver
+from ..common import FlowControlMixin, Handler, LineReceiver
+from .commands import AGICommandsMixin
 
 
 class AGIError(RuntimeError):
@@ -34,6 +35,19 @@ class AGICommandFailure(AGIError):
     Negative result code returned by a command.
     """
 
+class AGITimeoutError(AGIError):
+    """
+    A command or the whole AGI session took too long to complete.
+    """
+
+class AGIChannelGone(AGIError):
+    """
+    The AGI channel went away before the command completed.
+    """
+
+# Characters requiring an AGI argument to be quoted (or rejected)
+_special_arg_chars = frozenset(' \t\\"\0\n')
+
 _agi_errors = {
     510: AGIUnknownCommand,
     511: AGIForbiddenCommand,
@@ -53,6 +67,25 @@ class AGIChannel(object):
     def send_command_line(self, line):
         raise NotImplementedError
 
+    def close(self):
+        """
+        Close the channel, ending the AGI session.
+        """
+        raise NotImplementedError
+
+    def pop_pending_commands(self):
+        """
+        Return a list of the Handlers for commands sent through this
+        channel but not yet delivered to the protocol, and forget them.
+        """
+        return []
+
+    def send_command_lines(self, lines):
+        """
+        Send several command lines at once, and return a list of Handlers.
+        """
+        return [self.send_command_line(line) for line in lines]
+
 
 class ProtocolAGIChannel(AGIChannel):
     """
@@ -67,11 +100,22 @@ class ProtocolAGIChannel(AGIChannel):
         self.proto._push_command(handler)
         return handler
 
+    def send_command_lines(self, lines):
+        handlers = [Handler() for line in lines]
+        # Write all lines at once
+        self.write(b''.join(lines))
+        for handler in handlers:
+            self.proto._push_command(handler)
+        return handlers
+
     def write(self, data):
         self.proto.write(data)
 
+    def close(self):
+        self.proto.transport.close()
+
 
-class AGIProtocol(LineReceiver):
+class AGIProtocol(AGICommandsMixin, FlowControlMixin, LineReceiver):
 
     # XXX The AGI charset isn't really defined, it seems Asterisk
     # will just pass bytestrings around without caring.  We use
@@ -79,6 +123,18 @@ class AGIProtocol(LineReceiver):
     encoding = 'utf-8'
     eol = '\n'
     session_factory = None
+    # If set to True, commands can be sent without waiting for the
+    # responses to the previous ones (responses are matched in order).
+    pipelined = False
+    # Optional timeouts, in seconds: *command_timeout* bounds the time
+    # to get the response to each command, *session_timeout* the
+    # duration of the whole session.  They require *call_later*, a
+    # function with the same signature as asyncio's loop.call_later().
+    command_timeout = None
+    session_timeout = None
+    call_later = None
+    # An optional collections.Counter of notable events
+    stats = None
 
     logger = logging.getLogger(__name__)
 
@@ -95,6 +151,7 @@ class AGIProtocol(LineReceiver):
         self._resp_message = ''
         self._commands = collections.deque()
         self._session = None
+        self._session_timer = None
 
     def connection_made(self, transport):
         self.transport = transport
@@ -105,20 +162,105 @@ class AGIProtocol(LineReceiver):
     def write(self, data):
         self.transport.write(data)
 
-    def bind_session(self):
+    def bind_session(self, session_factory=None):
         """
+        Create a session using *session_factory*, or the
+        :attr:`session_factory` attribute if not given.
         """
-        if self.session_factory is not None:
-            self._session = self.session_factory()
+        if self.session_timeout is not None:
+            self._check_call_later()
+            self._session_timer = self.call_later(self.session_timeout,
+                                                  self._session_timed_out)
+        if session_factory is None:
+            session_factory = self.session_factory
+        if session_factory is not None:
+            self._session = session_factory()
             self._session.proto = self
         return self._session
 
     def unbind_session(self):
         """
         """
+        self._cancel_session_timer()
         if self._session is not None:
-            self._session.session_finished()
+            session = self._session
             self._session = None
+            session.session_finished()
+            cancel_coroutines = getattr(session, 'cancel_coroutines', None)
+            if cancel_coroutines is not None:
+                cancel_coroutines()
+
+    def header_received(self):
+        """
+        Called when the AGI variables header has been received.
+        """
+        if self._session is not None:
+            self._session.session_established()
+
+    def abort(self, exc):
+        """
+        Abort the AGI session: fail all pending commands with the *exc*
+        exception instance and close the channel.  No commands can be
+        sent afterwards.
+        """
+        self._abort(exc, ())
+
+    def _abort(self, exc, handlers):
+        if self._state == 'closed':
+            return
+        self._state = 'closed'
+        self._cancel_session_timer()
+        pending = list(handlers)
+        pending.extend(self._commands)
+        pending.extend(self.channel.pop_pending_commands())
+        self._commands.clear()
+        for handler in pending:
+            self._cancel_command_timer(handler)
+            if not handler._triggered and handler.on_exception is not None:
+                handler.set_exception(exc)
+        self.channel.close()
+
+    def _count(self, name):
+        if self.stats is not None:
+            self.stats[name] += 1
+
+    def _check_call_later(self):
+        if self.call_later is None:
+            raise ValueError("AGI timeouts require call_later")
+
+    def _cancel_session_timer(self):
+        timer = self._session_timer
+        if timer is not None:
+            self._session_timer = None
+            timer.cancel()
+
+    def _cancel_command_timer(self, handler):
+        # Command timers are stored on their Handler
+        timer = getattr(handler, '_timer', None)
+        if timer is not None:
+            handler._timer = None
+            timer.cancel()
+
+    def _arm_command_timer(self, handler):
+        self._check_call_later()
+        handler._timer = self.call_later(self.command_timeout,
+                                         self._command_timed_out, handler)
+
+    def _command_timed_out(self, handler):
+        handler._timer = None
+        if handler._triggered:
+            return
+        self.logger.warning("AGI command timed out after %s s, "
+                            "aborting session", self.command_timeout)
+        self._count('command_timeouts')
+        self._abort(AGITimeoutError("AGI command timed out"), (handler,))
+
+    def _session_timed_out(self):
+        self._session_timer = None
+        self.logger.warning("AGI session timed out after %s s, aborting",
+                            self.session_timeout)
+        self._count('session_timeouts')
+        self._abort(AGITimeoutError("AGI session timed out"), ())
 
     def _split_key_value(self, line):
         key, sep, value = line.rstrip().partition(':')
@@ -128,6 +270,9 @@ class AGIProtocol(LineReceiver):
         return key, value.lstrip()
 
     def _escape_arg(self, arg):
+        if arg and _special_arg_chars.isdisjoint(arg):
+            # Fast path: nothing to quote or escape
+            return arg
         if '\0' in arg or '\n' in arg:
             raise ValueError("Forbidden characters in AGI argument: %r"
                              % (arg,))
@@ -153,8 +298,7 @@ class AGIProtocol(LineReceiver):
                 self._state = 'idle'
                 self.logger.info("Got %d AGI variables, now "
                                  "waiting for commands", len(self.env))
-                if self._session is not None:
-                    self._session.session_established()
+                self.header_received()
                 return
             k, v = self._split_key_value(line)
             if not k.startswith('agi_'):
@@ -181,6 +325,10 @@ class AGIProtocol(LineReceiver):
             if line.strip():
                 self.logger.warning("Unexpected line received while idle: %r", line)
             return
+        if self._state == 'closed':
+            # Late data after the session was aborted
+            self.logger.debug("Ignoring line received after abort: %r", line)
+            return
         if self._state == 'awaiting-response':
             if line[3] not in ' -':
                 raise ValueError("Invalid response line %r" % line)
@@ -222,16 +370,79 @@ class AGIProtocol(LineReceiver):
     def send_command(self, args):
         """
         Send the command identified by the *args* tuple of strings.
+
+        Unless :attr:`pipelined` is true, this can only be called when
+        the responses to all previous commands have been received.
         """
-        # XXX Relax this?
-        if self._state != 'idle':
-            raise RuntimeError("Can only send AGI command when idle")
-        assert not self._commands
+        self._check_can_send()
         line = self._encode_command(args)
+        return self._send_command_line(line)
+
+    def send_typed_command(self, command, args=()):
+        """
+        Send the given :class:`~obelus.agi.commands.Command` with the
+        *args* sequence of strings.  Return a Handler firing with the
+        result computed by the command's decoder.
+        """
+        self._check_can_send()
+        if args:
+            line = ' '.join([self._escape_arg(a) for a in args]) + self.eol
+            if not isinstance(line, bytes):
+                # Python 3
+                line = line.encode(self.encoding)
+            line = command.prefix + line
+        elif self.eol == '\n':
+            line = command.bare_line
+        else:
+            line = command.verb + self.eol
+            if not isinstance(line, bytes):
+                # Python 3
+                line = line.encode(self.encoding)
+        handler = self._send_command_line(line)
+        handler._decoder = command.decoder
+        return handler
+
+    def _send_command_line(self, line):
         command = self.channel.send_command_line(line)
-        self._state = 'awaiting-response'
+        self._commands_sent()
+        if self.command_timeout is not None:
+            self._arm_command_timer(command)
         return command
 
+    def send_commands(self, commands, stop_on_error=True):
+        """
+        Send several commands at once, each identified by a tuple of
+        strings in the *commands* sequence.  Commands are encoded
+        together and written in a single operation where possible.
+
+        Return a Handler which fires with the list of the commands'
+        responses.  If *stop_on_error* is true, the Handler fails as soon
+        as one of the commands fails (note that subsequent commands have
+        already been sent and will still be executed by Asterisk).
+        Otherwise, the Handler fires when all responses are received,
+        failed commands being represented by an exception instance
+        in the list.
+        """
+        if not commands:
+            raise ValueError("Commands sequence cannot be empty")
+        self._check_can_send()
+        lines = [self._encode_command(args) for args in commands]
+        handlers = self.channel.send_command_lines(lines)
+        self._commands_sent()
+        if self.command_timeout is not None:
+            for handler in handlers:
+                self._arm_command_timer(handler)
+        return Handler.aggregate(handlers,
+                                 return_exceptions=not stop_on_error)
+
+    def _check_can_send(self):
+        if self._state == 'idle':
+            assert not self._commands
+        elif self._state == 'closed':
+            raise RuntimeError("AGI session was aborted")
+        elif self._state == 'init' or not self.pipelined:
+            raise RuntimeError("Can only send AGI command when idle")
+
     def _encode_command(self, args):
         """
         Return the encoded command line (as bytes) for the given *args*.
@@ -286,7 +497,13 @@ class AGIProtocol(LineReceiver):
         Push a command on the commands queue and adjust the protocol's state.
         """
         self._commands.append(command)
-        self._state = 'awaiting-response'
+        self._commands_sent()
+
+    def _commands_sent(self):
+        # When pipelining, a response may be in progress: only leave
+        # the idle state
+        if self._state == 'idle':
+            self._state = 'awaiting-response'
 
     def _pop_command(self):
         """
@@ -294,10 +511,26 @@ class AGIProtocol(LineReceiver):
         """
         command = self._commands.popleft()
         self._state = 'awaiting-response' if self._commands else 'idle'
+        if self.command_timeout is not None:
+            self._cancel_command_timer(command)
         return command
 
     def _got_successful_response(self, code, body):
-        command = self._pop_command()
+        self._deliver_success(self._pop_command(), body)
+
+    def _deliver_success(self, command, body):
+        """
+        Fire the *command* Handler with the result parsed from the *body*
+        of its successful response.
+        """
+        decoder = getattr(command, '_decoder', None)
+        if decoder is not None:
+            # Typed command: use its dedicated decoder
+            if body.startswith('result=-'):
+                command.set_exception(AGICommandFailure(body))
+            else:
+                command.set_result(decoder(body))
+            return
         # Try to parse the AGI ad-hoc result string
         result, variables, data = self._parse_result(body)
         if result < 0:
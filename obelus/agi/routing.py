@@ -0,0 +1,127 @@
+"""
+Routing of FastAGI sessions based on the requested script path.
+"""
+
+import collections
+try:
+    # Python 3
+    from urllib.parse import parse_qsl, unquote
+except ImportError:
+    # Python 2
+    from urlparse import parse_qsl
+    from urllib import unquote
+
+
+_BaseRouteMatch = collections.namedtuple('_BaseRouteMatch',
+                                         ('session_factory', 'path', 'args'))
+
+class RouteMatch(_BaseRouteMatch):
+    """
+    The result of a successful route lookup: the *session_factory* of the
+    matching route, the requested *path*, and the dict of query *args*.
+    """
+    __slots__ = ()
+
+
+class _Route(object):
+
+    __slots__ = ('session_factory', 'query')
+
+    def __init__(self, session_factory, query):
+        self.session_factory = session_factory
+        self.query = query
+
+    def matches(self, args):
+        for name, value in self.query:
+            if name not in args:
+                return False
+            if value is not None and args[name] != value:
+                return False
+        return True
+
+
+class _Node(object):
+
+    __slots__ = ('children', 'exact', 'prefix')
+
+    def __init__(self):
+        # Path segment => _Node
+        self.children = {}
+        # Routes matching the path ending at this node, exactly or as
+        # a prefix, most specific first
+        self.exact = []
+        self.prefix = []
+
+
+def _split_path(path):
+    return [unquote(seg) for seg in path.split('/') if seg]
+
+
+class Router(object):
+    """
+    A Router maps the script paths requested by FastAGI clients (the
+    ``agi_network_script`` AGI variable, e.g. "ivr/menu?lang=fr") to
+    session factories.
+
+    Routes are stored in a prefix tree of path segments, so that lookup
+    cost is proportional to the length of the requested path, regardless
+    of the number of routes.  *default*, if given, is the session factory
+    used when no route matches.
+    """
+
+    def __init__(self, default=None):
+        self.default = default
+        self._root = _Node()
+
+    def add_route(self, path, session_factory, prefix=False, query=None):
+        """
+        Route requests for *path* to *session_factory*.
+
+        If *prefix* is true, requests for any path below *path* also
+        match (the longest matching prefix wins).  *query* is an optional
+        dict of query arguments the request must have: a None value only
+        requires the argument to be present.  Routes with query
+        constraints are tried before those without.
+        """
+        node = self._root
+        for seg in _split_path(path):
+            try:
+                node = node.children[seg]
+            except KeyError:
+                child = node.children[seg] = _Node()
+                node = child
+        route = _Route(session_factory, tuple(sorted((query or {}).items())))
+        routes = node.prefix if prefix else node.exact
+        routes.append(route)
+        # Most constrained routes first (the sort is stable, so routes
+        # with the same number of constraints keep their insertion order)
+        routes.sort(key=lambda r: -len(r.query))
+
+    def resolve(self, script):
+        """
+        Return a :class:`RouteMatch` for the requested *script*, or None
+        if no route matches and there is no default.
+        """
+        path, _, query = script.partition('?')
+        args = dict(parse_qsl(query, keep_blank_values=True)) if query else {}
+        node = self._root
+        candidates = []
+        if node.prefix:
+            candidates.append(node.prefix)
+        for seg in _split_path(path):
+            node = node.children.get(seg)
+            if node is None:
+                break
+            if node.prefix:
+                candidates.append(node.prefix)
+        else:
+            if node.exact:
+                candidates.append(node.exact)
+        # Try the most specific routes first
+        for routes in reversed(candidates):
+            for route in routes:
+                if route.matches(args):
+                    return RouteMatch(route.session_factory, path, args)
+        if self.default is not None:
+            return RouteMatch(self.default, path, args)
+        return None
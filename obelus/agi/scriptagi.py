@@ -0,0 +1,242 @@
+"""
+Runner for classic AGI scripts, spawned by Asterisk for each call and
+talking AGI over their standard input and output.
+
+Startup cost dominates the latency of such short-lived scripts, so this
+module only imports what it needs, and I/O is done with unbuffered
+os.read() and os.write() calls.  In particular, the AGI protocol (and the
+logging package it uses) is only imported when running a session, not on
+the :func:`run_in_zygote` path.
+
+To avoid the interpreter startup altogether, a long-running
+:class:`Zygote` process can pre-import the application: the script
+started by Asterisk only hands its standard input and output over to the
+zygote (see :func:`run_in_zygote`), which forks a child process to run
+the AGI session on them.
+"""
+
+import os
+
+
+READ_SIZE = 65536
+
+
+class _FDTransport(object):
+    """
+    A minimal blocking transport writing to a file descriptor.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.closed = False
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            n = os.write(self.fd, view)
+            view = view[n:]
+
+    def close(self):
+        self.closed = True
+
+
+def run_session(session_factory=None, protocol_factory=None,
+                stdin_fd=0, stdout_fd=1):
+    """
+    Run an AGI session over the *stdin_fd* and *stdout_fd* file
+    descriptors, until the session closes the transport or Asterisk
+    closes the connection.
+
+    The protocol is created by calling *protocol_factory* (AGIProtocol
+    if None) with an AGI channel, and its session by *session_factory*
+    (or the protocol's :attr:`session_factory` attribute if None).
+    Return the protocol.
+    """
+    from .protocol import AGIProtocol, ProtocolAGIChannel
+
+    if protocol_factory is None:
+        protocol_factory = AGIProtocol
+    proto = protocol_factory(ProtocolAGIChannel())
+    transport = _FDTransport(stdout_fd)
+    proto.connection_made(transport)
+    proto.bind_session(session_factory)
+    exc = None
+    try:
+        while not transport.closed:
+            data = os.read(stdin_fd, READ_SIZE)
+            if not data:
+                break
+            proto.data_received(data)
+    except Exception as e:
+        exc = e
+        raise
+    finally:
+        proto.connection_lost(exc)
+        proto.unbind_session()
+    return proto
+
+
+def run_in_zygote(path, stdin_fd=0, stdout_fd=1):
+    """
+    Hand the *stdin_fd* and *stdout_fd* file descriptors over to the
+    :class:`Zygote` listening at *path*, wait for the session to finish,
+    and return its exit status.
+    """
+    import socket
+    from .handoff import send_fds
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        send_fds(conn, [stdin_fd, stdout_fd])
+        status = conn.recv(1)
+    finally:
+        conn.close()
+    # An empty reply means the session process died
+    return ord(status) if status else 1
+
+
+class Zygote(object):
+    """
+    A process listening on the Unix socket at *path*, forking a child
+    process for each AGI session handed over by :func:`run_in_zygote`.
+    *session_factory* and *protocol_factory* are passed to
+    :func:`run_session`.
+
+    Import the application's modules before calling :meth:`serve_forever`,
+    so that children start warm.
+    """
+
+    def __init__(self, path, session_factory=None, protocol_factory=None):
+        import socket
+
+        self.path = path
+        self.session_factory = session_factory
+        self.protocol_factory = protocol_factory
+        if os.path.exists(path):
+            os.unlink(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen(128)
+        self._children = set()
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def serve_forever(self):
+        """
+        Accept and run sessions until the process is interrupted.
+        """
+        try:
+            while True:
+                self.handle_request()
+        finally:
+            self.close()
+
+    def handle_request(self):
+        """
+        Accept one session hand-over and fork a child to run it.
+        Return the child's pid (in the parent).
+        """
+        from .handoff import recv_fds
+
+        conn, _ = self._sock.accept()
+        try:
+            fds = recv_fds(conn)
+            if len(fds) != 2:
+                for fd in fds:
+                    os.close(fd)
+                raise ValueError("Expected 2 file descriptors, got %d"
+                                 % len(fds))
+            pid = os.fork()
+            if pid == 0:
+                self._run_child(conn, fds)
+            for fd in fds:
+                os.close(fd)
+        finally:
+            conn.close()
+        self._children.add(pid)
+        self.reap_children()
+        return pid
+
+    def _run_child(self, conn, fds):
+        status = 1
+        try:
+            self._sock.close()
+            run_session(self.session_factory, self.protocol_factory,
+                        fds[0], fds[1])
+            status = 0
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+        finally:
+            try:
+                conn.sendall(bytes(bytearray([status])))
+            finally:
+                os._exit(status)
+
+    def reap_children(self):
+        """
+        Reap the finished child processes.
+        """
+        for pid in list(self._children):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                done = pid
+            if done:
+                self._children.discard(pid)
+
+    def close(self, unlink=True):
+        """
+        Stop listening, and remove the socket file if *unlink* is true.
+        """
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if unlink:
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
+
+
+def _load_factory(spec):
+    module_name, sep, attr = spec.partition(':')
+    if not sep:
+        raise ValueError("Expected 'module:name', got %r" % (spec,))
+    module = __import__(module_name, fromlist=[attr])
+    return getattr(module, attr)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) == 3 and sys.argv[1] == '--connect':
+        # Fast path for the script started by Asterisk: skip argparse
+        sys.exit(run_in_zygote(sys.argv[2]))
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Classic (stdin/stdout) AGI runner")
+    parser.add_argument('session_factory', nargs='?',
+                        help='session factory, as "module:name"')
+    parser.add_argument('--zygote', metavar='PATH',
+                        help='run a zygote listening on PATH')
+    parser.add_argument('--connect', metavar='PATH',
+                        help='run the session in the zygote at PATH')
+    args = parser.parse_args()
+
+    if args.connect:
+        sys.exit(run_in_zygote(args.connect))
+    if not args.session_factory:
+        parser.error("a session factory is required")
+    session_factory = _load_factory(args.session_factory)
+    if args.zygote:
+        try:
+            Zygote(args.zygote, session_factory).serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        run_session(session_factory)
@@ -1,14 +1,18 @@
 
-from functools import partial
 import logging
 
-from ..common import Handler
+from ..common import CoroutineRunner
 
 
 class AGISession(object):
 
     proto = None
     logger = logging.getLogger(__name__)
+    # A BlockingPool shared by sessions, for run_blocking()
+    blocking_pool = None
+    # A dict of LookupCaches shared by sessions, by name, for lookup()
+    caches = None
+    _runners = None
 
     def session_established(self):
         """
@@ -20,23 +24,59 @@ class AGISession(object):
         Called when the AGI session is torn down.
         """
 
-    def run_coroutine(self, gen):
-        handler = next(gen)
-        self._bind_coroutine_handler(gen, handler)
-
-    def _bind_coroutine_handler(self, gen, handler):
-        if not isinstance(handler, Handler):
-            raise TypeError(handler.__class__)
-        handler.on_result = partial(self._on_coroutine_result, gen, True)
-        handler.on_exception = partial(self._on_coroutine_result, gen, False)
-
-    def _on_coroutine_result(self, gen, is_success, result):
-        try:
-            if is_success:
-                handler = gen.send(result)
-            else:
-                handler = gen.throw(result)
-        except StopIteration:
-            gen.close()
-        else:
-            self._bind_coroutine_handler(gen, handler)
+    def run_coroutine(self, coro):
+        """
+        Run *coro*, which can be either a generator yielding Handlers
+        (e.g. those returned by :meth:`AGIProtocol.send_command`) or a
+        native coroutine (``async def``) awaiting them.
+
+        Return a Handler firing with the coroutine's return value, or
+        with the exception it raised (callbacks can be set even if the
+        coroutine already finished synchronously).  Coroutines still
+        running when the session is torn down are cancelled: their
+        Handlers fail with :exc:`~obelus.common.CoroutineCancelled`.
+
+        (with asyncio, native coroutines awaiting Handlers can also be
+        run as regular asyncio tasks, for example to use
+        ``asyncio.wait_for()``)
+        """
+        if self._runners is None:
+            self._runners = set()
+        runner = CoroutineRunner(coro, self._runners.discard)
+        self._runners.add(runner)
+        return runner.start().handler
+
+    def cancel_coroutines(self):
+        """
+        Cancel all coroutines started with :meth:`run_coroutine` which
+        are still running.
+        """
+        runners = self._runners
+        if runners:
+            self._runners = None
+            for runner in list(runners):
+                runner.cancel()
+
+    def run_blocking(self, func, *args):
+        """
+        Call *func* with *args* in the :attr:`blocking_pool`, without
+        blocking the event loop.  Return a Handler firing with the
+        function's return value, or with the exception it raised, e.g.::
+
+            rules = yield self.run_blocking(db.lookup_rules, dnid)
+        """
+        if self.blocking_pool is None:
+            raise ValueError("no blocking_pool configured")
+        return self.blocking_pool.run(func, *args)
+
+    def lookup(self, cache_name, key):
+        """
+        Look up *key* in the :class:`~obelus.cache.LookupCache` named
+        *cache_name* in :attr:`caches`.  Return a Handler firing with the
+        cached or loaded value, e.g.::
+
+            rules = yield self.lookup('routing', dnid)
+        """
+        if not self.caches or cache_name not in self.caches:
+            raise ValueError("no cache named %r configured" % (cache_name,))
+        return self.caches[cache_name].get(key)
@@ -52,13 +52,13 @@ if __name__ == "__main__":
 
     options, args = examplecli.parse_args(parser)
 
-    loop = IOLoop.instance()
+    loop = IOLoop.current()
 
     class CLIProtocol(examplecli.CLIProtocol, FastAGIProtocol):
         pass
 
     executor = FastAGIExecutor(CLIProtocol)
-    server = FastAGIServer(executor, io_loop=loop)
+    server = FastAGIServer(executor)
     server.listen(args.port, args.listen)
 
     try:
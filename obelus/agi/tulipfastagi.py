@@ -19,6 +19,7 @@ if __name__ == "__main__":
     import logging
     import signal
 
+    from ..asynciosupport import AsyncioAdapter
     from .fastagi import FastAGIProtocol, FastAGIExecutor, TCP_PORT
     from .session import AGISession
     from . import examplecli
@@ -38,12 +39,13 @@ if __name__ == "__main__":
         pass
 
     executor = FastAGIExecutor(CLIProtocol)
+    protocol_factory = lambda: AsyncioAdapter(executor.make_protocol())
 
     loop = asyncio.get_event_loop()
     try:
-        loop.create_server(executor.make_protocol, args.listen, args.port)
+        loop.create_server(protocol_factory, args.listen, args.port)
     except AttributeError:
         # Old Tulip versions
-        loop.start_serving(executor.make_protocol, args.listen, args.port)
+        loop.start_serving(protocol_factory, args.listen, args.port)
     loop.add_signal_handler(signal.SIGINT, loop.stop)
     loop.run_forever()
@@ -1,12 +1,18 @@
+import collections
 import hashlib
 import logging
 import os
 
-from obelus.ami.protocol import Handler, ActionError
+from obelus.ami.protocol import Event, Handler, ActionError
+from obelus.metrics import Histogram, monotonic
 
 
 log = logging.getLogger(__name__)
 
+# Channel states, see <asterisk>/include/asterisk/channelstate.h
+AST_STATE_RINGING = 5
+AST_STATE_UP = 6
+
 
 class OriginateError(ActionError):
     """
@@ -22,6 +28,93 @@ class OriginateError(ActionError):
         return "Originate failed with reason %s" % (self.reason)
 
 
+class CallMetrics(object):
+    """
+    Latency metrics for the calls tracked by a CallManager.
+
+    Call state transitions are timestamped using *clock* (a monotonic
+    clock by default), and the time spent between some transitions is
+    accounted in histograms, one per (metric name, call label) pair.
+    The label of a call is its :attr:`Call.metrics_label` attribute.
+    """
+
+    # Transition names, in their normal order of occurrence.
+    # "created" is the time the call was originated or, for incoming
+    # calls, detected.
+    transitions = ('created', 'queued', 'dialing_started', 'ringing',
+                   'dialing_finished', 'answered', 'ended')
+
+    # (metric name, start transition, end transition)
+    intervals = [
+        ('queue_to_dial', 'queued', 'dialing_started'),
+        ('post_dial_delay', 'dialing_started', 'ringing'),
+        ('dial_time', 'dialing_started', 'dialing_finished'),
+        ('answer_time', 'created', 'answered'),
+        ('duration', 'answered', 'ended'),
+        ]
+
+    def __init__(self, clock=monotonic, histogram_factory=Histogram):
+        self.clock = clock
+        self.histogram_factory = histogram_factory
+        # (metric name, label) => Histogram
+        self._histograms = {}
+        # end transition => [(metric name, start transition)]
+        self._intervals_by_end = {}
+        for name, start, end in self.intervals:
+            self._intervals_by_end.setdefault(end, []).append((name, start))
+
+    def record(self, call, transition):
+        """
+        Record the given *transition* for *call*.  Only the first
+        occurrence of a transition is taken into account.
+        """
+        timestamps = call._timestamps
+        if transition in timestamps:
+            return
+        now = timestamps[transition] = self.clock()
+        for name, start in self._intervals_by_end.get(transition, ()):
+            started = timestamps.get(start)
+            if started is not None:
+                self.observe(name, call.metrics_label, now - started)
+
+    def observe(self, name, label, value):
+        """
+        Account for the *value* of metric *name* with the given *label*.
+        """
+        key = (name, label)
+        try:
+            hist = self._histograms[key]
+        except KeyError:
+            hist = self._histograms[key] = self.histogram_factory()
+        hist.add(value)
+
+    def histogram(self, name, label=None):
+        """
+        Return the histogram for metric *name* with the given *label*,
+        or None if nothing was accounted for them.
+        """
+        return self._histograms.get((name, label))
+
+    def histograms(self):
+        """
+        Return a dict mapping (metric name, label) pairs to histograms.
+        """
+        return dict(self._histograms)
+
+    def merge(self, other):
+        """
+        Merge the histograms of the *other* CallMetrics instance into
+        this one.
+        """
+        for key, hist in other._histograms.items():
+            try:
+                mine = self._histograms[key]
+            except KeyError:
+                self._histograms[key] = hist.copy()
+            else:
+                mine.merge(hist)
+
+
 class Call(object):
     """
     Base class for call objects tracked by the CallManager.
@@ -32,6 +125,9 @@ class Call(object):
     _call_id = None
     _action_id = None
     manager = None
+    # Label under which latency metrics for this call are accounted
+    # (e.g. a trunk or context name); see CallMetrics.
+    metrics_label = None
 
     def _bind(self, manager, call_id, outgoing):
         self.manager = manager
@@ -41,6 +137,12 @@ class Call(object):
         self._unique_ids = set()
         self._outgoing = outgoing
         self._last_hangup_cause = None
+        self._caller_id = None
+        # Unique ID of the channel the caller ID number comes from
+        self._caller_id_source = None
+        self._linked_id = None
+        # transition name => timestamp (only filled if metrics are enabled)
+        self._timestamps = {}
 
     def __str__(self):
         try:
@@ -59,6 +161,33 @@ class Call(object):
             pass
         raise ValueError("Call not originated")
 
+    def event_history(self):
+        """
+        Get the last AMI events received for this call, as a list of
+        :class:`~obelus.ami.history.EventRecord` instances (oldest first).
+        The list is empty unless the CallManager was created with an
+        EventHistory instance.
+        """
+        if self.manager is None:
+            raise ValueError("Call not originated")
+        history = self.manager.event_history
+        if history is None:
+            return []
+        return history.events(self)
+
+    def timestamps(self):
+        """
+        Get the times at which the call went through its various
+        transitions (see CallMetrics.transitions).  Return a dict
+        mapping transition names onto clock values.  The dict is empty
+        unless the CallManager was created with a CallMetrics instance.
+        """
+        try:
+            return dict(self._timestamps)
+        except AttributeError:
+            pass
+        raise ValueError("Call not originated")
+
     # XXX should the state notification callbacks get the logical
     # channel number? (i.e. 1 for the first created channel, 2 for the
     # second...)
@@ -106,6 +235,34 @@ class CallManager(object):
     """
     A CallManager helps you originate calls and track the status of those
     calls using an AMI instance.
+
+    Optional secondary indexes can be maintained to look up tracked
+    calls quickly: pass *index_channels* to enable :meth:`call_by_channel`,
+    *index_caller_ids* to enable :meth:`calls_by_caller_id` and
+    *index_linked_ids* to enable :meth:`calls_by_linked_id`.  Each index
+    costs a bit of memory per tracked channel or call, which is why they
+    are disabled by default.
+
+    If a :class:`CallMetrics` instance is passed as *metrics*, call
+    transitions are timestamped and latency metrics are accounted in it.
+
+    By default, the event handlers of :class:`Call` objects are called
+    synchronously while AMI events are being processed.  If they can be
+    slow, pass an :class:`~obelus.executors.OrderedCallbackExecutor` as
+    *callback_executor*: the handlers will then run on the executor's
+    workers, still in order for any given call.
+
+    If an :class:`~obelus.ami.history.EventHistory` instance is passed as
+    *event_history*, the last AMI events received for each call are kept
+    in it, and can be retrieved using :meth:`Call.event_history`.
+
+    Bursts of Newstate events can be coalesced by passing a number of
+    seconds as *coalesce_states*: state changes are then delivered at
+    most once per call per interval, with only the latest state.  An
+    interval of 0 delivers them on the next event loop iteration.  This
+    requires *call_later*, a function with the same signature as
+    asyncio's ``loop.call_later()`` (for example Twisted's
+    ``reactor.callLater``).
     """
     # Implementation strategy: when originating a call, we add a custom
     # variable with a unique name and a unique per-call value.  We then
@@ -115,8 +272,21 @@ class CallManager(object):
     # unique id, but this would prevent the user from passing important
     # information there.
 
-    def __init__(self, ami):
+    def __init__(self, ami, index_channels=False, index_caller_ids=False,
+                 index_linked_ids=False, metrics=None,
+                 callback_executor=None, event_history=None,
+                 call_later=None, coalesce_states=None):
+        if coalesce_states is not None and call_later is None:
+            raise ValueError("state coalescing requires call_later")
         self.ami = ami
+        self.call_later = call_later
+        self.coalesce_states = coalesce_states
+        # call => (state, state_desc) not delivered yet
+        self._pending_states = collections.OrderedDict()
+        self._flush_scheduled = False
+        self.event_history = event_history
+        self.metrics = metrics
+        self.callback_executor = callback_executor
         self._tracking_variable = (
             'X_' + hashlib.sha1(os.urandom(32)).hexdigest().upper()[:12])
         self._call_id = 1
@@ -129,6 +299,15 @@ class CallManager(object):
         self._calls = {}
         # channel unique id => call
         self._unique_ids = {}
+        # Optional secondary indexes (None when disabled).
+        # channel name => call
+        self._channels = {} if index_channels else None
+        # channel unique id => channel name (to maintain the above)
+        self._channel_names = {} if index_channels else None
+        # caller id number => set of calls
+        self._caller_ids = {} if index_caller_ids else None
+        # linked id => set of calls
+        self._linked_ids = {} if index_linked_ids else None
         self.setup_event_handlers()
 
     def _new_call_id(self):
@@ -149,6 +328,38 @@ class CallManager(object):
         """
         return set(self._calls.values()) - set(self._actions.values())
 
+    def call_by_channel(self, channel):
+        """
+        Return the tracked call owning the channel named *channel*
+        (e.g. "SIP/trunk-0000abcd"), or None if there isn't any.
+        The CallManager must have been created with *index_channels*
+        set to True.
+        """
+        if self._channels is None:
+            raise ValueError("channel index not enabled")
+        return self._channels.get(channel)
+
+    def calls_by_caller_id(self, caller_id):
+        """
+        Return a set of tracked calls with the given *caller_id* number.
+        The CallManager must have been created with *index_caller_ids*
+        set to True.
+        """
+        if self._caller_ids is None:
+            raise ValueError("caller id index not enabled")
+        return set(self._caller_ids.get(caller_id, ()))
+
+    def calls_by_linked_id(self, linked_id):
+        """
+        Return a set of tracked calls with the given *linked_id*
+        (the "Linkedid" header sent by Asterisk 1.8 and later).
+        The CallManager must have been created with *index_linked_ids*
+        set to True.
+        """
+        if self._linked_ids is None:
+            raise ValueError("linked id index not enabled")
+        return set(self._linked_ids.get(linked_id, ()))
+
     def listen_for_incoming_calls(self, call_factory):
         """
         When an incoming call is detected, call the given *call_factory*.
@@ -174,6 +385,11 @@ class CallManager(object):
         self.ami.register_event_handler('Hangup', self.on_hangup)
         # Yes, there's an event called "OriginateResponse"
         self.ami.register_event_handler('OriginateResponse', self.on_originate_response)
+        if self._channels is not None:
+            self.ami.register_event_handler('Rename', self.on_rename)
+        if self._caller_ids is not None:
+            self.ami.register_event_handler('NewCallerid',
+                                            self.on_new_caller_id)
 
     def setup_filters(self):
         """
@@ -216,14 +432,16 @@ class CallManager(object):
         variables[self._tracking_variable] = call_id
         a = self.ami.send_action('Originate', headers, variables)
         call._bind(self, call_id, outgoing=True)
+        self._record(call, 'created')
         def _call_queued(resp):
             action_id = resp.headers['ActionID']
             call._action_id = action_id
             self._actions[action_id] = call
             self._calls[call_id] = call
-            call.call_queued()
+            self._record(call, 'queued')
+            self._notify(call, 'call_queued')
         def _call_failed(exc):
-            call.call_failed(exc)
+            self._notify(call, 'call_failed', exc)
         a.on_result = _call_queued
         a.on_exception = _call_failed
 
@@ -238,8 +456,100 @@ class CallManager(object):
         action_id = h['ActionID']
         call = self._actions.pop(action_id, None)
         if call is not None:
-            del self._calls[call._call_id]
-            call.call_failed(OriginateError(h['Reason']))
+            self._record_event(call, event)
+            self._untrack_call(call)
+            self._notify(call, 'call_failed', OriginateError(h['Reason']))
+
+    def _notify(self, call, method_name, *args):
+        """
+        Call the *method_name* event handler of *call* with *args*,
+        either immediately or through the callback executor.
+        """
+        if self._pending_states and method_name != 'call_state_changed':
+            # Deliver any coalesced state change first, to preserve
+            # ordering of notifications.
+            pending = self._pending_states.pop(call, None)
+            if pending is not None:
+                self._deliver_state(call, *pending)
+        method = getattr(call, method_name)
+        if self.callback_executor is None:
+            method(*args)
+        else:
+            self.callback_executor.submit(call, method, *args)
+
+    def _record_event(self, call, event):
+        if self.event_history is not None:
+            self.event_history.record(call, event)
+
+    def _record(self, call, transition):
+        if self.metrics is not None:
+            self.metrics.record(call, transition)
+
+    def _add_to_index(self, index, key, call):
+        if index is not None and key:
+            try:
+                index[key].add(call)
+            except KeyError:
+                index[key] = {call}
+
+    def _remove_from_index(self, index, key, call):
+        if index is not None and key:
+            calls = index.get(key)
+            if calls is not None:
+                calls.discard(call)
+                if not calls:
+                    del index[key]
+
+    def _track_channel(self, call, unique_id, channel, headers=None):
+        """
+        Associate the channel *unique_id* with *call*, updating the
+        secondary indexes.  *headers* are the headers of the first
+        event seen for the channel, if any.
+        """
+        call._unique_ids.add(unique_id)
+        self._unique_ids[unique_id] = call
+        if self._channels is not None and channel:
+            self._channels[channel] = call
+            self._channel_names[unique_id] = channel
+        if headers is None:
+            return
+        if call._caller_id is None:
+            caller_id = headers.get('CallerIDNum') or None
+            if caller_id is not None:
+                self._set_caller_id(call, caller_id, unique_id)
+        self._update_linked_id(call, headers)
+
+    def _set_caller_id(self, call, caller_id, unique_id):
+        self._remove_from_index(self._caller_ids, call._caller_id, call)
+        call._caller_id = caller_id
+        call._caller_id_source = unique_id
+        self._add_to_index(self._caller_ids, caller_id, call)
+
+    def _update_linked_id(self, call, headers):
+        # The Linkedid of a channel changes when it gets bridged or
+        # masqueraded: follow it on every event
+        linked_id = headers.get('Linkedid') or None
+        if linked_id is not None and linked_id != call._linked_id:
+            self._remove_from_index(self._linked_ids, call._linked_id, call)
+            call._linked_id = linked_id
+            self._add_to_index(self._linked_ids, linked_id, call)
+
+    def _untrack_channel(self, call, unique_id):
+        """
+        Dissociate the channel *unique_id* from *call*, updating the
+        secondary indexes.
+        """
+        del self._unique_ids[unique_id]
+        call._unique_ids.remove(unique_id)
+        if self._channels is not None:
+            channel = self._channel_names.pop(unique_id, None)
+            if channel is not None and self._channels.get(channel) is call:
+                del self._channels[channel]
+
+    def _untrack_call(self, call):
+        del self._calls[call._call_id]
+        self._remove_from_index(self._caller_ids, call._caller_id, call)
+        self._remove_from_index(self._linked_ids, call._linked_id, call)
 
     def _candidate_incoming_call(self, unique_id):
         newchannel = self._new_channels.pop(unique_id, None)
@@ -248,9 +558,11 @@ class CallManager(object):
             call = self._incoming_call_factory(newchannel)
             call_id = self._new_call_id()
             call._bind(self, call_id, outgoing=False)
+            self._record(call, 'created')
+            self._record_event(call, Event('Newchannel', newchannel))
             self._calls[call_id] = call
-            call._unique_ids.add(unique_id)
-            self._unique_ids[unique_id] = call
+            self._track_channel(call, unique_id, newchannel['Channel'],
+                                newchannel)
             return call
 
     def on_new_channel(self, event):
@@ -277,7 +589,7 @@ class CallManager(object):
         unique_id = h['Uniqueid']
         # The channel belongs to an outgoing call, remove it from the
         # candidate incoming calls.
-        self._new_channels.pop(unique_id, None)
+        newchannel = self._new_channels.pop(unique_id, None)
         try:
             call = self._calls[call_id]
         except KeyError:
@@ -290,8 +602,11 @@ class CallManager(object):
             return
         log.info("Got UniqueID %r for call #%s (channel %r)",
                  unique_id, call_id, h['Channel'])
-        call._unique_ids.add(unique_id)
-        self._unique_ids[unique_id] = call
+        self._track_channel(call, unique_id, h['Channel'],
+                            newchannel if newchannel is not None else h)
+        if newchannel is not None:
+            self._record_event(call, Event('Newchannel', newchannel))
+        self._record_event(call, event)
 
     def on_local_bridge(self, event):
         """
@@ -312,8 +627,8 @@ class CallManager(object):
             return
         log.info("LocalBridge: new related UniqueID %r for call #%s",
                  id2, call._call_id)
-        call._unique_ids.add(id2)
-        self._unique_ids[id2] = call
+        self._track_channel(call, id2, h.get('Channel2'))
+        self._record_event(call, event)
 
     def _update_hangup_cause(self, call, headers):
         cause = int(headers.get('Cause', '0'), 10)
@@ -332,6 +647,8 @@ class CallManager(object):
             log.debug("SoftHangupRequest: unknown UniqueID %r, ignoring",
                       unique_id)
             return
+        self._record_event(call, event)
+        self._update_linked_id(call, h)
         self._update_hangup_cause(call, h)
 
     def on_hangup(self, event):
@@ -342,15 +659,56 @@ class CallManager(object):
         h = event.headers
         unique_id = h['Uniqueid']
         self._new_channels.pop(unique_id, None)
-        call = self._unique_ids.pop(unique_id, None)
+        call = self._unique_ids.get(unique_id)
         if call is None:
             log.debug("Hangup: unknown UniqueID %r, ignoring", unique_id)
             return
-        call._unique_ids.remove(unique_id)
+        self._record_event(call, event)
+        self._update_linked_id(call, h)
+        self._untrack_channel(call, unique_id)
         self._update_hangup_cause(call, h)
         if not call._unique_ids:
-            del self._calls[call._call_id]
-            call.call_ended(*call._last_hangup_cause)
+            self._untrack_call(call)
+            self._record(call, 'ended')
+            self._notify(call, 'call_ended', *call._last_hangup_cause)
+
+    def on_rename(self, event):
+        """
+        On a Rename event, update the channel index.
+        This handler is only registered if the channel index is enabled.
+        """
+        h = event.headers
+        unique_id = h['Uniqueid']
+        call = self._unique_ids.get(unique_id)
+        if call is None:
+            log.debug("Rename: unknown UniqueID %r, ignoring", unique_id)
+            return
+        self._record_event(call, event)
+        self._update_linked_id(call, h)
+        old_name = self._channel_names.get(unique_id)
+        if old_name is not None and self._channels.get(old_name) is call:
+            del self._channels[old_name]
+        new_name = h['Newname']
+        self._channels[new_name] = call
+        self._channel_names[unique_id] = new_name
+
+    def on_new_caller_id(self, event):
+        """
+        On a NewCallerid event, update the caller ID index.
+        This handler is only registered if the caller ID index is enabled.
+        """
+        h = event.headers
+        unique_id = h['Uniqueid']
+        call = self._unique_ids.get(unique_id)
+        if call is None:
+            log.debug("NewCallerid: unknown UniqueID %r, ignoring", unique_id)
+            return
+        self._record_event(call, event)
+        self._update_linked_id(call, h)
+        if call._caller_id_source not in (None, unique_id):
+            # The call's caller ID comes from another of its channels
+            return
+        self._set_caller_id(call, h.get('CallerIDNum') or None, unique_id)
 
     def on_dial(self, event):
         """
@@ -362,12 +720,16 @@ class CallManager(object):
         if call is None:
             log.debug("Dial: unknown UniqueID %r, ignoring", unique_id)
             return
+        self._record_event(call, event)
+        self._update_linked_id(call, h)
         sub = h['SubEvent']
         if sub == 'Begin':
-            call.dialing_started()
+            self._record(call, 'dialing_started')
+            self._notify(call, 'dialing_started')
         elif sub == 'End':
             status = h['DialStatus']
-            call.dialing_finished(status)
+            self._record(call, 'dialing_finished')
+            self._notify(call, 'dialing_finished', status)
 
     def on_new_state(self, event):
         """
@@ -381,9 +743,34 @@ class CallManager(object):
             if call is None:
                 log.debug("Newstate: unknown UniqueID %r, ignoring", unique_id)
                 return
+        self._record_event(call, event)
+        self._update_linked_id(call, h)
         state = int(h['ChannelState'])
         state_desc = h['ChannelStateDesc']
+        if state == AST_STATE_RINGING:
+            self._record(call, 'ringing')
+        elif state == AST_STATE_UP:
+            self._record(call, 'answered')
+        if self.coalesce_states is None:
+            self._deliver_state(call, state, state_desc)
+            return
+        self._pending_states[call] = (state, state_desc)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.call_later(self.coalesce_states, self._flush_states)
+
+    def _deliver_state(self, call, state, state_desc):
         if state != call._state:
             call._state = state
-            call.call_state_changed(state, state_desc)
+            self._notify(call, 'call_state_changed', state, state_desc)
         call._state_desc = state_desc
+
+    def _flush_states(self):
+        """
+        Deliver the coalesced state changes.
+        """
+        self._flush_scheduled = False
+        pending = self._pending_states
+        self._pending_states = collections.OrderedDict()
+        for call, (state, state_desc) in pending.items():
+            self._deliver_state(call, state, state_desc)
@@ -0,0 +1,103 @@
+"""
+Bounded per-call history of AMI events, for post-mortem debugging.
+"""
+
+import collections
+import time
+
+
+_BaseEventRecord = collections.namedtuple('_BaseEventRecord',
+                                          ('name', 'timestamp', 'headers'))
+
+class EventRecord(_BaseEventRecord):
+    """
+    A compact record of an AMI event: its *name*, the *timestamp* it
+    was received at, and a tuple of (name, value) pairs for the
+    *headers* deemed interesting.
+    """
+    __slots__ = ()
+
+
+class EventHistory(object):
+    """
+    EventHistory keeps the last *events_per_call* AMI events received
+    for each call, as :class:`EventRecord` instances.
+
+    The total number of stored records is capped to *max_events*: when
+    the cap is exceeded, the histories of the oldest calls are evicted
+    first.  Histories are kept after the calls end, so that they can be
+    examined afterwards.
+
+    Only the headers listed in *headers* are stored.
+
+    An EventHistory can be shared by several CallManagers.
+    """
+
+    default_headers = ('Uniqueid', 'Channel', 'ChannelState', 'SubEvent',
+                       'DialStatus', 'Cause', 'Cause-txt', 'Response',
+                       'Reason')
+
+    def __init__(self, events_per_call=20, max_events=100000, headers=None,
+                 clock=time.time):
+        if events_per_call < 1 or max_events < 1:
+            raise ValueError("history sizes should be positive")
+        self.events_per_call = events_per_call
+        self.max_events = max_events
+        self.headers = tuple(headers or self.default_headers)
+        self.clock = clock
+        # (manager, call id) => deque of EventRecords, oldest calls first
+        # (call ids are only unique for a given manager)
+        self._histories = collections.OrderedDict()
+        self._num_events = 0
+
+    def __len__(self):
+        """
+        The total number of stored event records.
+        """
+        return self._num_events
+
+    def _key(self, call):
+        return (call.manager, call._call_id)
+
+    def record(self, call, event):
+        """
+        Record *event* in the history of *call*.
+        """
+        key = self._key(call)
+        try:
+            history = self._histories[key]
+        except KeyError:
+            history = self._histories[key] = collections.deque(
+                maxlen=self.events_per_call)
+        if len(history) == self.events_per_call:
+            # Oldest record will be dropped by the deque
+            self._num_events -= 1
+        h = event.headers
+        headers = tuple((name, h[name]) for name in self.headers
+                        if name in h)
+        history.append(EventRecord(event.name, self.clock(), headers))
+        self._num_events += 1
+        while self._num_events > self.max_events:
+            _, evicted = self._histories.popitem(last=False)
+            self._num_events -= len(evicted)
+
+    def events(self, call):
+        """
+        Return a list of the stored EventRecords for *call*, oldest first.
+        """
+        return list(self._histories.get(self._key(call), ()))
+
+    def discard(self, call):
+        """
+        Forget the history of *call*.
+        """
+        history = self._histories.pop(self._key(call), None)
+        if history is not None:
+            self._num_events -= len(history)
+
+    def clear(self):
+        """
+        Forget all stored histories.
+        """
+        self._histories.clear()
+        self._num_events = 0
@@ -6,7 +6,7 @@ import collections
 import logging
 
 from ..casedict import CaseDict
-from ..common import Handler, LineReceiver
+from ..common import FlowControlMixin, Handler, LineReceiver
 
 
 _BaseResponse = collections.namedtuple('_BaseResponse',
@@ -36,7 +36,7 @@ class ActionError(RuntimeError):
     """
 
 
-class BaseAMIProtocol(LineReceiver):
+class BaseAMIProtocol(FlowControlMixin, LineReceiver):
     """
     Implementation of the AMI protocol syntax.
     """
@@ -63,6 +63,22 @@ class BaseAMIProtocol(LineReceiver):
     def reset(self):
         self._state = 'init'
         self._event_handlers = {}
+        # Event name => (lowercased header name, predicate)
+        self._event_filters = {}
+        self._event_filter = None
+
+    def set_event_filter(self, name, header, predicate):
+        """
+        Skip the events named *name* whose *header* value doesn't satisfy
+        *predicate* (a callable taking the value and returning a boolean),
+        as soon as that header is received: the rest of the event isn't
+        parsed, and the event isn't delivered.  Events lacking *header*
+        are delivered.  Pass None as *predicate* to remove the filter.
+        """
+        if predicate is None:
+            self._event_filters.pop(name, None)
+        else:
+            self._event_filters[name] = (header.lower(), predicate)
 
     def _split_key_value(self, line):
         key, sep, value = line.rstrip().partition(':')
@@ -94,6 +110,11 @@ class BaseAMIProtocol(LineReceiver):
         Processing an incoming *line* of AMI data.
         """
         line = line.rstrip(b'\r\n')
+        if self._state == 'skipping-event':
+            # Filtered out event: just wait for its end
+            if not line:
+                self._state = 'idle'
+            return
         if not isinstance(line, str):
             # Python 3 only
             line = line.decode(self.encoding)
@@ -119,6 +140,7 @@ class BaseAMIProtocol(LineReceiver):
                 self._state = 'in-event'
                 self._headers = CaseDict()
                 self._event_type = value
+                self._event_filter = self._event_filters.get(value)
             else:
                 raise ValueError("Unexpected first message line %r" % (line,))
         elif self._state == 'in-response':
@@ -144,6 +166,13 @@ class BaseAMIProtocol(LineReceiver):
             else:
                 # Expect a "Key: value" line
                 key, value = self._split_key_value(line)
+                event_filter = self._event_filter
+                if (event_filter is not None
+                    and key.lower() == event_filter[0]
+                    and not event_filter[1](value)):
+                    self._state = 'skipping-event'
+                    self._headers = None
+                    return
                 self._headers[key] = value
         elif self._state == 'in-response-follows':
             # Inside a command payload: accumulate until we encounter
@@ -222,7 +251,33 @@ class AMIProtocol(BaseAMIProtocol):
         and *headers* (a dict mapping names onto values).
         Return a Handler which will be fired when the AMI returns a
         response for the action.
+
+        The action is written even if writing is paused: senders of
+        many actions should wait on :meth:`wait_writable` first.
+        """
+        data, action_id = self._serialize_action(name, headers, variables)
+        self.logger.debug("Sending action: %r", data)
+        self.write(data)
+        return self._register_action(action_id)
+
+    def send_actions(self, actions):
         """
+        Send several actions at once, in a single write.  *actions* is
+        a sequence of (name, headers) tuples.  Return a list of Handlers,
+        as returned by :meth:`send_action`.
+        """
+        chunks = []
+        action_ids = []
+        for name, headers in actions:
+            data, action_id = self._serialize_action(name, headers)
+            chunks.append(data)
+            action_ids.append(action_id)
+        data = b''.join(chunks)
+        self.logger.debug("Sending actions: %r", data)
+        self.write(data)
+        return [self._register_action(action_id) for action_id in action_ids]
+
+    def _serialize_action(self, name, headers, variables=()):
         if variables:
             vars_list = headers.setdefault('Variable', [])
             for key, value in variables.items():
@@ -232,9 +287,9 @@ class AMIProtocol(BaseAMIProtocol):
             action_id = headers['ActionID']
         except KeyError:
             action_id = headers['ActionID'] = self._next_action_id()
-        data = self.serialize_message(headers)
-        self.logger.debug("Sending action: %r", data)
-        self.write(data)
+        return self.serialize_message(headers), action_id
+
+    def _register_action(self, action_id):
         handler = Handler()
         handler._action_id = action_id
         self._actions[action_id] = handler
@@ -30,13 +30,21 @@ if __name__ == "__main__":
 
     log = logging.getLogger(__name__)
 
-    loop = IOLoop.instance()
+    loop = IOLoop.current()
     proto = examplecli.CLIProtocol(loop, options)
     adapter = TornadoAdapter(proto)
 
-    stream = IOStream(socket.socket(), loop)
-    stream.connect((options.host, options.port),
-                   lambda: adapter.bind_stream(stream))
+    stream = IOStream(socket.socket())
+    def connected(future):
+        try:
+            future.result()
+        except Exception as e:
+            log.error("Connection to %r failed: %s",
+                      (options.host, options.port), e)
+            loop.stop()
+        else:
+            adapter.bind_stream(stream)
+    loop.add_future(stream.connect((options.host, options.port)), connected)
 
     try:
         loop.start()
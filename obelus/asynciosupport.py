@@ -0,0 +1,84 @@
+"""
+Adapter for the asyncio network programming framework.
+"""
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+if not asyncio:
+    raise ImportError("asyncio is required for this module to work: "
+                      "https://pypi.python.org/pypi/asyncio")
+
+
+class AsyncioAdapter(asyncio.Protocol):
+    """
+    asyncio adapter for Obelus protocols (e.g. AMIProtocol, AGIProtocol),
+    inheriting from :class:`asyncio.Protocol`.
+
+    Pass a *protocol* instance to create the adapter, which you can
+    e.g. return from the protocol factory given to
+    :meth:`loop.create_connection` or :meth:`loop.create_server`.
+
+    The transport's flow control notifications are forwarded to the
+    protocol (see :meth:`pause_writing`).
+    """
+
+    transport = None
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.protocol.connection_made(self)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if getattr(self.protocol, 'writing_paused', False):
+            # Don't leave senders waiting forever
+            self.protocol.resume_writing()
+        self.protocol.connection_lost(exc)
+
+    def data_received(self, data):
+        self.protocol.data_received(data)
+
+    def eof_received(self):
+        # Let the transport close itself
+        return False
+
+    def pause_writing(self):
+        """
+        Called by the transport when its write buffer goes over the
+        high-water mark.  The protocol's pause_writing() is called, if
+        it has one (see :class:`~obelus.common.FlowControlMixin`).
+        """
+        pause_writing = getattr(self.protocol, 'pause_writing', None)
+        if pause_writing is not None:
+            pause_writing()
+
+    def resume_writing(self):
+        """
+        Called by the transport when its write buffer drains below the
+        low-water mark.
+        """
+        resume_writing = getattr(self.protocol, 'resume_writing', None)
+        if resume_writing is not None:
+            resume_writing()
+
+    # Transport methods
+    def write(self, data):
+        """
+        Write the given *data* bytes on the transport.
+        """
+        if self.transport is None:
+            raise ValueError("write() on a non-connected protocol")
+        self.transport.write(data)
+
+    def close(self):
+        """
+        Close the transport's underlying connection.
+        """
+        if self.transport is not None:
+            self.transport.close()
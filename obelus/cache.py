@@ -0,0 +1,155 @@
+"""
+A lookup cache returning Handlers, for data shared by many sessions
+(routing rules, caller information, etc.).
+"""
+
+import collections
+import logging
+
+from .common import Handler
+from .metrics import monotonic
+
+
+class LookupCache(object):
+    """
+    A LookupCache stores the results of an asynchronous *loader*, a
+    callable taking a key and returning a Handler (for example one
+    returned by :meth:`BlockingPool.run`).
+
+    At most *max_size* entries are kept, least recently used entries
+    being evicted first.  Entries expire *ttl* seconds after being
+    loaded.  A None result means "not found": it is cached too, but
+    only for *negative_ttl* seconds.  Loader failures aren't cached.
+
+    Concurrent lookups of a key which isn't cached are coalesced into
+    a single call to the loader.
+
+    The :attr:`stats` Counter records hits, misses, etc.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, loader, max_size=1024, ttl=60.0, negative_ttl=5.0,
+                 clock=monotonic):
+        if max_size < 1:
+            raise ValueError("max_size should be positive")
+        self.loader = loader
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.stats = collections.Counter()
+        # key => (value, expiry time), least recently used first
+        self._entries = collections.OrderedDict()
+        # key => list of Handlers waiting for the ongoing load
+        self._loading = {}
+
+    @classmethod
+    def blocking(cls, pool, func, **kwargs):
+        """
+        Create a LookupCache calling the blocking function *func* in
+        *pool*, a :class:`~obelus.executors.BlockingPool`.
+        """
+        return cls(lambda key: pool.run(func, key), **kwargs)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Look up *key*, and return a Handler firing with the cached or
+        loaded value.
+
+        On a cache hit, the returned Handler has already fired: the result
+        is delivered as soon as :attr:`~Handler.on_result` is set, or
+        right away when yielded or awaited from a coroutine (see
+        :meth:`AGISession.lookup`).  Use :meth:`get_cached` for
+        synchronous lookups.
+        """
+        entry = self._get_entry(key)
+        if entry is not None:
+            handler = Handler()
+            handler.set_result(entry[0])
+            return handler
+        handler = Handler()
+        waiters = self._loading.get(key)
+        if waiters is not None:
+            self.stats['coalesced'] += 1
+            waiters.append(handler)
+            return handler
+        self.stats['misses'] += 1
+        self._loading[key] = [handler]
+        try:
+            load = self.loader(key)
+        except Exception as e:
+            self._load_failed(key, e)
+            return handler
+        if load._triggered:
+            # Synchronous loader
+            if load._failed:
+                self._load_failed(key, load._outcome)
+            else:
+                self._loaded(key, load._outcome)
+        else:
+            load.on_result = lambda value: self._loaded(key, value)
+            load.on_exception = lambda exc: self._load_failed(key, exc)
+        return handler
+
+    def get_cached(self, key, default=None):
+        """
+        Return the cached value for *key*, or *default* if not cached.
+        This never calls the loader.
+        """
+        entry = self._get_entry(key)
+        return default if entry is None else entry[0]
+
+    def _get_entry(self, key):
+        entries = self._entries
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= self.clock():
+            self.stats['expirations'] += 1
+            del entries[key]
+            return None
+        # Mark as most recently used
+        del entries[key]
+        entries[key] = entry
+        self.stats['hits' if entry[0] is not None else 'negative_hits'] += 1
+        return entry
+
+    def invalidate(self, key):
+        """
+        Remove *key* from the cache.
+        """
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        self._entries.clear()
+
+    def _loaded(self, key, value):
+        self.stats['loads'] += 1
+        ttl = self.ttl if value is not None else self.negative_ttl
+        entries = self._entries
+        entries.pop(key, None)
+        if ttl > 0:
+            entries[key] = (value, self.clock() + ttl)
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+                self.stats['evictions'] += 1
+        for handler in self._loading.pop(key):
+            handler.set_result(value)
+
+    def _load_failed(self, key, exc):
+        self.stats['errors'] += 1
+        self.logger.warning("Failed loading %r: %r", key, exc)
+        for handler in self._loading.pop(key):
+            try:
+                handler.set_exception(exc)
+            except Exception:
+                # Only a result callback was set on this waiter (the
+                # failure is logged above): still fail the other waiters
+                pass
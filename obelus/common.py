@@ -1,6 +1,8 @@
 
 import functools
 import logging
+import sys
+import threading
 
 
 class Handler(object):
@@ -12,12 +14,23 @@ class Handler(object):
     a producer will create it for you, and you will set the
     :attr:`on_result` and :attr:`on_exception` attributes to be
     notified of the output of the operation.
+
+    A Handler can fire before its callbacks are set (for example when
+    the operation completes synchronously): its outcome is then kept,
+    and delivered as soon as the matching callback is set.  A failure
+    with only a success callback set is raised by :meth:`set_exception`,
+    rather than silently dropped.
+
+    Handlers are also awaitable from native coroutines, either those run
+    by :class:`CoroutineRunner` (e.g. through
+    :meth:`AGISession.run_coroutine`), or asyncio tasks.
     """
 
     _unset = object()
     _result_cb = None
     _exception_cb = None
     _outcome = _unset
+    _failed = False
 
     _triggered = False
 
@@ -36,10 +49,9 @@ class Handler(object):
         if not callable(cb):
             raise TypeError("on_result should be callable, got %r"
                             % type(cb))
-        if self._triggered:
-            raise NotImplementedError(
-                "callbacks can't be set after Handler was triggered")
         self._result_cb = cb
+        if self._triggered and not self._failed:
+            cb(self._outcome)
 
     @property
     def on_exception(self):
@@ -56,10 +68,9 @@ class Handler(object):
         if not callable(cb):
             raise TypeError("on_exception should be callable, got %r"
                             % type(cb))
-        if self._triggered:
-            raise NotImplementedError(
-                "callbacks can't be set after Handler was triggered")
         self._exception_cb = cb
+        if self._triggered and self._failed:
+            cb(self._outcome)
 
     def set_result(self, result):
         if self._triggered:
@@ -68,6 +79,7 @@ class Handler(object):
             raise TypeError("Cannot set an exception with set_result(), "
                             "please use set_exception()")
         self._triggered = True
+        self._outcome = result
         if self._result_cb is not None:
             self._result_cb(result)
 
@@ -77,16 +89,27 @@ class Handler(object):
         if not isinstance(exc, BaseException):
             raise TypeError("Exception instance expected")
         self._triggered = True
-        if self._exception_cb is None:
-            raise exc
-        else:
+        self._outcome = exc
+        self._failed = True
+        if self._exception_cb is not None:
             self._exception_cb(exc)
+        elif self._result_cb is not None:
+            # Someone only waits for a result: don't swallow the error
+            raise exc
+
+    def __await__(self):
+        return _HandlerAwaiter(self)
 
     @classmethod
-    def aggregate(cls, handlers):
+    def aggregate(cls, handlers, return_exceptions=False):
         """
         Return a new Handler which will trigger when all the given
         handlers have successfully fired, or when one of them fails.
+        Its result is the list of the given handlers' results.
+
+        If *return_exceptions* is true, the new Handler only triggers
+        when all the given handlers have fired, and failures are reported
+        as exception instances in the results list.
         """
         result_handler = cls()
         n = len(handlers)
@@ -103,10 +126,249 @@ class Handler(object):
                 result_handler.set_exception(exc)
         for i, handler in enumerate(handlers):
             handler.on_result = functools.partial(_on_result, i)
-            handler.on_exception = _on_exception
+            if return_exceptions:
+                handler.on_exception = handler.on_result
+            else:
+                handler.on_exception = _on_exception
         return result_handler
 
 
+# Whether a CoroutineRunner is currently stepping a coroutine (per thread)
+_driver_state = threading.local()
+
+
+def _running_asyncio_loop():
+    asyncio = sys.modules.get('asyncio')
+    if asyncio is None:
+        return None
+    get_running_loop = getattr(asyncio, '_get_running_loop', None)
+    if get_running_loop is None:
+        # Python 3.5.2 and earlier
+        return None
+    return get_running_loop()
+
+
+def _future_for_handler(handler, loop):
+    fut = loop.create_future()
+    def _on_result(result):
+        if not fut.cancelled():
+            fut.set_result(result)
+    def _on_exception(exc):
+        if not fut.cancelled():
+            fut.set_exception(exc)
+    handler.on_result = _on_result
+    handler.on_exception = _on_exception
+    return fut
+
+
+class _HandlerAwaiter(object):
+    """
+    The iterator returned by Handler.__await__().  When driven by a
+    CoroutineRunner, it yields the Handler itself; inside an asyncio
+    task, it delegates to an asyncio Future.
+    """
+
+    __slots__ = ('_handler', '_delegate', '_started')
+
+    def __init__(self, handler):
+        self._handler = handler
+        self._delegate = None
+        self._started = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    next = __next__
+
+    def send(self, value):
+        if self._delegate is not None:
+            return self._delegate.send(value)
+        if self._started:
+            # Resumed by the CoroutineRunner with the handler's result
+            raise StopIteration(value)
+        self._started = True
+        handler = self._handler
+        if handler._triggered:
+            if handler._failed:
+                raise handler._outcome
+            raise StopIteration(handler._outcome)
+        if getattr(_driver_state, 'running', False):
+            return handler
+        loop = _running_asyncio_loop()
+        if loop is None:
+            raise RuntimeError("Handler can only be awaited from a coroutine "
+                               "run by CoroutineRunner or asyncio")
+        self._delegate = _future_for_handler(handler, loop).__await__()
+        return next(self._delegate)
+
+    def throw(self, typ, val=None, tb=None):
+        if self._delegate is not None:
+            return self._delegate.throw(typ, val, tb)
+        if val is None:
+            val = typ if isinstance(typ, BaseException) else typ()
+        raise val
+
+    def close(self):
+        if self._delegate is not None:
+            self._delegate.close()
+
+
+class CoroutineCancelled(Exception):
+    """
+    A coroutine was cancelled before it finished.
+    """
+
+
+class CoroutineRunner(object):
+    """
+    Run a coroutine which waits on Handlers.  The coroutine can be
+    either a generator yielding Handlers, or a native coroutine
+    awaiting them.  Each time the awaited Handler fires, the coroutine
+    is resumed with its result (or its exception is thrown into it).
+
+    The :attr:`handler` attribute is a Handler firing with the
+    coroutine's return value, or with the exception it raised.
+    If given, *done_callback* is called with the runner once the
+    coroutine has finished or was cancelled.
+    """
+
+    def __init__(self, coro, done_callback=None):
+        self.coro = coro
+        self.handler = Handler()
+        self.done_callback = done_callback
+        self._done = False
+        # Bind callbacks once rather than on every step
+        self._on_result = functools.partial(self._step, False)
+        self._on_exception = functools.partial(self._step, True)
+
+    def start(self):
+        """
+        Start running the coroutine, until it first waits on a Handler.
+        """
+        self._step(False, None)
+        return self
+
+    def done(self):
+        """
+        Whether the coroutine has finished.
+        """
+        return self._done
+
+    def cancel(self):
+        """
+        Cancel the coroutine by closing it.  The :attr:`handler` fails
+        with CoroutineCancelled (delivered when an exception callback is
+        set, if there is none yet).
+        """
+        if self._done:
+            return
+        self._set_done()
+        self.coro.close()
+        try:
+            self.handler.set_exception(CoroutineCancelled())
+        except CoroutineCancelled:
+            # Only a result callback is set: nobody waits for failures,
+            # and the caller of cancel() shouldn't get the exception
+            pass
+
+    def _set_done(self):
+        self._done = True
+        if self.done_callback is not None:
+            self.done_callback(self)
+
+    def _step(self, is_exception, value):
+        if self._done:
+            # Cancelled while waiting
+            return
+        coro = self.coro
+        state = _driver_state
+        was_running = getattr(state, 'running', False)
+        state.running = True
+        try:
+            while True:
+                try:
+                    if is_exception:
+                        handler = coro.throw(value)
+                    else:
+                        handler = coro.send(value)
+                except StopIteration as e:
+                    self._set_done()
+                    self.handler.set_result(getattr(e, 'value', None))
+                    return
+                except Exception as e:
+                    self._set_done()
+                    self.handler.set_exception(e)
+                    return
+                if not isinstance(handler, Handler):
+                    is_exception = True
+                    value = TypeError("expected a Handler, got %r"
+                                      % (handler.__class__,))
+                elif handler._triggered:
+                    # Resume immediately with the known outcome
+                    is_exception = handler._failed
+                    value = handler._outcome
+                else:
+                    handler.on_result = self._on_result
+                    handler.on_exception = self._on_exception
+                    return
+        finally:
+            state.running = was_running
+
+
+class FlowControlMixin(object):
+    """
+    A mixin class for protocols, tracking whether the transport asked
+    to pause writing (because its write buffer is full).  Transports
+    or adapters call :meth:`pause_writing` and :meth:`resume_writing`.
+
+    Protocols don't buffer or refuse writes while writing is paused:
+    backpressure is up to the senders, which should wait on
+    :meth:`wait_writable` before sending more data.
+    """
+
+    _writing_paused = False
+    _write_waiters = None
+
+    @property
+    def writing_paused(self):
+        """
+        Whether the transport asked to pause writing.
+        """
+        return self._writing_paused
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        waiters = self._write_waiters
+        if waiters:
+            self._write_waiters = None
+            for handler in waiters:
+                handler.set_result(None)
+
+    def wait_writable(self):
+        """
+        Return a Handler firing once writing isn't paused anymore (right
+        away if writing isn't paused).  Senders can wait on it to apply
+        backpressure, e.g. from a coroutine::
+
+            yield proto.wait_writable()
+            proto.send_action('Originate', headers)
+        """
+        handler = Handler()
+        if not self._writing_paused:
+            handler.set_result(None)
+        else:
+            if self._write_waiters is None:
+                self._write_waiters = []
+            self._write_waiters.append(handler)
+        return handler
+
+
 class LineReceiver(object):
     """
     A base protocol class turning incoming data into distinct lines.
@@ -0,0 +1,187 @@
+"""
+Helpers for running callbacks outside of the protocol's event loop.
+"""
+
+import collections
+from functools import partial
+import logging
+import threading
+
+from .common import Handler
+from .metrics import Histogram, monotonic
+
+
+class OrderedCallbackExecutor(object):
+    """
+    Run callbacks on a thread-based :class:`concurrent.futures.Executor`
+    instance (typically a bounded
+    :class:`~concurrent.futures.ThreadPoolExecutor`), while guaranteeing
+    that callbacks submitted with the same key run sequentially, in
+    submission order.
+
+    Callbacks with different keys can run in parallel, up to the
+    executor's number of workers.
+
+    Process-based executors are not supported: the callbacks would run
+    on copies of the objects they touch, in the worker processes.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, executor):
+        self.executor = executor
+        self._lock = threading.Lock()
+        # key => deque of (func, args) waiting for the running callback
+        # with the same key to finish
+        self._queues = {}
+        self._pending = 0
+
+    def submit(self, key, func, *args):
+        """
+        Schedule *func* to be called with *args*, after all callbacks
+        previously submitted with the same *key* have finished.
+        """
+        with self._lock:
+            self._pending += 1
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((func, args))
+                return
+            self._queues[key] = collections.deque()
+        self._run(key, func, args)
+
+    def _run(self, key, func, args):
+        while True:
+            try:
+                fut = self.executor.submit(func, *args)
+            except Exception as e:
+                # E.g. the executor was shut down: drop the callback, but
+                # don't leave the key's queue blocked
+                self.logger.error("Failed to submit callback for key %r: %r",
+                                  key, e)
+                item = self._next_callback(key)
+                if item is None:
+                    return
+                func, args = item
+            else:
+                fut.add_done_callback(partial(self._callback_done, key))
+                return
+
+    def _next_callback(self, key):
+        # Release the key's current callback, and return the next
+        # (func, args) queued for this key, or None
+        with self._lock:
+            self._pending -= 1
+            queue = self._queues[key]
+            if not queue:
+                del self._queues[key]
+                return None
+            return queue.popleft()
+
+    def _callback_done(self, key, fut):
+        if not fut.cancelled():
+            exc = fut.exception()
+            if exc is not None:
+                self.logger.error("Exception in callback for key %r: %r",
+                                  key, exc)
+        item = self._next_callback(key)
+        if item is not None:
+            self._run(key, item[0], item[1])
+
+    def queue_depth(self, key=None):
+        """
+        Return the number of submitted callbacks which haven't finished
+        running yet, either for the given *key* or (if None) in total.
+        """
+        with self._lock:
+            if key is None:
+                return self._pending
+            queue = self._queues.get(key)
+            return 0 if queue is None else len(queue) + 1
+
+
+class BlockingPoolFull(RuntimeError):
+    """
+    Too many calls are pending in a :class:`BlockingPool`.
+    """
+
+
+class BlockingPool(object):
+    """
+    Run blocking functions (database or HTTP lookups, etc.) on a
+    :class:`concurrent.futures.Executor` instance (typically a bounded
+    :class:`~concurrent.futures.ThreadPoolExecutor` shared by all
+    sessions), and deliver their outcome as Handlers on the event loop
+    thread.
+
+    *call_soon_threadsafe* schedules a callback on the event loop thread
+    from another thread (for example asyncio's
+    ``loop.call_soon_threadsafe``, Twisted's ``reactor.callFromThread``
+    or Tornado's ``IOLoop.add_callback``).  If *max_pending* is given,
+    at most that many calls can be pending at once.
+
+    The :attr:`queue_latency` histogram records the time calls wait for
+    a worker thread, and :attr:`run_time` the time they take to run.
+    """
+
+    def __init__(self, executor, call_soon_threadsafe, max_pending=None,
+                 clock=monotonic, histogram_factory=Histogram):
+        self.executor = executor
+        self.call_soon_threadsafe = call_soon_threadsafe
+        self.max_pending = max_pending
+        self.clock = clock
+        self.queue_latency = histogram_factory()
+        self.run_time = histogram_factory()
+        self.stats = collections.Counter()
+        # Only updated from the event loop thread
+        self._pending = 0
+
+    def run(self, func, *args):
+        """
+        Call *func* with *args* in the pool, and return a Handler firing
+        (on the event loop thread) with its return value or exception.
+        Must be called from the event loop thread.
+        """
+        if self.max_pending is not None and self._pending >= self.max_pending:
+            self.stats['rejected'] += 1
+            raise BlockingPoolFull("%d calls already pending"
+                                   % (self._pending,))
+        handler = Handler()
+        # Only count the call once submitted, in case submit() raises
+        self.executor.submit(self._call, handler, self.clock(), func, args)
+        self._pending += 1
+        self.stats['submitted'] += 1
+        return handler
+
+    def queue_depth(self):
+        """
+        Return the number of calls which haven't been delivered yet.
+        """
+        return self._pending
+
+    def _call(self, handler, submitted, func, args):
+        # Runs in a worker thread
+        started = self.clock()
+        try:
+            result = func(*args)
+        except BaseException as e:
+            # Always deliver the outcome, even for e.g. SystemExit
+            failed, result = True, e
+        else:
+            failed = False
+        finished = self.clock()
+        self.call_soon_threadsafe(self._deliver, handler, submitted, started,
+                                  finished, failed, result)
+
+    def _deliver(self, handler, submitted, started, finished, failed,
+                 result):
+        # Runs in the event loop thread
+        self._pending -= 1
+        self.queue_latency.add(started - submitted)
+        self.run_time.add(finished - started)
+        if failed:
+            self.stats['failed'] += 1
+            handler.set_exception(result)
+        else:
+            self.stats['completed'] += 1
+            handler.set_result(result)
@@ -0,0 +1,122 @@
+"""
+Lightweight metrics helpers.
+"""
+
+import math
+import time
+
+try:
+    # Python 3.3+
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+
+
+class Histogram(object):
+    """
+    A histogram of positive values (typically durations in seconds)
+    using logarithmically-spaced buckets.
+
+    Values below *min_value* are accounted in the first bucket, values
+    above *max_value* in the last one.  Histograms with the same bucket
+    layout can be merged together, e.g. to aggregate measurements taken
+    in several processes.
+    """
+
+    def __init__(self, min_value=1e-3, max_value=1e3, buckets_per_decade=10):
+        if not 0 < min_value < max_value:
+            raise ValueError("need 0 < min_value < max_value")
+        self.min_value = min_value
+        self.max_value = max_value
+        self.buckets_per_decade = buckets_per_decade
+        self._log_min = math.log10(min_value)
+        nbuckets = int(math.ceil(
+            (math.log10(max_value) - self._log_min) * buckets_per_decade))
+        self._buckets = [0] * (nbuckets + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def _layout(self):
+        return (self.min_value, self.max_value, self.buckets_per_decade)
+
+    def _bucket_index(self, value):
+        if value <= self.min_value:
+            return 0
+        i = int((math.log10(value) - self._log_min)
+                * self.buckets_per_decade) + 1
+        return min(i, len(self._buckets) - 1)
+
+    def _bucket_upper_bound(self, i):
+        return 10 ** (self._log_min + float(i) / self.buckets_per_decade)
+
+    def add(self, value):
+        """
+        Account for the given *value*.
+        """
+        self._buckets[self._bucket_index(value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Merge the contents of the *other* histogram into this one.
+        """
+        if other._layout() != self._layout():
+            raise ValueError("cannot merge histograms with different layouts")
+        for i, n in enumerate(other._buckets):
+            self._buckets[i] += n
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def copy(self):
+        """
+        Return a copy of this histogram.
+        """
+        h = Histogram(*self._layout())
+        h.merge(self)
+        return h
+
+    @property
+    def mean(self):
+        """
+        The mean of accounted values, or None if the histogram is empty.
+        """
+        return self.sum / self.count if self.count else None
+
+    def percentile(self, pct):
+        """
+        Return an estimate of the *pct* percentile (between 0 and 100) of
+        accounted values, or None if the histogram is empty.  The estimate
+        is accurate within the histogram's bucket resolution.
+        """
+        if not 0 <= pct <= 100:
+            raise ValueError("percentile should be between 0 and 100")
+        if not self.count:
+            return None
+        if pct == 0:
+            return self.min
+        threshold = self.count * pct / 100.0
+        running = 0
+        for i, n in enumerate(self._buckets):
+            running += n
+            if n and running >= threshold:
+                if i == len(self._buckets) - 1:
+                    # Overflow bucket
+                    return self.max
+                return max(self.min, min(self.max,
+                                         self._bucket_upper_bound(i)))
+        return self.max
+
+    def __repr__(self):
+        return "<%s count=%d mean=%r max=%r>" % (
+            self.__class__.__name__, self.count, self.mean, self.max)
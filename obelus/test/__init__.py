@@ -69,3 +69,59 @@ def watch_logging(logger_name=None, level=logging.INFO):
         logger.handlers = old_handlers
         logger.propagate = old_propagate
         logger.setLevel(old_level)
+
+
+class FakeClock(object):
+    """
+    A monotonic()-compatible clock, returning the :attr:`now` attribute.
+    """
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeTimer(object):
+
+    def __init__(self, scheduler, delay, callback, args):
+        self.scheduler = scheduler
+        self.delay = delay
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        self.scheduler.timers.remove(self)
+
+
+class FakeScheduler(object):
+    """
+    A call_later()-compatible scheduler with cancellable timers, running
+    callbacks on demand.
+    """
+
+    def __init__(self):
+        self.timers = []
+
+    def call_later(self, delay, callback, *args):
+        timer = FakeTimer(self, delay, callback, args)
+        self.timers.append(timer)
+        return timer
+
+    def fire(self, delay):
+        """
+        Run the pending timers with the given *delay*.
+        """
+        for timer in [t for t in self.timers if t.delay == delay]:
+            if timer in self.timers:
+                self.timers.remove(timer)
+                timer.callback(*timer.args)
+
+    def run_all(self):
+        """
+        Run all pending timers.
+        """
+        timers, self.timers = self.timers, []
+        for timer in timers:
+            timer.callback(*timer.args)
@@ -0,0 +1,87 @@
+"""
+Tests for native (async def) coroutines awaiting Handlers.  This module
+is a syntax error before Python 3.5, so it is only imported from
+test_coroutines on recent Pythons.
+"""
+
+import asyncio
+import sys
+import unittest
+
+from mock import Mock
+
+from obelus.common import Handler, CoroutineRunner
+from .test_session import SessionTestBase
+
+
+class NativeCoroutineSessionTest(SessionTestBase, unittest.TestCase):
+
+    def test_run_native_coroutine(self):
+        p = self.proto
+        async def coro():
+            resp = await p.send_command(("foo",))
+            resp2 = await p.send_command(("bar",))
+            return resp.result + resp2.result
+        h = self.run_coroutine(coro())
+        p.line_received(b"200 result=1\n")
+        p.line_received(b"200 result=2\n")
+        h.on_result.assert_called_once_with(3)
+        self.assertEqual(p.transport.write.call_count, 2)
+
+    def test_native_coroutine_exception(self):
+        p = self.proto
+        async def coro():
+            try:
+                await p.send_command(("foo",))
+            except Exception as e:
+                return str(e)
+        h = self.run_coroutine(coro())
+        p.line_received(b"510 Invalid or unknown command\n")
+        h.on_result.assert_called_once_with("Invalid or unknown command")
+
+    def test_await_triggered_handler(self):
+        done = Handler()
+        done.set_result(5)
+        async def coro():
+            return await done
+        runner = CoroutineRunner(coro())
+        runner.handler.on_result = Mock()
+        runner.start()
+        runner.handler.on_result.assert_called_once_with(5)
+
+
+@unittest.skipIf(sys.version_info < (3, 7),
+                 "awaiting Handlers from asyncio requires Python 3.7")
+class AsyncioTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_await_in_task(self):
+        h = Handler()
+        async def coro():
+            asyncio.get_running_loop().call_soon(h.set_result, 42)
+            return await h
+        self.assertEqual(self.loop.run_until_complete(coro()), 42)
+
+    def test_await_in_task_exception(self):
+        h = Handler()
+        async def coro():
+            asyncio.get_running_loop().call_soon(h.set_exception,
+                                                 ZeroDivisionError())
+            return await h
+        with self.assertRaises(ZeroDivisionError):
+            self.loop.run_until_complete(coro())
+
+    def test_wait_for_timeout(self):
+        h = Handler()
+        async def coro():
+            return await asyncio.wait_for(h, 0.01)
+        with self.assertRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(coro())
+        # Late result is ignored
+        h.set_result(1)
+
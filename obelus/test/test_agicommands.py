@@ -0,0 +1,146 @@
+
+import unittest
+
+from mock import Mock, ANY
+
+from obelus.agi.commands import PlaybackResult, DataResult
+from obelus.agi.protocol import (
+    AGIProtocol, ProtocolAGIChannel, AGICommandFailure, AGIUnknownCommand)
+from . import main
+from .test_agiprotocol import HEADER
+
+
+class TypedCommandsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.proto = AGIProtocol(ProtocolAGIChannel())
+        self.proto.data_received(HEADER + b"\n")
+        self.proto.channel.write = Mock()
+
+    def check_command(self, handler, expected_line, response, expected_result):
+        p = self.proto
+        p.channel.write.assert_called_once_with(expected_line)
+        handler.on_result = Mock()
+        handler.on_exception = Mock()
+        p.line_received(response)
+        self.assertEqual(p._state, 'idle')
+        self.assertEqual(handler.on_exception.call_count, 0)
+        handler.on_result.assert_called_once_with(expected_result)
+
+    def test_answer(self):
+        h = self.proto.answer()
+        self.check_command(h, b"ANSWER\n", b"200 result=0\n", None)
+
+    def test_hangup(self):
+        h = self.proto.hangup("SIP/foo-0001")
+        self.check_command(h, b"HANGUP SIP/foo-0001\n", b"200 result=1\n",
+                           None)
+
+    def test_custom_eol(self):
+        self.proto.eol = '\r\n'
+        h = self.proto.hangup("SIP/foo-0001")
+        self.check_command(h, b"HANGUP SIP/foo-0001\r\n", b"200 result=1\n",
+                           None)
+        self.proto.channel.write.reset_mock()
+        h = self.proto.answer()
+        self.check_command(h, b"ANSWER\r\n", b"200 result=0\n", None)
+
+    def test_channel_status(self):
+        h = self.proto.channel_status()
+        self.check_command(h, b"CHANNEL STATUS\n", b"200 result=6\n", 6)
+
+    def test_exec_app(self):
+        h = self.proto.exec_app("Dial", "SIP/foo", "20")
+        self.check_command(h, b"EXEC Dial SIP/foo,20\n", b"200 result=0\n", 0)
+
+    def test_set_variable(self):
+        h = self.proto.set_variable("FOO", "some value")
+        self.check_command(h, b'SET VARIABLE FOO "some value"\n',
+                           b"200 result=1\n", None)
+
+    def test_get_variable(self):
+        h = self.proto.get_variable("FOO")
+        self.check_command(h, b"GET VARIABLE FOO\n",
+                           b"200 result=1 (some value)\n", "some value")
+
+    def test_get_variable_unset(self):
+        h = self.proto.get_variable("FOO")
+        self.check_command(h, b"GET VARIABLE FOO\n", b"200 result=0\n", None)
+
+    def test_get_full_variable(self):
+        h = self.proto.get_full_variable("${CALLERID(num)}")
+        self.check_command(h, b"GET FULL VARIABLE ${CALLERID(num)}\n",
+                           b"200 result=1 (202)\n", "202")
+
+    def test_stream_file(self):
+        h = self.proto.stream_file("hello-world", "#")
+        self.check_command(h, b"STREAM FILE hello-world #\n",
+                           b"200 result=35 endpos=1234\n",
+                           PlaybackResult('#', 1234))
+
+    def test_stream_file_not_interrupted(self):
+        h = self.proto.stream_file("hello-world", offset=100)
+        self.check_command(h, b'STREAM FILE hello-world "" 100\n',
+                           b"200 result=0 endpos=5678\n",
+                           PlaybackResult(None, 5678))
+
+    def test_get_data(self):
+        h = self.proto.get_data("enter-number", 5000, 4)
+        self.check_command(h, b"GET DATA enter-number 5000 4\n",
+                           b"200 result=0123\n", DataResult("0123", False))
+
+    def test_get_data_timeout(self):
+        h = self.proto.get_data("enter-number")
+        self.check_command(h, b"GET DATA enter-number\n",
+                           b"200 result=12* (timeout)\n",
+                           DataResult("12*", True))
+
+    def test_wait_for_digit(self):
+        h = self.proto.wait_for_digit(1000)
+        self.check_command(h, b"WAIT FOR DIGIT 1000\n", b"200 result=49\n",
+                           "1")
+
+    def test_wait_for_digit_timeout(self):
+        h = self.proto.wait_for_digit()
+        self.check_command(h, b"WAIT FOR DIGIT -1\n", b"200 result=0\n", None)
+
+    def test_say_digits(self):
+        h = self.proto.say_digits(1234)
+        self.check_command(h, b'SAY DIGITS 1234 ""\n', b"200 result=0\n", None)
+
+    def test_failure(self):
+        p = self.proto
+        h = p.stream_file("hello-world")
+        h.on_result = Mock()
+        h.on_exception = Mock()
+        p.line_received(b"200 result=-1 endpos=0\n")
+        self.assertEqual(h.on_result.call_count, 0)
+        h.on_exception.assert_called_once_with(ANY)
+        (exc,), _ = h.on_exception.call_args
+        self.assertIsInstance(exc, AGICommandFailure)
+
+    def test_error(self):
+        p = self.proto
+        h = p.answer()
+        h.on_result = Mock()
+        h.on_exception = Mock()
+        p.line_received(b"510 Invalid or unknown command\n")
+        (exc,), _ = h.on_exception.call_args
+        self.assertIsInstance(exc, AGIUnknownCommand)
+
+    def test_not_idle(self):
+        p = self.proto
+        p.answer()
+        with self.assertRaises(RuntimeError):
+            p.answer()
+
+    def test_invalid_args(self):
+        p = self.proto
+        with self.assertRaises(ValueError):
+            p.set_variable("FOO", "a\nb")
+        self.assertEqual(p.channel.write.call_count, 0)
+        self.assertEqual(p._state, 'idle')
+
+
+if __name__ == "__main__":
+    main()
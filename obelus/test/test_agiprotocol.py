@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import collections
 import contextlib
 import textwrap
 import unittest
@@ -8,9 +9,10 @@ from mock import Mock, ANY
 
 from obelus.agi.protocol import (
     AGIProtocol, ProtocolAGIChannel, Response,
-    AGICommandFailure, AGIUnknownCommand, AGIForbiddenCommand, AGISyntaxError)
+    AGICommandFailure, AGIUnknownCommand, AGIForbiddenCommand, AGISyntaxError,
+    AGITimeoutError)
 from obelus.common import Handler
-from . import main, watch_logging
+from . import main, watch_logging, FakeScheduler
 
 
 def literal_message(text):
@@ -68,7 +70,10 @@ AGI_ENV = {
     }
 
 
-class AGIProtocolTest(unittest.TestCase):
+class AGIProtocolTestBase(object):
+    """
+    Helpers for AGIProtocol tests.
+    """
 
     def setUp(self):
         self.channel = ProtocolAGIChannel()
@@ -105,6 +110,9 @@ class AGIProtocolTest(unittest.TestCase):
         h.on_exception = Mock()
         yield h
 
+
+class AGIProtocolTest(AGIProtocolTestBase, unittest.TestCase):
+
     def test_header_parsing(self):
         self.check_header_parsing(HEADER, AGI_ENV, [])
 
@@ -269,3 +277,230 @@ class AGIProtocolTest(unittest.TestCase):
                 Response(result=1, variables={}, data=None))
         p.channel.write.assert_called_with(b"bar quux\n")
         self.assertEqual(p._state, 'idle')
+
+    def test_send_commands(self):
+        p = self.proto_idle()
+        h = p.send_commands([("answer",), ("set", "variable", "foo", "a b")])
+        p.channel.write.assert_called_once_with(
+            b'answer\nset variable foo "a b"\n')
+        self.assertEqual(p._state, 'awaiting-response')
+        h.on_result = Mock()
+        h.on_exception = Mock()
+        p.line_received(b"200 result=0\n")
+        self.assertEqual(p._state, 'awaiting-response')
+        self.assertEqual(h.on_result.call_count, 0)
+        p.line_received(b"200 result=1\n")
+        self.assertEqual(p._state, 'idle')
+        h.on_result.assert_called_once_with(
+            [Response(result=0, variables={}, data=None),
+             Response(result=1, variables={}, data=None)])
+        self.assertEqual(h.on_exception.call_count, 0)
+
+    def test_send_commands_stop_on_error(self):
+        p = self.proto_idle()
+        h = p.send_commands([("foo",), ("bar",), ("quux",)])
+        h.on_result = Mock()
+        h.on_exception = Mock()
+        p.line_received(b"510 Invalid or unknown command\n")
+        self.assert_called_once_with_exc(h.on_exception, AGIUnknownCommand)
+        # Remaining responses are still consumed
+        p.line_received(b"200 result=1\n")
+        p.line_received(b"200 result=-1\n")
+        self.assertEqual(p._state, 'idle')
+        self.assertEqual(h.on_result.call_count, 0)
+        self.assertEqual(h.on_exception.call_count, 1)
+
+    def test_send_commands_collect_all(self):
+        p = self.proto_idle()
+        h = p.send_commands([("foo",), ("bar",)], stop_on_error=False)
+        h.on_result = Mock()
+        h.on_exception = Mock()
+        p.line_received(b"510 Invalid or unknown command\n")
+        p.line_received(b"200 result=1\n")
+        self.assertEqual(p._state, 'idle')
+        h.on_result.assert_called_once_with(
+            [ANY, Response(result=1, variables={}, data=None)])
+        (results,), _ = h.on_result.call_args
+        self.assertIsInstance(results[0], AGIUnknownCommand)
+        self.assertEqual(h.on_exception.call_count, 0)
+
+    def test_send_commands_invalid(self):
+        p = self.proto_idle()
+        with self.assertRaises(ValueError):
+            p.send_commands([])
+        with self.assertRaises(ValueError):
+            p.send_commands([("foo",), ("bar", "\0")])
+        self.assertEqual(0, p.channel.write.call_count)
+        self.assertEqual(p._state, 'idle')
+
+    def test_send_commands_not_idle(self):
+        p = self.proto_idle()
+        p.send_command(("foo",))
+        with self.assertRaises(RuntimeError):
+            p.send_commands([("bar",)])
+
+    def test_send_command_not_ready(self):
+        p = self.proto
+        p.pipelined = True
+        with self.assertRaises(RuntimeError):
+            p.send_command(("foo",))
+
+
+class PipelinedAGIProtocolTest(AGIProtocolTestBase, unittest.TestCase):
+    """
+    Tests for pipelined command sending.
+    """
+
+    def setUp(self):
+        AGIProtocolTestBase.setUp(self)
+        self.proto.pipelined = True
+
+    def test_send_command_not_idle(self):
+        p = self.proto_idle()
+        h1 = p.send_command(("foo",))
+        h2 = p.send_command(("bar", "quux"))
+        self.assertEqual(p._state, 'awaiting-response')
+        self.assertEqual(p.channel.write.call_args_list,
+                         [((b"foo\n",),), ((b"bar quux\n",),)])
+        self.assertEqual(list(p._commands), [h1, h2])
+
+    def test_pipelined_responses(self):
+        p = self.proto_idle()
+        handlers = []
+        for args in [("foo",), ("bar",), ("quux",)]:
+            h = p.send_command(args)
+            h.on_result = Mock()
+            h.on_exception = Mock()
+            handlers.append(h)
+        h1, h2, h3 = handlers
+        p.data_received(b"200 result=1\n510 Invalid or unknown command\n")
+        h1.on_result.assert_called_once_with(
+            Response(result=1, variables={}, data=None))
+        self.assert_called_once_with_exc(h2.on_exception, AGIUnknownCommand)
+        self.assertEqual(p._state, 'awaiting-response')
+        self.assertEqual(h3.on_result.call_count, 0)
+        # Commands can still be sent while awaiting a response
+        h4 = p.send_command(("last",))
+        h4.on_result = Mock()
+        p.data_received(b"200 result=3\n200 result=4\n")
+        h3.on_result.assert_called_once_with(
+            Response(result=3, variables={}, data=None))
+        h4.on_result.assert_called_once_with(
+            Response(result=4, variables={}, data=None))
+        self.assertEqual(p._state, 'idle')
+
+    def test_send_commands_not_idle(self):
+        p = self.proto_idle()
+        p.send_command(("foo",))
+        p.send_commands([("bar",), ("quux",)])
+        self.assertEqual(len(p._commands), 3)
+
+    def test_pipelined_multiline_error(self):
+        p = self.proto_idle()
+        with self.sending_command(("foo",)) as h1:
+            with self.sending_command(("bar",)) as h2:
+                p.data_received(
+                    b"520-Invalid command syntax.  Proper usage follows:\n"
+                    b"Some usage text\n"
+                    b"520 End of proper usage.\n"
+                    b"200 result=0\n")
+        self.assert_called_once_with_exc(h1.on_exception, AGISyntaxError)
+        h2.on_result.assert_called_once_with(
+            Response(result=0, variables={}, data=None))
+        self.assertEqual(p._state, 'idle')
+
+
+    def test_send_during_multiline_error(self):
+        p = self.proto_idle()
+        with self.sending_command(("foo",)) as h1:
+            with self.sending_command(("bar",)) as h2:
+                p.data_received(
+                    b"520-Invalid command syntax.  Proper usage follows:\n")
+                self.assertEqual(p._state, 'in-response')
+                with self.sending_command(("quux",)) as h3:
+                    self.assertEqual(p._state, 'in-response')
+                    p.data_received(
+                        b"Some usage text\n"
+                        b"520 End of proper usage.\n"
+                        b"200 result=0\n"
+                        b"200 result=1\n")
+        self.assert_called_once_with_exc(h1.on_exception, AGISyntaxError)
+        h2.on_result.assert_called_once_with(
+            Response(result=0, variables={}, data=None))
+        h3.on_result.assert_called_once_with(
+            Response(result=1, variables={}, data=None))
+        self.assertEqual(p._state, 'idle')
+
+
+class AGITimeoutTest(AGIProtocolTestBase, unittest.TestCase):
+    """
+    Tests for command and session timeouts.
+    """
+
+    def setUp(self):
+        AGIProtocolTestBase.setUp(self)
+        self.scheduler = FakeScheduler()
+        p = self.proto
+        p.call_later = self.scheduler.call_later
+        p.command_timeout = 5
+        p.session_timeout = 60
+        p.stats = collections.Counter()
+        p.transport = Mock()
+
+    def test_timeouts_require_call_later(self):
+        p = AGIProtocol(ProtocolAGIChannel())
+        p.session_timeout = 60
+        with self.assertRaises(ValueError):
+            p.bind_session()
+
+    def test_command_timer_cancelled(self):
+        p = self.proto_idle()
+        with self.sending_command() as h:
+            self.assertEqual(len(self.scheduler.timers), 1)
+            p.line_received(b"200 result=1\n")
+        self.assertEqual(self.scheduler.timers, [])
+        self.assertEqual(h.on_result.call_count, 1)
+        self.assertEqual(p._state, 'idle')
+
+    def test_command_timeout(self):
+        p = self.proto_idle()
+        p.pipelined = True
+        with self.sending_command() as h1:
+            with self.sending_command() as h2:
+                with watch_logging('obelus.agi', level='WARN'):
+                    self.scheduler.fire(5)
+        self.assert_called_once_with_exc(h1.on_exception, AGITimeoutError)
+        self.assert_called_once_with_exc(h2.on_exception, AGITimeoutError)
+        self.assertEqual(self.scheduler.timers, [])
+        p.transport.close.assert_called_once_with()
+        self.assertEqual(p.stats['command_timeouts'], 1)
+        self.assertEqual(p._state, 'closed')
+        # Late responses are ignored, new commands are refused
+        p.line_received(b"200 result=1\n")
+        self.assertEqual(h1.on_result.call_count, 0)
+        with self.assertRaises(RuntimeError):
+            p.send_command(("foo",))
+
+    def test_session_timeout(self):
+        p = self.proto
+        p.bind_session()
+        p = self.proto_idle()
+        with self.sending_command() as h:
+            with watch_logging('obelus.agi', level='WARN'):
+                self.scheduler.fire(60)
+        self.assert_called_once_with_exc(h.on_exception, AGITimeoutError)
+        p.transport.close.assert_called_once_with()
+        self.assertEqual(p.stats['session_timeouts'], 1)
+        self.assertEqual(p.stats['command_timeouts'], 0)
+        self.assertEqual(self.scheduler.timers, [])
+
+    def test_session_timer_cancelled(self):
+        p = self.proto
+        p.bind_session()
+        self.assertEqual(len(self.scheduler.timers), 1)
+        p.unbind_session()
+        self.assertEqual(self.scheduler.timers, [])
+
+
+if __name__ == "__main__":
+    main()
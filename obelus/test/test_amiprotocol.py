@@ -7,7 +7,7 @@ from mock import Mock, ANY
 
 from obelus.ami.protocol import (
     BaseAMIProtocol, AMIProtocol, Event, Response, EventList, ActionError)
-from obelus.common import Handler
+from obelus.common import CoroutineRunner, Handler
 from . import main
 
 
@@ -222,6 +222,27 @@ class BaseAMIProtocolTest(ProtocolTestBase, unittest.TestCase):
             with self.assertRaises(TypeError):
                 p.serialize_message({b'foo': b'bar'})
 
+    def test_event_filter(self):
+        p = self.ready_proto()
+        p.event_received = Mock()
+        channels = []
+        def predicate(channel):
+            channels.append(channel)
+            return channel.startswith('IAX2/')
+        p.set_event_filter('Hangup', 'channel', predicate)
+        self.feed(EVENT_HANGUP)
+        self.assertEqual(p.event_received.call_count, 0)
+        self.assertEqual(channels, ['SIP/0004F2060EB4-00000000'])
+        self.assertEqual(p._state, 'idle')
+        self.feed(EVENT_HANGUP.replace(b'SIP/', b'IAX2/'))
+        self.assertEqual(p.event_received.call_count, 1)
+        # Other events aren't filtered
+        self.feed(EVENT_HANGUP.replace(b'Hangup', b'Newchannel'))
+        self.assertEqual(p.event_received.call_count, 2)
+        p.set_event_filter('Hangup', 'channel', None)
+        self.feed(EVENT_HANGUP)
+        self.assertEqual(p.event_received.call_count, 3)
+
 
 class AMIProtocolTest(ProtocolTestBase, unittest.TestCase):
 
@@ -238,6 +259,24 @@ class AMIProtocolTest(ProtocolTestBase, unittest.TestCase):
                 'Uniqueid': '1283174108.0',
                 }))
 
+    def test_write_backpressure(self):
+        # send_action() always writes, senders wait on wait_writable()
+        p = self.ready_proto()
+        p.write = Mock()
+        def sender():
+            for i in range(3):
+                yield p.wait_writable()
+                p.send_action('Ping', {})
+                if i == 0:
+                    p.pause_writing()
+        runner = CoroutineRunner(sender()).start()
+        self.assertEqual(p.write.call_count, 1)
+        p.send_action('Ping', {})
+        self.assertEqual(p.write.call_count, 2)
+        p.resume_writing()
+        self.assertEqual(p.write.call_count, 4)
+        self.assertTrue(runner.done())
+
     def test_event_handler(self):
         p = self.ready_proto()
         cb_hangup, cb_foobar = Mock(), Mock()
@@ -272,6 +311,24 @@ class AMIProtocolTest(ProtocolTestBase, unittest.TestCase):
         self.assertEqual(a._action_id, '2')
         self.assertEqual(set(p._actions), {'1', '2'})
 
+    def test_send_actions(self):
+        p = self.ready_proto()
+        p.write = Mock()
+        a, b = p.send_actions([('Hello', OrderedDict({'foo': 'bar'})),
+                               ('Hi', OrderedDict({'ActionID': 'X'}))])
+        # All actions are written at once
+        p.write.assert_called_once_with(
+            b"foo: bar\r\n"
+            b"Action: Hello\r\n"
+            b"ActionID: 1\r\n"
+            b"\r\n"
+            b"ActionID: X\r\n"
+            b"Action: Hi\r\n"
+            b"\r\n")
+        self.assertEqual(a._action_id, '1')
+        self.assertEqual(b._action_id, 'X')
+        self.assertEqual(p._actions, {'1': a, 'X': b})
+
     def test_send_action_variables(self):
         p = self.ready_proto()
         p.write = Mock()
@@ -6,14 +6,15 @@ import unittest
 
 from mock import Mock, ANY
 
-from obelus.agi.asyncagi import AsyncAGIExecutor
+from obelus.agi.asyncagi import AsyncAGIExecutor, ShardedAsyncAGIExecutor
 from obelus.agi.protocol import (
     AGIProtocol, Response,
-    AGICommandFailure, AGIUnknownCommand, AGIForbiddenCommand, AGISyntaxError)
+    AGICommandFailure, AGIUnknownCommand, AGIForbiddenCommand, AGISyntaxError,
+    AGITimeoutError, AGIChannelGone)
 from obelus.agi.session import AGISession
 from obelus.ami.protocol import AMIProtocol, ActionError
 from obelus.common import Handler
-from . import main, watch_logging
+from . import main, watch_logging, FakeScheduler
 
 
 def literal_ami(text):
@@ -325,6 +326,50 @@ class CommandSendingTest(TestHelpers, unittest.TestCase):
         self.assertEqual(p._state, 'idle')
         self.assertEqual(list(p.channel._commands), [])
 
+    def test_command_result_fast_path(self):
+        p, h = self.queued_command(["noop"])
+        # Single-line successful results don't go through line_received()
+        p.line_received = Mock()
+        self.feed_ami(ASYNC_AGI_EXEC_1)
+        h.on_result.assert_called_once_with(ASYNC_AGI_RESP_1)
+        self.assertEqual(p.line_received.call_count, 0)
+        self.assertEqual(p._state, 'idle')
+
+    def test_command_result_fast_path_non_ascii(self):
+        p, h = self.queued_command(["noop"])
+        self.feed_ami(ASYNC_AGI_EXEC_1.replace(b"foobar", b"foob%C3%A9r"))
+        h.on_result.assert_called_once_with(
+            Response(result=0, variables={'endpos': '1234'}, data='foobér'))
+
+    def test_command_result_multiline(self):
+        # Results with several lines go through line_received()
+        p, h = self.queued_command(["noop"])
+        p.line_received = Mock(wraps=p.line_received)
+        self.feed_ami(ASYNC_AGI_EXEC_1.replace(b"endpos%3D1234%0A",
+                                               b"endpos%3D1234%0A%0A"))
+        h.on_result.assert_called_once_with(ASYNC_AGI_RESP_1)
+        self.assertEqual(p.line_received.call_count, 2)
+        self.assertEqual(p._state, 'idle')
+
+    def test_command_result_negative(self):
+        p, h = self.queued_command(["noop"])
+        self.feed_ami(ASYNC_AGI_EXEC_1.replace(b"result%3D0", b"result%3D-1"))
+        self.assertEqual(h.on_result.call_count, 0)
+        exc = self.assert_called_once_with_exc(h.on_exception,
+                                               AGICommandFailure)
+        self.assertIsInstance(exc, AGICommandFailure)
+        self.assertEqual(p._state, 'idle')
+
+    def test_command_sent_from_callback(self):
+        p = self.proto
+        sent = []
+        h = p.send_command(["noop"])
+        h.on_result = lambda resp: sent.append(p.send_command(["answer"]))
+        self.feed_ami(AGI_ACTION_SUCCESS)
+        self.feed_ami(ASYNC_AGI_EXEC_1)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(p._state, 'awaiting-response')
+
     def test_command_queued_failed_1(self):
         p, h = self.queued_command(["noop"])
         self.feed_ami(ASYNC_AGI_EXEC_2)
@@ -371,3 +416,458 @@ class CommandSendingTest(TestHelpers, unittest.TestCase):
         self.assertEqual(h.on_exception.call_count, 0)
         self.assertEqual(list(p.channel._commands), ['SOME-COMMAND-ID'])
 
+
+class CommandTimeoutTest(TestHelpers, unittest.TestCase):
+
+    def make_executor(self):
+        self.scheduler = FakeScheduler()
+        self.agi_protocol_factory.command_timeout = 5
+        return AsyncAGIExecutor(self.agi_protocol_factory,
+                                call_later=self.scheduler.call_later)
+
+    def setUp(self):
+        TestHelpers.setUp(self)
+        self.bound_executor()
+        self.feed_ami(ASYNC_AGI_START)
+        self.proto = self.assert_one_proto()
+        self.ami.write = Mock()
+        self.executor._new_command_id = Mock(return_value='SOME-COMMAND-ID')
+
+    def test_timer_cancelled(self):
+        p = self.proto
+        h = p.send_command(["noop"])
+        h.on_result = Mock()
+        self.feed_ami(AGI_ACTION_SUCCESS)
+        self.feed_ami(ASYNC_AGI_EXEC_1)
+        h.on_result.assert_called_once_with(ASYNC_AGI_RESP_1)
+        self.assertEqual(self.scheduler.timers, [])
+
+    def test_command_timeout(self):
+        p = self.proto
+        h = p.send_command(["noop"])
+        h.on_result = Mock()
+        h.on_exception = Mock()
+        self.feed_ami(AGI_ACTION_SUCCESS)
+        self.ami.write.reset_mock()
+        with watch_logging('obelus.agi', level='WARN'):
+            self.scheduler.fire(5)
+        self.assert_called_once_with_exc(h.on_exception, AGITimeoutError)
+        self.assertEqual(list(p.channel._commands), [])
+        self.assertEqual(self.executor.stats['command_timeouts'], 1)
+        # The Async AGI session is broken out of
+        (data,), _ = self.ami.write.call_args
+        lines = data.splitlines()
+        self.assertIn(b"Action: AGI", lines)
+        self.assertIn(b"Command: ASYNCAGI BREAK", lines)
+        self.assertIn(b"Channel: Local/678@default-00000012;2", lines)
+        # A late result is ignored
+        with watch_logging('obelus.agi', level='WARN'):
+            self.feed_ami(ASYNC_AGI_EXEC_1)
+        self.assertEqual(h.on_result.call_count, 0)
+
+    def test_timeout_before_action_response(self):
+        p = self.proto
+        h = p.send_command(["noop"])
+        h.on_exception = Mock()
+        with watch_logging('obelus.agi', level='WARN'):
+            self.scheduler.fire(5)
+        self.assert_called_once_with_exc(h.on_exception, AGITimeoutError)
+        self.feed_ami(AGI_ACTION_SUCCESS)
+        self.assertEqual(list(p.channel._commands), [])
+
+
+def exec_event(command_id, result):
+    return literal_ami("""\
+        Event: AsyncAGI
+        Privilege: agi,all
+        SubEvent: Exec
+        Channel: Local/678@default-00000012;2
+        CommandID: %s
+        Result: %s
+        """ % (command_id, result))
+
+
+def action_success(action_id):
+    return AGI_ACTION_SUCCESS.replace(b"ActionID: 1",
+                                      b"ActionID: " + action_id.encode())
+
+
+class ChannelTestHelpers(TestHelpers):
+    """
+    Helpers for tests running on a single started Async AGI channel.
+    """
+
+    def make_executor(self):
+        return AsyncAGIExecutor(self.agi_protocol_factory, pipelined=True)
+
+    def setUp(self):
+        TestHelpers.setUp(self)
+        self.bound_executor()
+        self.feed_ami(ASYNC_AGI_START)
+        self.proto = self.assert_one_proto()
+        self.ami.write = Mock()
+        ids = iter(['CMD-%d' % i for i in range(1, 10)])
+        self.executor._new_command_id = lambda: next(ids)
+
+    def send(self, args):
+        h = self.proto.send_command(args)
+        h.on_result = Mock()
+        h.on_exception = Mock()
+        return h
+
+
+class PipelinedTest(ChannelTestHelpers, unittest.TestCase):
+
+    def test_pipelined_commands(self):
+        p = self.proto
+        h1 = self.send(["noop"])
+        h2 = self.send(["answer"])
+        self.assertEqual(self.ami.write.call_count, 2)
+        self.feed_ami(action_success('1'))
+        self.feed_ami(action_success('2'))
+        self.assertEqual(sorted(p.channel._commands), ['CMD-1', 'CMD-2'])
+        # Results are matched by command id, whatever their order
+        self.feed_ami(exec_event('CMD-2', '200%20result%3D2%0A'))
+        h2.on_result.assert_called_once_with(Response(2, {}, None))
+        self.assertEqual(h1.on_result.call_count, 0)
+        self.assertEqual(p._state, 'awaiting-response')
+        self.feed_ami(exec_event('CMD-1', '200%20result%3D1%0A'))
+        h1.on_result.assert_called_once_with(Response(1, {}, None))
+        self.assertEqual(p._state, 'idle')
+
+    def test_send_commands_single_write(self):
+        p = self.proto
+        h = p.send_commands([("noop",), ("answer",), ("hangup",)])
+        h.on_result = Mock()
+        self.ami.write.assert_called_once_with(ANY)
+        (data,), _ = self.ami.write.call_args
+        self.assertEqual(data.count(b"Action: AGI"), 3)
+        for i in range(1, 4):
+            self.feed_ami(action_success(str(i)))
+        for i in range(1, 4):
+            self.feed_ami(exec_event('CMD-%d' % i, '200%%20result%%3D%d%%0A' % i))
+        h.on_result.assert_called_once_with(
+            [Response(i, {}, None) for i in range(1, 4)])
+        self.assertEqual(p._state, 'idle')
+
+    def test_action_failure_state(self):
+        p = self.proto
+        h1 = self.send(["noop"])
+        self.feed_ami(AGI_ACTION_ERROR)
+        self.assertEqual(h1.on_exception.call_count, 1)
+        self.assertEqual(p._state, 'idle')
+
+
+class NonPipelinedTest(ChannelTestHelpers, unittest.TestCase):
+
+    def make_executor(self):
+        return AsyncAGIExecutor(self.agi_protocol_factory)
+
+    def test_pipelined_commands(self):
+        self.send(["noop"])
+        with self.assertRaises(RuntimeError):
+            self.send(["answer"])
+
+
+class ChannelEndTest(ChannelTestHelpers, unittest.TestCase):
+
+    def test_pending_commands_failed(self):
+        e = self.executor
+        p = self.proto
+        channel = p.channel
+        session = self.session
+        # One acknowledged command, one not acknowledged
+        h1 = self.send(["noop"])
+        h2 = self.send(["answer"])
+        self.feed_ami(action_success('1'))
+        self.assertEqual(e.gauges(), {'active_channels': 1,
+                                      'pending_commands': 2})
+        self.ami.write.reset_mock()
+        with watch_logging('obelus.agi', level='WARN') as w:
+            self.feed_ami(ASYNC_AGI_END)
+        self.assertEqual(len(w.output), 1)
+        exc = self.assert_called_once_with_exc(h1.on_exception,
+                                               AGIChannelGone)
+        self.assertIsInstance(exc, AGIChannelGone)
+        exc = self.assert_called_once_with_exc(h2.on_exception,
+                                               AGIChannelGone)
+        self.assertIsInstance(exc, AGIChannelGone)
+        session.session_finished.assert_called_once_with()
+        self.assertEqual(p._state, 'closed')
+        self.assertEqual(channel._commands, {})
+        self.assertEqual(channel._unacked, {})
+        self.assertFalse(hasattr(channel, 'proto'))
+        # No ASYNCAGI BREAK is sent for an ended channel
+        self.assertEqual(self.ami.write.call_count, 0)
+        self.assertEqual(e.stats['ended_channels'], 1)
+        self.assertEqual(e.stats['orphaned_commands'], 2)
+        self.assertEqual(e.gauges(), {'active_channels': 0,
+                                      'pending_commands': 0})
+        # A late action response is ignored
+        self.feed_ami(action_success('2'))
+        self.assertEqual(h2.on_exception.call_count, 1)
+        self.assertEqual(h2.on_result.call_count, 0)
+
+    def test_no_pending_commands(self):
+        e = self.executor
+        h = self.send(["noop"])
+        self.feed_ami(action_success('1'))
+        self.feed_ami(exec_event('CMD-1', '200%20result%3D1%0A'))
+        with watch_logging('obelus.agi', level='WARN') as w:
+            self.feed_ami(ASYNC_AGI_END)
+        self.assertEqual(w.output, [])
+        self.assertEqual(h.on_exception.call_count, 0)
+        self.assertEqual(e.stats['ended_channels'], 1)
+        self.assertEqual(e.stats['orphaned_commands'], 0)
+
+    def test_send_after_end(self):
+        p = self.proto
+        self.feed_ami(ASYNC_AGI_END)
+        with self.assertRaises(RuntimeError):
+            p.send_command(["noop"])
+
+
+class ShardedTest(TestHelpers, unittest.TestCase):
+
+    channel_id = "Local/678@default-00000012;2"
+
+    def make_executor(self):
+        return ShardedAsyncAGIExecutor(self.agi_protocol_factory, 3)
+
+    def setUp(self):
+        TestHelpers.setUp(self)
+        e = self.executor
+        self.amis = [AMIProtocol() for i in range(3)]
+        for ami in self.amis:
+            ami.line_received(AMI_GREETING_LINE)
+            ami.write = Mock()
+            e.bind(ami)
+        self.sync()
+        for ami in self.amis:
+            # Forget the synchronization actions
+            ami.write.reset_mock()
+            ami._actions.clear()
+            ami._action_id = 1
+        e._new_command_id = Mock(return_value='SOME-COMMAND-ID')
+        self.owner = e._shard_for(self.channel_id)
+        self.others = [ami for ami in self.amis if ami is not self.owner]
+
+    def feed_all(self, message, amis=None):
+        for ami in amis or self.amis:
+            for line in message.splitlines(True):
+                ami.line_received(line)
+
+    def sync_event(self):
+        e = self.executor
+        return literal_ami("""\
+            Event: UserEvent
+            Privilege: user,all
+            UserEvent: %s
+            Executor: %s
+            Epoch: %d
+            """ % (e.sync_event_name, e._command_id_stem, e._epoch))
+
+    def sync(self, amis=None):
+        # Deliver the latest synchronization event on all connections
+        self.feed_all(self.sync_event(), amis)
+
+    def test_bind(self):
+        e = self.executor
+        self.assertTrue(e.is_bound())
+        with self.assertRaises(ValueError):
+            e.bind(self.amis[0])
+        e.unbind()
+        self.assertFalse(e.is_bound())
+        with self.assertRaises(ValueError):
+            e.unbind()
+
+    def test_bind_too_many(self):
+        e = self.executor
+        ami = AMIProtocol()
+        ami.line_received(AMI_GREETING_LINE)
+        ami.write = Mock()
+        with self.assertRaises(ValueError):
+            e.bind(ami)
+        e.unbind(self.amis[1])
+        e.bind(ami)
+        self.assertEqual(e._slots, [self.amis[0], ami, self.amis[2]])
+        with self.assertRaises(ValueError):
+            ShardedAsyncAGIExecutor(self.agi_protocol_factory, 0)
+
+    def test_shard_for(self):
+        e = self.executor
+        owners = set(e._shard_for("SIP/peer-%08x" % i) for i in range(100))
+        self.assertEqual(owners, set(self.amis))
+        self.assertIs(e._shard_for(self.channel_id), self.owner)
+
+    def test_shard_for_stable(self):
+        # Binding or unbinding a connection doesn't change the shards of
+        # channels hashed to other slots
+        e = self.executor
+        channel_ids = ["SIP/peer-%08x" % i for i in range(100)]
+        before = [e._shard_for(c) for c in channel_ids]
+        e.unbind(self.amis[2])
+        after = [e._shard_for(c) for c in channel_ids]
+        for old, new in zip(before, after):
+            if old is not self.amis[2]:
+                self.assertIs(new, old)
+            else:
+                self.assertIs(new, self.amis[0])
+        e.bind(self.amis[2])
+        self.assertEqual([e._shard_for(c) for c in channel_ids], before)
+
+    def test_channel_pinned(self):
+        e = self.executor
+        self.feed_all(ASYNC_AGI_START)
+        p = self.assert_one_proto(self.channel_id)
+        self.assertEqual(sorted(e.shard_sizes()), [0, 0, 1])
+        h = p.send_command(["noop"])
+        h.on_result = Mock()
+        self.assertEqual(self.owner.write.call_count, 1)
+        for ami in self.others:
+            self.assertEqual(ami.write.call_count, 0)
+        self.feed_all(AGI_ACTION_SUCCESS, [self.owner])
+        self.assertEqual(list(p.channel._commands), ['SOME-COMMAND-ID'])
+        # Copies of the event on other connections are ignored
+        self.feed_all(ASYNC_AGI_EXEC_1, self.others)
+        self.assertEqual(h.on_result.call_count, 0)
+        self.feed_all(ASYNC_AGI_EXEC_1)
+        h.on_result.assert_called_once_with(ASYNC_AGI_RESP_1)
+        session = self.session
+        self.feed_all(ASYNC_AGI_END)
+        self.assertEqual(len(e._channels), 0)
+        session.session_finished.assert_called_once_with()
+
+    def test_unbind_repins(self):
+        e = self.executor
+        self.feed_all(ASYNC_AGI_START)
+        p = self.assert_one_proto(self.channel_id)
+        e.unbind(self.owner)
+        self.assertEqual(len(e.amis), 2)
+        new_owner = p.channel._ami
+        self.assertIn(new_owner, self.others)
+        p.send_command(["noop"])
+        self.assertIn(b"Action: AGI", new_owner.write.call_args[0][0])
+        self.sync()
+        self.assertNotIn(self.owner, e._ami_epochs)
+        # The new owner handles the channel's events
+        with watch_logging('obelus.agi', level='WARN'):
+            self.feed_all(ASYNC_AGI_END)
+        self.assertEqual(len(e._channels), 0)
+
+    def test_events_filtered(self):
+        # Other connections skip events before parsing them
+        e = self.executor
+        e._shard_event_received = Mock()
+        self.feed_all(ASYNC_AGI_START)
+        e._shard_event_received.assert_called_once_with(self.owner, ANY)
+
+    def test_bind_handover(self):
+        e = self.executor = ShardedAsyncAGIExecutor(
+            self.agi_protocol_factory, 2)
+        old, new = AMIProtocol(), AMIProtocol()
+        for ami in old, new:
+            ami.line_received(AMI_GREETING_LINE)
+            ami.write = Mock()
+        e.bind(old)
+        e._new_command_id = Mock(return_value='SOME-COMMAND-ID')
+        self.feed_all(ASYNC_AGI_START, [old])
+        p = self.assert_one_proto(self.channel_id)
+        # The channel is hashed to the second slot
+        e.bind(new)
+        self.assertIs(e._shard_for(self.channel_id), new)
+        self.assertIs(p.channel._ami, old)
+        new.write.assert_called_once_with(ANY)
+        self.assertIn(b"UserEvent: ObelusShardSync", new.write.call_args[0][0])
+        h = p.send_command(["noop"])
+        h.on_result = Mock()
+        self.feed_all(AGI_ACTION_SUCCESS, [old])
+        # Both connections get the result, then the synchronization
+        # event, then the channel's end.  The new connection runs ahead:
+        # it must hold the end until the old one handled the result.
+        session = self.session
+        events = ASYNC_AGI_EXEC_1 + self.sync_event() + ASYNC_AGI_END
+        with watch_logging('obelus.agi', level='WARN') as w:
+            self.feed_all(events, [new])
+            self.assertEqual(h.on_result.call_count, 0)
+            self.assertEqual(len(e._held), 1)
+            self.feed_all(ASYNC_AGI_EXEC_1, [old])
+            h.on_result.assert_called_once_with(ASYNC_AGI_RESP_1)
+            self.assertEqual(len(e._channels), 1)
+            self.feed_all(self.sync_event(), [old])
+            self.assertEqual(len(e._channels), 0)
+            session.session_finished.assert_called_once_with()
+            # The old connection's copy is ignored
+            self.feed_all(ASYNC_AGI_END, [old])
+        self.assertEqual(w.output, [])
+        self.assertEqual(e._held, [])
+        self.assertEqual(list(e._assignments), [e._epoch])
+
+    def test_bind_handover_held(self):
+        # Events received by the new connection are held until the old
+        # one switches, to keep them in order
+        e = self.executor = ShardedAsyncAGIExecutor(
+            self.agi_protocol_factory, 2)
+        old, new = AMIProtocol(), AMIProtocol()
+        for ami in old, new:
+            ami.line_received(AMI_GREETING_LINE)
+            ami.write = Mock()
+        e.bind(old)
+        e.bind(new)
+        self.feed_all(self.sync_event() + ASYNC_AGI_START + ASYNC_AGI_END,
+                      [new])
+        self.assertEqual(len(e._held), 2)
+        self.assertIsNone(self.session)
+        self.feed_all(self.sync_event(), [old])
+        self.assertEqual(e._held, [])
+        self.session.session_established.assert_called_once_with()
+        self.session.session_finished.assert_called_once_with()
+        self.assertEqual(len(e._channels), 0)
+
+    def test_unbind_lost(self):
+        e = self.executor
+        self.feed_all(ASYNC_AGI_START)
+        p = self.assert_one_proto(self.channel_id)
+        e.unbind(self.owner, lost=True)
+        self.assertNotIn(self.owner, e._ami_epochs)
+        self.assertIn(p.channel._ami, self.others)
+        # Taken over right away, without synchronization
+        self.feed_all(ASYNC_AGI_END, self.others)
+        self.assertEqual(len(e._channels), 0)
+
+    def test_sync_failure(self):
+        e = self.executor = ShardedAsyncAGIExecutor(
+            self.agi_protocol_factory, 2)
+        old, new = AMIProtocol(), AMIProtocol()
+        for ami in old, new:
+            ami.line_received(AMI_GREETING_LINE)
+            ami.write = Mock()
+        e.bind(old)
+        with watch_logging('obelus.agi', level='ERROR') as w:
+            e.bind(new)
+            self.feed_all(AGI_ACTION_ERROR, [new])
+        self.assertEqual(len(w.output), 1)
+        self.assertEqual(e._ami_epochs, {old: e._epoch, new: e._epoch})
+        self.feed_all(ASYNC_AGI_START, [old, new])
+        self.assertIs(self.session.proto.channel._ami, new)
+
+    def test_user_events(self):
+        # Other user events go to the previous handler, restored when
+        # unbinding
+        e = self.executor = ShardedAsyncAGIExecutor(
+            self.agi_protocol_factory, 2)
+        ami = AMIProtocol()
+        ami.line_received(AMI_GREETING_LINE)
+        ami.write = Mock()
+        handler = Mock()
+        ami.register_event_handler('UserEvent', handler)
+        e.bind(ami)
+        other_event = literal_ami("""\
+            Event: UserEvent
+            UserEvent: Foo
+            """)
+        self.feed_all(other_event + self.sync_event(), [ami])
+        handler.assert_called_once_with(ANY)
+        e.unbind()
+        self.assertIs(ami._event_handlers['UserEvent'], handler)
+        self.assertNotIn('AsyncAGI', ami._event_handlers)
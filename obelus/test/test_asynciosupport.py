@@ -0,0 +1,135 @@
+"""
+Tests for the asyncio adapter.
+"""
+
+import socket
+import sys
+import unittest
+
+from mock import Mock
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+else:
+    from obelus.asynciosupport import AsyncioAdapter
+
+from obelus.agi.protocol import AGIProtocol, ProtocolAGIChannel
+from obelus.common import FlowControlMixin
+from . import main
+
+
+class FlowControlTest(unittest.TestCase):
+
+    def test_wait_writable(self):
+        p = FlowControlMixin()
+        self.assertFalse(p.writing_paused)
+        h = p.wait_writable()
+        h.on_result = Mock()
+        h.on_result.assert_called_once_with(None)
+        p.pause_writing()
+        self.assertTrue(p.writing_paused)
+        h1 = p.wait_writable()
+        h2 = p.wait_writable()
+        h1.on_result = Mock()
+        self.assertFalse(h1._triggered)
+        p.resume_writing()
+        self.assertFalse(p.writing_paused)
+        h1.on_result.assert_called_once_with(None)
+        self.assertTrue(h2._triggered)
+        # Resuming again is harmless
+        p.resume_writing()
+
+
+@unittest.skipIf(asyncio is None, "asyncio is not available")
+class AsyncioAdapterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.proto = Mock()
+        self.transport = Mock()
+        self.adapter = AsyncioAdapter(self.proto)
+        self.adapter.connection_made(self.transport)
+
+    def test_connection(self):
+        a = self.adapter
+        self.proto.connection_made.assert_called_once_with(a)
+        a.write(b"foo")
+        self.transport.write.assert_called_once_with(b"foo")
+        a.close()
+        self.transport.close.assert_called_once_with()
+        exc = socket.error()
+        a.connection_lost(exc)
+        self.proto.connection_lost.assert_called_once_with(exc)
+        with self.assertRaises(ValueError):
+            a.write(b"bar")
+
+    def test_data_received(self):
+        data = b"hello"
+        self.adapter.data_received(data)
+        # The data is passed as is, without copying
+        (arg,), _ = self.proto.data_received.call_args
+        self.assertIs(arg, data)
+
+    def test_flow_control(self):
+        a = self.adapter
+        a.pause_writing()
+        self.proto.pause_writing.assert_called_once_with()
+        a.resume_writing()
+        self.proto.resume_writing.assert_called_once_with()
+
+    def test_connection_lost_while_paused(self):
+        proto = FlowControlMixin()
+        proto.connection_made = Mock()
+        proto.connection_lost = Mock()
+        a = AsyncioAdapter(proto)
+        a.connection_made(self.transport)
+        a.pause_writing()
+        h = proto.wait_writable()
+        a.connection_lost(None)
+        self.assertTrue(h._triggered)
+        proto.connection_lost.assert_called_once_with(None)
+
+
+@unittest.skipIf(sys.version_info < (3, 7),
+                 "awaiting Handlers from asyncio requires Python 3.7")
+class AsyncioIntegrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_agi_over_socket(self):
+        loop = self.loop
+        rsock, wsock = socket.socketpair()
+        self.addCleanup(wsock.close)
+        proto = AGIProtocol(ProtocolAGIChannel())
+        proto.bind_session = Mock()
+        wsock.settimeout(5)
+
+        def run_until(predicate):
+            for i in range(500):
+                if predicate():
+                    return
+                loop.run_until_complete(asyncio.sleep(0.01))
+            self.fail("timed out")
+
+        transport, adapter = loop.run_until_complete(
+            loop.connect_accepted_socket(lambda: AsyncioAdapter(proto),
+                                         rsock))
+        wsock.sendall(b"agi_channel: SIP/foo\n\n")
+        run_until(lambda: proto._state == 'idle')
+        self.assertEqual(proto.env, {'channel': 'SIP/foo'})
+        h = proto.send_command(("answer",))
+        h.on_result = Mock()
+        self.assertEqual(wsock.recv(100), b"answer\n")
+        wsock.sendall(b"200 result=0\n")
+        run_until(lambda: h.on_result.called)
+        (resp,), _ = h.on_result.call_args
+        self.assertEqual(resp.result, 0)
+        transport.close()
+        loop.run_until_complete(asyncio.sleep(0))
+
+
+if __name__ == "__main__":
+    main()
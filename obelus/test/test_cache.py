@@ -0,0 +1,182 @@
+
+import unittest
+
+from mock import Mock
+
+from obelus.cache import LookupCache
+from obelus.common import CoroutineRunner, Handler
+from . import main, watch_logging, FakeClock
+
+
+class LookupCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        # key => list of pending loader Handlers
+        self.loads = {}
+
+    def loader(self, key):
+        h = Handler()
+        self.loads.setdefault(key, []).append(h)
+        return h
+
+    def make_cache(self, **kwargs):
+        return LookupCache(self.loader, clock=self.clock, **kwargs)
+
+    def get(self, cache, key):
+        h = cache.get(key)
+        if not h._triggered:
+            h.on_result = Mock()
+            h.on_exception = Mock()
+        return h
+
+    def test_miss_then_hit(self):
+        c = self.make_cache()
+        h = self.get(c, 'a')
+        self.assertEqual(len(self.loads['a']), 1)
+        self.loads['a'][0].set_result(1)
+        h.on_result.assert_called_once_with(1)
+        self.assertEqual(c.get_cached('a'), 1)
+        h = c.get('a')
+        self.assertTrue(h._triggered)
+        self.assertEqual(h._outcome, 1)
+        self.assertEqual(len(self.loads['a']), 1)
+        self.assertEqual(c.stats['misses'], 1)
+        self.assertEqual(c.stats['hits'], 2)
+
+    def test_single_flight(self):
+        c = self.make_cache()
+        handlers = [self.get(c, 'a') for i in range(3)]
+        self.assertEqual(len(self.loads['a']), 1)
+        self.assertEqual(c.stats['coalesced'], 2)
+        self.loads['a'][0].set_result('x')
+        for h in handlers:
+            h.on_result.assert_called_once_with('x')
+
+    def test_ttl(self):
+        c = self.make_cache(ttl=10)
+        self.get(c, 'a')
+        self.loads['a'][0].set_result(1)
+        self.clock.now = 9.9
+        self.assertEqual(c.get_cached('a'), 1)
+        self.clock.now = 10
+        self.assertIsNone(c.get_cached('a'))
+        self.assertEqual(c.stats['expirations'], 1)
+        self.assertEqual(len(c), 0)
+
+    def test_negative_caching(self):
+        c = self.make_cache(ttl=10, negative_ttl=2)
+        h = self.get(c, 'a')
+        self.loads['a'][0].set_result(None)
+        h.on_result.assert_called_once_with(None)
+        h = c.get('a')
+        self.assertTrue(h._triggered)
+        self.assertEqual(c.stats['negative_hits'], 1)
+        self.clock.now = 2
+        self.get(c, 'a')
+        self.assertEqual(len(self.loads['a']), 2)
+
+    def test_lru_eviction(self):
+        c = self.make_cache(max_size=2)
+        for key in 'abc':
+            self.get(c, key)
+        self.loads['a'][0].set_result(1)
+        self.loads['b'][0].set_result(2)
+        # Touch 'a' so that 'b' is the least recently used
+        c.get('a')
+        self.loads['c'][0].set_result(3)
+        self.assertEqual(c.get_cached('a'), 1)
+        self.assertIsNone(c.get_cached('b'))
+        self.assertEqual(c.get_cached('c'), 3)
+        self.assertEqual(c.stats['evictions'], 1)
+
+    def test_load_failure(self):
+        c = self.make_cache()
+        h1 = self.get(c, 'a')
+        h2 = self.get(c, 'a')
+        with watch_logging('obelus.cache', level='WARN'):
+            self.loads['a'][0].set_exception(ZeroDivisionError())
+        for h in (h1, h2):
+            (exc,), _ = h.on_exception.call_args
+            self.assertIsInstance(exc, ZeroDivisionError)
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.stats['errors'], 1)
+        # Next lookup retries
+        self.get(c, 'a')
+        self.assertEqual(len(self.loads['a']), 2)
+
+    def test_synchronous_loader(self):
+        def loader(key):
+            h = Handler()
+            h.set_result(key * 2)
+            return h
+        c = LookupCache(loader, clock=self.clock)
+        h = c.get('a')
+        self.assertEqual(h._outcome, 'aa')
+        self.assertEqual(c.get_cached('a'), 'aa')
+
+    def test_hit_callbacks(self):
+        c = self.make_cache()
+        self.get(c, 'a')
+        self.loads['a'][0].set_result(1)
+        h = c.get('a')
+        # Callbacks can be set on a hit like on a miss
+        h.on_exception = Mock()
+        h.on_result = Mock()
+        h.on_result.assert_called_once_with(1)
+        self.assertEqual(h.on_exception.call_count, 0)
+        with self.assertRaises(ValueError):
+            h.on_result = Mock()
+
+    def test_synchronous_loader_failure(self):
+        def loader(key):
+            h = Handler()
+            h.on_exception = lambda exc: None
+            h.set_exception(KeyError(key))
+            return h
+        c = LookupCache(loader, clock=self.clock)
+        with watch_logging('obelus.cache', level='WARN'):
+            h = c.get('a')
+        h.on_result = Mock()
+        h.on_exception = Mock()
+        self.assertEqual(h.on_result.call_count, 0)
+        (exc,), _ = h.on_exception.call_args
+        self.assertIsInstance(exc, KeyError)
+        self.assertEqual(c._loading, {})
+
+    def test_loader_exception_in_coroutine(self):
+        def loader(key):
+            raise KeyError(key)
+        c = LookupCache(loader, clock=self.clock)
+        caught = []
+        def coro():
+            try:
+                yield c.get('a')
+            except KeyError as e:
+                caught.append(e)
+        with watch_logging('obelus.cache', level='WARN'):
+            runner = CoroutineRunner(coro()).start()
+        self.assertTrue(runner.done())
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(c.stats['errors'], 1)
+
+    def test_invalidate(self):
+        c = self.make_cache()
+        self.get(c, 'a')
+        self.loads['a'][0].set_result(1)
+        c.invalidate('a')
+        self.assertIsNone(c.get_cached('a'))
+        c.invalidate('b')
+
+    def test_blocking(self):
+        pool = Mock()
+        pool.run.return_value = Handler()
+        func = Mock()
+        c = LookupCache.blocking(pool, func, ttl=5)
+        self.assertEqual(c.ttl, 5)
+        h = c.get('a')
+        pool.run.assert_called_once_with(func, 'a')
+
+
+if __name__ == "__main__":
+    main()
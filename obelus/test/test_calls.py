@@ -5,11 +5,14 @@ import unittest
 
 from mock import Mock, ANY
 
-from obelus.ami.calls import Call, CallManager, OriginateError
+from obelus.ami.calls import Call, CallManager, CallMetrics, OriginateError
 from obelus.ami.protocol import (
     BaseAMIProtocol, AMIProtocol, Event, Response, EventList, ActionError)
-from . import main, watch_logging
+from obelus.ami.history import EventHistory
+from obelus.executors import OrderedCallbackExecutor
+from . import main, watch_logging, FakeClock, FakeScheduler
 from .test_amiprotocol import ProtocolTestBase
+from .test_executors import Future, ManualExecutor, ImmediateExecutor
 
 
 class MockCall(Call):
@@ -170,7 +173,10 @@ HANGUP_INCOMING = Event('Hangup',
                          'Cause-txt': 'Unknown'})
 
 
-class CallManagerTest(ProtocolTestBase, unittest.TestCase):
+class CallManagerTestBase(ProtocolTestBase):
+    """
+    Helpers for CallManager tests.
+    """
 
     protocol_factory = AMIProtocol
 
@@ -205,6 +211,21 @@ class CallManagerTest(ProtocolTestBase, unittest.TestCase):
         cm.ami.event_received(event)
         return cm, call
 
+    def incoming_call(self, cm, newchannel, newstate):
+        def factory(*args):
+            factory.result = MockCall()
+            return factory.result
+        factory = Mock(side_effect=factory)
+        cm.listen_for_incoming_calls(factory)
+        cm.ami.event_received(newchannel)
+        self.assertEqual(factory.call_count, 0)
+        cm.ami.event_received(newstate)
+        factory.assert_called_once_with(newchannel.headers)
+        return factory.result
+
+
+class CallManagerTest(CallManagerTestBase, unittest.TestCase):
+
     def test_init(self):
         ami = self.protocol_factory()
         cm = CallManager(ami)
@@ -459,18 +480,6 @@ class CallManagerTest(ProtocolTestBase, unittest.TestCase):
     # Tracking of incoming calls
     #
 
-    def incoming_call(self, cm, newchannel, newstate):
-        def factory(*args):
-            factory.result = MockCall()
-            return factory.result
-        factory = Mock(side_effect=factory)
-        cm.listen_for_incoming_calls(factory)
-        cm.ami.event_received(newchannel)
-        self.assertEqual(factory.call_count, 0)
-        cm.ami.event_received(newstate)
-        factory.assert_called_once_with(newchannel.headers)
-        return factory.result
-
     def test_incoming_local_call(self):
         # Local calls are not considered
         cm = self.call_manager()
@@ -523,6 +532,333 @@ class CallManagerTest(ProtocolTestBase, unittest.TestCase):
         with self.assertRaises(TypeError):
             cm.listen_for_incoming_calls(object())
 
+    def test_event_history_disabled(self):
+        cm, call = self.tracked_call()
+        self.assertEqual(call.event_history(), [])
+        self.assertRaises(ValueError, self.call().event_history)
+
+    def test_event_history(self):
+        cm = self.call_manager()
+        cm.event_history = EventHistory()
+        call = self.incoming_call(cm, NEWCHANNEL_INCOMING, NEWSTATE_INCOMING)
+        cm.ami.event_received(SOFT_HANGUP_INCOMING_1)
+        cm.ami.event_received(HANGUP_INCOMING)
+        # The history survives the call's end
+        self.assertEqual([rec.name for rec in call.event_history()],
+                         ['Newchannel', 'Newstate', 'SoftHangupRequest',
+                          'Hangup'])
+        rec = call.event_history()[-1]
+        self.assertEqual(dict(rec.headers),
+                         {'Uniqueid': UNIQUE_ID_INCOMING,
+                          'Channel': CHANNEL_INCOMING,
+                          'Cause': '0',
+                          'Cause-txt': 'Unknown'})
+
+
+class CallIndexesTest(CallManagerTestBase, unittest.TestCase):
+    """
+    Tests for the optional secondary indexes.
+    """
+
+    def call_manager(self):
+        self.ami = self.ready_proto()
+        cm = CallManager(self.ami, index_channels=True,
+                         index_caller_ids=True, index_linked_ids=True)
+        cm._tracking_variable = 'X_TRACK'
+        return cm
+
+    def test_indexes_disabled(self):
+        cm = CallManager(self.ready_proto())
+        with self.assertRaises(ValueError):
+            cm.call_by_channel(CHANNEL)
+        with self.assertRaises(ValueError):
+            cm.calls_by_caller_id('202')
+        with self.assertRaises(ValueError):
+            cm.calls_by_linked_id(UNIQUE_ID)
+
+    def test_channel_index(self):
+        cm, call = self.tracked_call()
+        self.assertIs(cm.call_by_channel(CHANNEL), call)
+        self.assertIs(cm.call_by_channel(CHANNEL_2), None)
+        cm.ami.event_received(LOCAL_BRIDGE)
+        self.assertIs(cm.call_by_channel(CHANNEL_2), call)
+        cm.ami.event_received(HANGUP_REJECTED_1)
+        self.assertIs(cm.call_by_channel(CHANNEL_2), None)
+        self.assertIs(cm.call_by_channel(CHANNEL), call)
+        cm.ami.event_received(HANGUP_REJECTED_2)
+        self.assertIs(cm.call_by_channel(CHANNEL), None)
+        self.assertEqual(cm._channels, {})
+        self.assertEqual(cm._channel_names, {})
+
+    def test_channel_rename(self):
+        cm = self.call_manager()
+        call = self.incoming_call(cm, NEWCHANNEL_INCOMING, NEWSTATE_INCOMING)
+        self.assertIs(cm.call_by_channel(CHANNEL_INCOMING), call)
+        event = Event('Rename',
+                      {'Channel': CHANNEL_INCOMING,
+                       'Newname': CHANNEL_INCOMING + '<MASQ>',
+                       'Uniqueid': UNIQUE_ID_INCOMING})
+        cm.ami.event_received(event)
+        self.assertIs(cm.call_by_channel(CHANNEL_INCOMING), None)
+        self.assertIs(cm.call_by_channel(CHANNEL_INCOMING + '<MASQ>'), call)
+        cm.ami.event_received(HANGUP_INCOMING)
+        self.assertEqual(cm._channels, {})
+
+    def test_caller_id_index(self):
+        cm = self.call_manager()
+        call = self.incoming_call(cm, NEWCHANNEL_INCOMING, NEWSTATE_INCOMING)
+        self.assertEqual(cm.calls_by_caller_id('202'), {call})
+        self.assertEqual(cm.calls_by_caller_id('203'), set())
+        cm.ami.event_received(HANGUP_INCOMING)
+        self.assertEqual(cm.calls_by_caller_id('202'), set())
+        self.assertEqual(cm._caller_ids, {})
+
+    def test_caller_id_change(self):
+        cm = self.call_manager()
+        call = self.incoming_call(cm, NEWCHANNEL_INCOMING, NEWSTATE_INCOMING)
+        event = Event('NewCallerid',
+                      {'Channel': CHANNEL_INCOMING,
+                       'CallerIDNum': '203',
+                       'CallerIDName': 'Someone',
+                       'Uniqueid': UNIQUE_ID_INCOMING})
+        cm.ami.event_received(event)
+        self.assertEqual(cm.calls_by_caller_id('202'), set())
+        self.assertEqual(cm.calls_by_caller_id('203'), {call})
+        # Unknown channel
+        cm.ami.event_received(Event('NewCallerid',
+                                    dict(event.headers, CallerIDNum='204',
+                                         Uniqueid='1234.5')))
+        self.assertEqual(cm.calls_by_caller_id('204'), set())
+        cm.ami.event_received(HANGUP_INCOMING)
+        self.assertEqual(cm.calls_by_caller_id('203'), set())
+        self.assertEqual(cm._caller_ids, {})
+
+    def test_linked_id_index(self):
+        cm = self.call_manager()
+        newchannel = Event('Newchannel', dict(NEWCHANNEL_INCOMING.headers,
+                                              Linkedid=UNIQUE_ID_INCOMING))
+        call = self.incoming_call(cm, newchannel, NEWSTATE_INCOMING)
+        self.assertEqual(cm.calls_by_linked_id(UNIQUE_ID_INCOMING), {call})
+        self.assertEqual(cm.calls_by_linked_id(UNIQUE_ID), set())
+        cm.ami.event_received(HANGUP_INCOMING)
+        self.assertEqual(cm.calls_by_linked_id(UNIQUE_ID_INCOMING), set())
+        self.assertEqual(cm._linked_ids, {})
+
+    def test_linked_id_change(self):
+        cm = self.call_manager()
+        newchannel = Event('Newchannel', dict(NEWCHANNEL_INCOMING.headers,
+                                              Linkedid=UNIQUE_ID_INCOMING))
+        call = self.incoming_call(cm, newchannel, NEWSTATE_INCOMING)
+        # The channel got bridged to another one
+        cm.ami.event_received(Event('Newstate',
+                                    dict(NEWSTATE_INCOMING.headers,
+                                         Linkedid=UNIQUE_ID)))
+        self.assertEqual(cm.calls_by_linked_id(UNIQUE_ID_INCOMING), set())
+        self.assertEqual(cm.calls_by_linked_id(UNIQUE_ID), {call})
+        # Events without a Linkedid header don't change it
+        cm.ami.event_received(NEWSTATE_INCOMING)
+        self.assertEqual(cm.calls_by_linked_id(UNIQUE_ID), {call})
+        cm.ami.event_received(HANGUP_INCOMING)
+        self.assertEqual(cm.calls_by_linked_id(UNIQUE_ID), set())
+        self.assertEqual(cm._linked_ids, {})
+
+
+class CallMetricsTest(CallManagerTestBase, unittest.TestCase):
+    """
+    Tests for per-call latency metrics.
+    """
+
+    def call_manager(self):
+        self.ami = self.ready_proto()
+        self.clock = FakeClock(100.0)
+        cm = CallManager(self.ami, metrics=CallMetrics(clock=self.clock))
+        cm._tracking_variable = 'X_TRACK'
+        return cm
+
+    def call(self):
+        call = MockCall()
+        call.metrics_label = 'trunk'
+        return call
+
+    def test_outgoing_call_metrics(self):
+        cm = self.call_manager()
+        call = self.call()
+        cm.ami._action_id = 1
+        cm.ami.write = Mock()
+        cm.originate(call, {"Foo": "Bar"})
+        self.clock.now += 0.5
+        cm.ami.response_received(Response('success', {'ActionID': '1'}, []))
+        cm.ami.event_received(Event('VarSet',
+                                    {'Variable': 'X_TRACK',
+                                     'Value': '1',
+                                     'Channel': CHANNEL,
+                                     'Uniqueid': UNIQUE_ID}))
+        cm.ami.event_received(LOCAL_BRIDGE)
+        self.clock.now += 1.0
+        cm.ami.event_received(DIAL_START)
+        self.clock.now += 2.0
+        cm.ami.event_received(NEWSTATE_1)
+        self.clock.now += 3.0
+        cm.ami.event_received(NEWSTATE_2)
+        self.clock.now += 4.0
+        cm.ami.event_received(HANGUP_REJECTED_1)
+        cm.ami.event_received(HANGUP_REJECTED_2)
+        self.assertEqual(call.timestamps(),
+                         {'created': 100.0, 'queued': 100.5,
+                          'dialing_started': 101.5, 'ringing': 103.5,
+                          'answered': 106.5, 'ended': 110.5})
+        m = cm.metrics
+        expected = {'queue_to_dial': 1.0, 'post_dial_delay': 2.0,
+                    'answer_time': 6.5, 'duration': 4.0}
+        self.assertEqual(set(m.histograms()),
+                         {(name, 'trunk') for name in expected})
+        for name, value in expected.items():
+            h = m.histogram(name, 'trunk')
+            self.assertEqual(h.count, 1)
+            self.assertAlmostEqual(h.sum, value)
+        self.assertIs(m.histogram('answer_time'), None)
+
+    def test_incoming_call_metrics(self):
+        cm = self.call_manager()
+        call = self.incoming_call(cm, NEWCHANNEL_INCOMING, NEWSTATE_INCOMING)
+        self.clock.now += 2.0
+        cm.ami.event_received(Event('Newstate',
+                                    dict(NEWSTATE_INCOMING.headers,
+                                         ChannelState='6',
+                                         ChannelStateDesc='Up')))
+        h = cm.metrics.histogram('answer_time')
+        self.assertEqual(h.count, 1)
+        self.assertAlmostEqual(h.sum, 2.0)
+
+    def test_merge(self):
+        m1 = CallMetrics()
+        m2 = CallMetrics()
+        m1.observe('answer_time', 'a', 1.0)
+        m2.observe('answer_time', 'a', 2.0)
+        m2.observe('answer_time', 'b', 3.0)
+        m1.merge(m2)
+        self.assertEqual(m1.histogram('answer_time', 'a').count, 2)
+        self.assertEqual(m1.histogram('answer_time', 'b').count, 1)
+        # m2 is left untouched
+        self.assertEqual(m2.histogram('answer_time', 'a').count, 1)
+        m1.observe('answer_time', 'b', 3.0)
+        self.assertEqual(m2.histogram('answer_time', 'b').count, 1)
+
+
+@unittest.skipIf(Future is None, "concurrent.futures needed")
+class CallbackExecutorTest(CallManagerTestBase, unittest.TestCase):
+    """
+    Tests for running Call event handlers through a callback executor.
+    """
+
+    executor_factory = ImmediateExecutor
+
+    def call_manager(self):
+        self.ami = self.ready_proto()
+        self.executor = self.executor_factory()
+        cm = CallManager(
+            self.ami,
+            callback_executor=OrderedCallbackExecutor(self.executor))
+        cm._tracking_variable = 'X_TRACK'
+        return cm
+
+    def test_immediate_callbacks(self):
+        cm, call = self.tracked_call()
+        cm.ami.event_received(LOCAL_BRIDGE)
+        cm.ami.event_received(DIAL_START)
+        cm.ami.event_received(HANGUP_REJECTED_1)
+        cm.ami.event_received(HANGUP_REJECTED_2)
+        self.assertEqual(call.event_calls,
+                         ['call_queued', 'dialing_started', 'call_ended'])
+        call.call_ended.assert_called_once_with(21, 'Call Rejected')
+        self.assertEqual(cm.callback_executor.queue_depth(), 0)
+
+    def test_deferred_callbacks(self):
+        self.executor_factory = ManualExecutor
+        cm, call = self.tracked_call()
+        cm.ami.event_received(LOCAL_BRIDGE)
+        cm.ami.event_received(DIAL_START)
+        cm.ami.event_received(NEWSTATE_1)
+        cm.ami.event_received(HANGUP_REJECTED_1)
+        cm.ami.event_received(HANGUP_REJECTED_2)
+        # Nothing was called yet, but the manager's state is up to date
+        self.assertEqual(call.event_calls, [])
+        self.assertEqual(cm.tracked_calls(), set())
+        self.assertEqual(cm.callback_executor.queue_depth(call), 4)
+        while self.executor.tasks:
+            self.executor.run_one()
+        self.assertEqual(call.event_calls,
+                         ['call_queued', 'dialing_started',
+                          'call_state_changed', 'call_ended'])
+        self.assertEqual(cm.callback_executor.queue_depth(), 0)
+
+
+class StateCoalescingTest(CallManagerTestBase, unittest.TestCase):
+    """
+    Tests for coalescing of Newstate events.
+    """
+
+    def call_manager(self):
+        self.ami = self.ready_proto()
+        self.scheduler = FakeScheduler()
+        cm = CallManager(self.ami, call_later=self.scheduler.call_later,
+                         coalesce_states=0.05)
+        cm._tracking_variable = 'X_TRACK'
+        return cm
+
+    def test_call_later_required(self):
+        with self.assertRaises(ValueError):
+            CallManager(self.ready_proto(), coalesce_states=0)
+
+    def test_state_events(self):
+        cm, call = self.tracked_call()
+        cm.ami.event_received(LOCAL_BRIDGE)
+        cm.ami.event_received(NEWSTATE_1)
+        cm.ami.event_received(NEWSTATE_2)
+        self.assertEqual(call.event_calls, ['call_queued'])
+        # Only one flush is scheduled
+        self.assertEqual(len(self.scheduler.timers), 1)
+        self.assertEqual(self.scheduler.timers[0].delay, 0.05)
+        self.scheduler.run_all()
+        self.assertEqual(call.event_calls,
+                         ['call_queued', 'call_state_changed'])
+        call.call_state_changed.assert_called_once_with(6, 'Up')
+        # Same state again: no notification
+        cm.ami.event_received(NEWSTATE_2)
+        self.scheduler.run_all()
+        call.call_state_changed.assert_called_once_with(6, 'Up')
+        cm.ami.event_received(NEWSTATE_1)
+        self.scheduler.run_all()
+        call.call_state_changed.assert_called_with(5, 'Ringing')
+
+    def test_state_flushed_before_other_notifications(self):
+        cm, call = self.tracked_call()
+        cm.ami.event_received(LOCAL_BRIDGE)
+        cm.ami.event_received(NEWSTATE_1)
+        cm.ami.event_received(HANGUP_REJECTED_1)
+        cm.ami.event_received(HANGUP_REJECTED_2)
+        self.assertEqual(call.event_calls,
+                         ['call_queued', 'call_state_changed', 'call_ended'])
+        self.scheduler.run_all()
+        self.assertEqual(call.event_calls,
+                         ['call_queued', 'call_state_changed', 'call_ended'])
+
+    def test_incoming_sip_call(self):
+        cm = self.call_manager()
+        call = self.incoming_call(cm, NEWCHANNEL_INCOMING, NEWSTATE_INCOMING)
+        self.assertEqual(call.event_calls, [])
+        self.scheduler.run_all()
+        self.assertEqual(call.event_calls, ['call_state_changed'])
+        call.call_state_changed.assert_called_once_with(4, 'Ring')
+
+    def test_incoming_sip_call_hangup_cause(self):
+        cm = self.call_manager()
+        call = self.incoming_call(cm, NEWCHANNEL_INCOMING, NEWSTATE_INCOMING)
+        cm.ami.event_received(SOFT_HANGUP_INCOMING_1)
+        cm.ami.event_received(HANGUP_INCOMING)
+        self.assertEqual(call.event_calls, ['call_state_changed', 'call_ended'])
+        call.call_ended.assert_called_once_with(32, '')
+
 
 if __name__ == "__main__":
     main()
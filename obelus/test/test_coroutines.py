@@ -0,0 +1,15 @@
+"""
+Tests for native (async def) coroutines awaiting Handlers, on Python 3.5
+and later (see native_coroutines).
+"""
+
+import sys
+
+from . import main
+
+if sys.version_info >= (3, 5):
+    from .native_coroutines import NativeCoroutineSessionTest, AsyncioTest
+
+
+if __name__ == "__main__":
+    main()
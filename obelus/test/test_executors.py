@@ -0,0 +1,245 @@
+
+import collections
+try:
+    from concurrent.futures import Future, ThreadPoolExecutor
+except ImportError:
+    # Python 2 without the "futures" backport
+    Future = ThreadPoolExecutor = None
+import sys
+import threading
+import unittest
+
+from mock import Mock
+
+from obelus.executors import (
+    OrderedCallbackExecutor, BlockingPool, BlockingPoolFull)
+from . import main, watch_logging, FakeClock
+
+
+class ManualExecutor(object):
+    """
+    A concurrent.futures-like executor which runs tasks on demand.
+    """
+
+    def __init__(self):
+        self.tasks = collections.deque()
+
+    def submit(self, func, *args):
+        fut = Future()
+        self.tasks.append((fut, func, args))
+        return fut
+
+    def run_one(self):
+        fut, func, args = self.tasks.popleft()
+        try:
+            res = func(*args)
+        except Exception as e:
+            fut.set_exception(e)
+        else:
+            fut.set_result(res)
+
+
+class ImmediateExecutor(ManualExecutor):
+    """
+    A concurrent.futures-like executor which runs tasks immediately.
+    """
+
+    def submit(self, func, *args):
+        fut = ManualExecutor.submit(self, func, *args)
+        self.run_one()
+        return fut
+
+
+@unittest.skipIf(Future is None, "concurrent.futures needed")
+class OrderedCallbackExecutorTest(unittest.TestCase):
+
+    def test_ordering_per_key(self):
+        manual = ManualExecutor()
+        e = OrderedCallbackExecutor(manual)
+        calls = []
+        e.submit('a', calls.append, 'a1')
+        e.submit('b', calls.append, 'b1')
+        e.submit('a', calls.append, 'a2')
+        e.submit('a', calls.append, 'a3')
+        # Only one task per key is submitted to the underlying executor
+        self.assertEqual(len(manual.tasks), 2)
+        self.assertEqual(e.queue_depth(), 4)
+        self.assertEqual(e.queue_depth('a'), 3)
+        self.assertEqual(e.queue_depth('b'), 1)
+        self.assertEqual(e.queue_depth('c'), 0)
+        manual.run_one()
+        self.assertEqual(calls, ['a1'])
+        self.assertEqual(e.queue_depth('a'), 2)
+        manual.run_one()
+        manual.run_one()
+        self.assertEqual(calls, ['a1', 'b1', 'a2'])
+        self.assertEqual(e.queue_depth('b'), 0)
+        manual.run_one()
+        self.assertEqual(calls, ['a1', 'b1', 'a2', 'a3'])
+        self.assertEqual(e.queue_depth(), 0)
+        self.assertEqual(e._queues, {})
+        self.assertEqual(len(manual.tasks), 0)
+
+    def test_exception(self):
+        manual = ManualExecutor()
+        e = OrderedCallbackExecutor(manual)
+        calls = []
+        e.submit('a', lambda: 1 / 0)
+        e.submit('a', calls.append, 'a2')
+        with watch_logging('obelus.executors') as w:
+            manual.run_one()
+        self.assertEqual(len(w.output), 1)
+        self.assertIn("ZeroDivisionError", w.output[0])
+        manual.run_one()
+        self.assertEqual(calls, ['a2'])
+        self.assertEqual(e.queue_depth(), 0)
+
+    def test_submit_failure(self):
+        manual = ManualExecutor()
+        e = OrderedCallbackExecutor(manual)
+        calls = []
+        e.submit('a', calls.append, 'a1')
+        e.submit('a', calls.append, 'a2')
+        e.submit('a', calls.append, 'a3')
+        manual.submit = Mock(side_effect=RuntimeError("shut down"))
+        with watch_logging('obelus.executors') as w:
+            manual.run_one()
+        self.assertEqual(calls, ['a1'])
+        # The queued callbacks are dropped, and the key is released
+        self.assertEqual(len(w.output), 2)
+        self.assertIn("shut down", w.output[0])
+        self.assertEqual(e.queue_depth(), 0)
+        self.assertEqual(e._queues, {})
+        del manual.submit
+        e.submit('a', calls.append, 'a4')
+        manual.run_one()
+        self.assertEqual(calls, ['a1', 'a4'])
+
+    def test_thread_pool(self):
+        pool = ThreadPoolExecutor(4)
+        e = OrderedCallbackExecutor(pool)
+        results = collections.defaultdict(list)
+        done = threading.Event()
+        def cb(key, i):
+            results[key].append(i)
+            if sum(len(v) for v in results.values()) == 400:
+                done.set()
+        for i in range(100):
+            for key in 'abcd':
+                e.submit(key, cb, key, i)
+        self.assertTrue(done.wait(10.0))
+        pool.shutdown()
+        for key in 'abcd':
+            self.assertEqual(results[key], list(range(100)))
+        self.assertEqual(e.queue_depth(), 0)
+
+
+class FakeLoop(object):
+    """
+    Collects callbacks scheduled with call_soon_threadsafe().
+    """
+
+    def __init__(self):
+        self.callbacks = []
+
+    def call_soon_threadsafe(self, func, *args):
+        self.callbacks.append((func, args))
+
+    def run_all(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for func, args in callbacks:
+            func(*args)
+
+
+class BlockingPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ManualExecutor()
+        self.loop = FakeLoop()
+        self.clock = FakeClock()
+
+    def make_pool(self, **kwargs):
+        return BlockingPool(self.executor, self.loop.call_soon_threadsafe,
+                            clock=self.clock, **kwargs)
+
+    def test_result(self):
+        pool = self.make_pool()
+        h = pool.run(lambda x, y: x + y, 1, 2)
+        h.on_result = Mock()
+        self.assertEqual(pool.queue_depth(), 1)
+        self.clock.now = 0.5
+        self.executor.run_one()
+        # Result is only delivered on the loop thread
+        self.assertEqual(h.on_result.call_count, 0)
+        self.loop.run_all()
+        h.on_result.assert_called_once_with(3)
+        self.assertEqual(pool.queue_depth(), 0)
+        self.assertEqual(pool.stats['completed'], 1)
+        self.assertEqual(pool.queue_latency.count, 1)
+        self.assertAlmostEqual(pool.queue_latency.percentile(50), 0.5,
+                               delta=0.1)
+
+    def test_exception(self):
+        pool = self.make_pool()
+        h = pool.run(lambda: 1 // 0)
+        h.on_exception = Mock()
+        self.executor.run_one()
+        self.loop.run_all()
+        (exc,), _ = h.on_exception.call_args
+        self.assertIsInstance(exc, ZeroDivisionError)
+        self.assertEqual(pool.stats['failed'], 1)
+
+    def test_base_exception(self):
+        pool = self.make_pool()
+        h = pool.run(sys.exit, 3)
+        h.on_exception = Mock()
+        self.executor.run_one()
+        self.loop.run_all()
+        (exc,), _ = h.on_exception.call_args
+        self.assertIsInstance(exc, SystemExit)
+        self.assertEqual(pool.queue_depth(), 0)
+
+    def test_submit_failure(self):
+        pool = self.make_pool(max_pending=1)
+        self.executor.submit = Mock(side_effect=RuntimeError("shut down"))
+        with self.assertRaises(RuntimeError):
+            pool.run(lambda: None)
+        self.assertEqual(pool.queue_depth(), 0)
+        self.assertEqual(pool.stats['submitted'], 0)
+        del self.executor.submit
+        # The failed call didn't take a slot
+        pool.run(lambda: None)
+
+    def test_max_pending(self):
+        pool = self.make_pool(max_pending=1)
+        pool.run(lambda: None)
+        with self.assertRaises(BlockingPoolFull):
+            pool.run(lambda: None)
+        self.assertEqual(pool.stats['rejected'], 1)
+        self.executor.run_one()
+        self.loop.run_all()
+        pool.run(lambda: None)
+
+    def test_thread_pool(self):
+        try:
+            import asyncio
+        except ImportError:
+            self.skipTest("asyncio needed")
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        tpe = ThreadPoolExecutor(2)
+        self.addCleanup(tpe.shutdown)
+        pool = BlockingPool(tpe, loop.call_soon_threadsafe)
+        thread_ids = []
+        fut = loop.create_future()
+        def func():
+            thread_ids.append(threading.current_thread())
+            return 42
+        h = pool.run(func)
+        h.on_result = fut.set_result
+        self.assertEqual(loop.run_until_complete(fut), 42)
+        self.assertNotEqual(thread_ids, [threading.current_thread()])
+
+
+if __name__ == "__main__":
+    main()
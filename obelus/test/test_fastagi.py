@@ -0,0 +1,316 @@
+
+import unittest
+
+from mock import Mock
+
+from obelus.agi.fastagi import FastAGIExecutor, FastAGIProtocol
+from obelus.agi.routing import Router
+from obelus.agi.session import AGISession
+from . import main, watch_logging, FakeClock, FakeScheduler
+from .test_agiprotocol import HEADER
+
+
+class FastAGIExecutorTestBase(object):
+    """
+    Helpers for FastAGIExecutor tests.
+    """
+
+    def setUp(self):
+        class MyProtocol(FastAGIProtocol):
+            @staticmethod
+            def session_factory():
+                return Mock(spec_set=AGISession)
+        self.protocol_factory = MyProtocol
+
+    def make_executor(self, **kwargs):
+        return FastAGIExecutor(self.protocol_factory, **kwargs)
+
+    def connect(self, executor):
+        proto = executor.make_protocol()
+        proto.connection_made(Mock())
+        return proto
+
+    def connect_with_header(self, executor):
+        proto = self.connect(executor)
+        proto.data_received(HEADER + b"\n")
+        return proto
+
+
+class FastAGIExecutorTest(FastAGIExecutorTestBase, unittest.TestCase):
+
+    def test_active_connections(self):
+        e = self.make_executor()
+        p1 = self.connect(e)
+        p2 = self.connect(e)
+        self.assertEqual(e.active_connections(), 2)
+        p1.connection_lost(None)
+        self.assertEqual(e.active_connections(), 1)
+        self.assertEqual(e.stats['connections'], 2)
+        e.close()
+        self.assertEqual(e.active_connections(), 0)
+        p2.transport.close.assert_called_once_with()
+
+    def test_call_later(self):
+        call_later = Mock()
+        e = self.make_executor(call_later=call_later)
+        p = self.connect(e)
+        self.assertIs(p.call_later, call_later)
+        self.assertIs(p.stats, e.stats)
+        self.assertIs(p.executor, e)
+
+
+class AdmissionControlTest(FastAGIExecutorTestBase, unittest.TestCase):
+
+    def assert_shed(self, proto, lines=b"SET VARIABLE AGIOVERLOAD 1\n"):
+        self.assertIsNone(proto._session)
+        proto.transport.write.assert_called_once_with(lines)
+        self.assertEqual(proto.transport.close.call_count, 0)
+        proto.data_received(b"200 result=1\n")
+        proto.transport.close.assert_called_once_with()
+
+    def test_max_sessions(self):
+        e = self.make_executor(max_sessions=2)
+        p1 = self.connect_with_header(e)
+        p2 = self.connect_with_header(e)
+        p3 = self.connect_with_header(e)
+        self.assertIsNotNone(p1._session)
+        self.assertIsNotNone(p2._session)
+        self.assert_shed(p3)
+        self.assertEqual(e.stats['rejected_sessions'], 1)
+        self.assertEqual(e.gauges(),
+                         {'active_sessions': 2, 'queued_sessions': 0})
+        # Once a session ends, a new one is accepted
+        p1.connection_lost(None)
+        p4 = self.connect_with_header(e)
+        self.assertIsNotNone(p4._session)
+        self.assertEqual(e.stats['rejected_sessions'], 1)
+
+    def test_custom_fallback(self):
+        e = self.make_executor(max_sessions=0,
+                               fallback_commands=[("HANGUP",)])
+        self.assert_shed(self.connect_with_header(e), b"HANGUP\n")
+
+    def test_no_fallback(self):
+        e = self.make_executor(max_sessions=0, fallback_commands=[])
+        p = self.connect_with_header(e)
+        self.assertEqual(p.transport.write.call_count, 0)
+        p.transport.close.assert_called_once_with()
+
+    def test_queue(self):
+        e = self.make_executor(max_sessions=1, max_queued=1)
+        p1 = self.connect_with_header(e)
+        p2 = self.connect_with_header(e)
+        p3 = self.connect_with_header(e)
+        self.assertIsNone(p2._session)
+        self.assert_shed(p3)
+        self.assertEqual(e.gauges(),
+                         {'active_sessions': 1, 'queued_sessions': 1})
+        self.assertEqual(e.active_connections(), 2)
+        p1.connection_lost(None)
+        # The queued connection gets its session started
+        self.assertIsNotNone(p2._session)
+        p2._session.session_established.assert_called_once_with()
+        self.assertEqual(e.gauges(),
+                         {'active_sessions': 1, 'queued_sessions': 0})
+
+    def test_queued_header_after_admission(self):
+        e = self.make_executor(max_sessions=1, max_queued=1)
+        p1 = self.connect_with_header(e)
+        p2 = self.connect(e)
+        p1.connection_lost(None)
+        self.assertIsNotNone(p2._session)
+        self.assertEqual(p2._session.session_established.call_count, 0)
+        p2.data_received(HEADER + b"\n")
+        p2._session.session_established.assert_called_once_with()
+
+    def test_queued_connection_lost(self):
+        e = self.make_executor(max_sessions=1, max_queued=1)
+        p1 = self.connect_with_header(e)
+        p2 = self.connect_with_header(e)
+        p2.connection_lost(None)
+        self.assertEqual(e.gauges(),
+                         {'active_sessions': 1, 'queued_sessions': 0})
+
+    def test_queue_timeout(self):
+        scheduler = FakeScheduler()
+        e = self.make_executor(max_sessions=1, max_queued=1, queue_timeout=2,
+                               call_later=scheduler.call_later)
+        p1 = self.connect_with_header(e)
+        p2 = self.connect_with_header(e)
+        with watch_logging('obelus.agi', level='WARN'):
+            scheduler.fire(2)
+        self.assert_shed(p2)
+        self.assertEqual(e.stats['queue_timeouts'], 1)
+        self.assertEqual(e.gauges(),
+                         {'active_sessions': 1, 'queued_sessions': 0})
+
+    def test_shed_timeout(self):
+        scheduler = FakeScheduler()
+        e = self.make_executor(max_sessions=0, shed_timeout=5,
+                               call_later=scheduler.call_later)
+        p = self.connect(e)
+        self.assertIs(p.stats, e.stats)
+        # Asterisk never sends the header
+        with watch_logging('obelus.agi', level='WARN') as w:
+            scheduler.fire(5)
+        self.assertEqual(len(w.output), 1)
+        p.transport.close.assert_called_once_with()
+        self.assertEqual(e.stats['shed_timeouts'], 1)
+
+    def test_shed_timer_cancelled(self):
+        scheduler = FakeScheduler()
+        e = self.make_executor(max_sessions=0,
+                               call_later=scheduler.call_later)
+        p = self.connect_with_header(e)
+        self.assertEqual(len(scheduler.timers), 1)
+        p.data_received(b"200 result=1\n")
+        p.connection_lost(None)
+        self.assertEqual(scheduler.timers, [])
+
+    def test_queued_shed_timeout(self):
+        scheduler = FakeScheduler()
+        e = self.make_executor(max_sessions=1, max_queued=1, queue_timeout=2,
+                               shed_timeout=5,
+                               call_later=scheduler.call_later)
+        p1 = self.connect_with_header(e)
+        p2 = self.connect(e)
+        with watch_logging('obelus.agi', level='WARN'):
+            scheduler.fire(2)
+            self.assertEqual(p2.transport.close.call_count, 0)
+            scheduler.fire(5)
+        p2.transport.close.assert_called_once_with()
+
+    def test_queue_timer_cancelled(self):
+        scheduler = FakeScheduler()
+        e = self.make_executor(max_sessions=1, max_queued=1, queue_timeout=2,
+                               call_later=scheduler.call_later)
+        p1 = self.connect_with_header(e)
+        p2 = self.connect_with_header(e)
+        p1.connection_lost(None)
+        self.assertEqual(scheduler.timers, [])
+
+    def test_queue_timeout_requires_call_later(self):
+        with self.assertRaises(ValueError):
+            self.make_executor(max_queued=1, queue_timeout=2)
+
+    def test_accept_rate(self):
+        clock = FakeClock()
+        e = self.make_executor(max_accept_rate=2, clock=clock)
+        p1 = self.connect_with_header(e)
+        p2 = self.connect_with_header(e)
+        p3 = self.connect_with_header(e)
+        self.assertIsNotNone(p2._session)
+        self.assert_shed(p3)
+        self.assertEqual(e.stats['rate_limited_sessions'], 1)
+        clock.now += 0.5
+        p4 = self.connect_with_header(e)
+        self.assertIsNotNone(p4._session)
+
+
+class DrainTest(FastAGIExecutorTestBase, unittest.TestCase):
+
+    def test_drain(self):
+        e = self.make_executor()
+        p1 = self.connect_with_header(e)
+        p2 = self.connect_with_header(e)
+        h = e.drain()
+        h.on_result = Mock()
+        # New connections are shed
+        p3 = self.connect_with_header(e)
+        self.assertIsNone(p3._session)
+        p3.transport.write.assert_called_once_with(
+            b"SET VARIABLE AGIOVERLOAD 1\n")
+        p1.connection_lost(None)
+        self.assertEqual(h.on_result.call_count, 0)
+        p2.connection_lost(None)
+        h.on_result.assert_called_once_with(None)
+        self.assertEqual(p1.transport.close.call_count, 0)
+
+    def test_drain_idle(self):
+        e = self.make_executor()
+        h = e.drain()
+        with self.assertRaises(RuntimeError):
+            e.drain()
+        # Already drained: the callback is called right away
+        h.on_result = Mock()
+        h.on_result.assert_called_once_with(None)
+
+    def test_drain_queued(self):
+        e = self.make_executor(max_sessions=1, max_queued=1)
+        p1 = self.connect_with_header(e)
+        p2 = self.connect_with_header(e)
+        e.drain()
+        p2.transport.write.assert_called_once_with(
+            b"SET VARIABLE AGIOVERLOAD 1\n")
+        self.assertEqual(e.gauges(),
+                         {'active_sessions': 1, 'queued_sessions': 0})
+
+    def test_drain_timeout(self):
+        scheduler = FakeScheduler()
+        e = self.make_executor(call_later=scheduler.call_later)
+        p1 = self.connect_with_header(e)
+        h = e.drain(timeout=10)
+        h.on_result = Mock()
+        with watch_logging('obelus.agi', level='WARN'):
+            scheduler.fire(10)
+        p1.transport.close.assert_called_once_with()
+        h.on_result.assert_called_once_with(None)
+        self.assertEqual(e.stats['drain_timeouts'], 1)
+
+    def test_drain_timer_cancelled(self):
+        scheduler = FakeScheduler()
+        e = self.make_executor(call_later=scheduler.call_later)
+        p1 = self.connect_with_header(e)
+        e.drain(timeout=10)
+        p1.connection_lost(None)
+        self.assertEqual(scheduler.timers, [])
+
+    def test_drain_timeout_requires_call_later(self):
+        e = self.make_executor()
+        with self.assertRaises(ValueError):
+            e.drain(timeout=10)
+
+
+class RoutingTest(FastAGIExecutorTestBase, unittest.TestCase):
+
+    def setUp(self):
+        FastAGIExecutorTestBase.setUp(self)
+        self.router = Router()
+        self.ivr_factory = lambda: Mock(spec_set=AGISession)
+        self.router.add_route('ivr', self.ivr_factory, prefix=True)
+
+    def header(self, script):
+        return HEADER + ("agi_network_script: %s\n\n" % script).encode()
+
+    def test_routed_session(self):
+        e = self.make_executor(router=self.router)
+        p = self.connect(e)
+        self.assertIsNone(p._session)
+        p.data_received(self.header('ivr/menu?lang=fr'))
+        p._session.session_established.assert_called_once_with()
+        self.assertEqual(p.route.path, 'ivr/menu')
+        self.assertEqual(p.route.args, {'lang': 'fr'})
+
+    def test_unrouted_session(self):
+        e = self.make_executor(router=self.router)
+        p = self.connect(e)
+        with watch_logging('obelus.agi', level='WARN'):
+            p.data_received(self.header('other'))
+        self.assertIsNone(p._session)
+        p.transport.close.assert_called_once_with()
+        self.assertEqual(e.stats['unrouted_sessions'], 1)
+
+    def test_routed_queued_session(self):
+        e = self.make_executor(router=self.router, max_sessions=1,
+                               max_queued=1)
+        p1 = self.connect(e)
+        p1.data_received(self.header('ivr'))
+        p2 = self.connect(e)
+        p2.data_received(self.header('ivr'))
+        self.assertIsNone(p2._session)
+        p1.connection_lost(None)
+        p2._session.session_established.assert_called_once_with()
+
+
+if __name__ == "__main__":
+    main()
@@ -53,20 +53,31 @@ class HandlerTest(unittest.TestCase):
     def test_set_result_before_callbacks(self):
         h = Handler()
         h.set_result(5)
-        with self.assertRaises(NotImplementedError):
+        # The result is delivered when the callback is set
+        cb = h.on_result = Mock()
+        cb.assert_called_once_with(5)
+        eb = h.on_exception = Mock()
+        self.assertEqual(eb.call_count, 0)
+        with self.assertRaises(ValueError):
             h.on_result = Mock()
-        with self.assertRaises(NotImplementedError):
-            h.on_exception = Mock()
 
     def test_set_exception_before_callbacks(self):
         h = Handler()
         exc = ZeroDivisionError()
+        h.set_exception(exc)
+        cb = h.on_result = Mock()
+        self.assertEqual(cb.call_count, 0)
+        eb = h.on_exception = Mock()
+        eb.assert_called_once_with(exc)
+        self.assertEqual(cb.call_count, 0)
+
+    def test_set_exception_without_exception_callback(self):
+        h = Handler()
+        cb = h.on_result = Mock()
+        exc = ZeroDivisionError()
         with self.assertRaises(ZeroDivisionError):
             h.set_exception(exc)
-        with self.assertRaises(NotImplementedError):
-            h.on_result = Mock()
-        with self.assertRaises(NotImplementedError):
-            h.on_exception = Mock()
+        self.assertEqual(cb.call_count, 0)
 
     def test_set_result_twice(self):
         h = Handler()
@@ -103,6 +114,44 @@ class HandlerTest(unittest.TestCase):
             h.set_exception(5)
         self.assertEqual(eb.call_count, 0)
 
+    def test_aggregate(self):
+        handlers = [Handler() for i in range(3)]
+        h = Handler.aggregate(handlers)
+        cb = h.on_result = Mock()
+        eb = h.on_exception = Mock()
+        handlers[2].set_result(3)
+        handlers[0].set_result(1)
+        self.assertEqual(cb.call_count, 0)
+        handlers[1].set_result(2)
+        cb.assert_called_once_with([1, 2, 3])
+        self.assertEqual(eb.call_count, 0)
+
+    def test_aggregate_exception(self):
+        handlers = [Handler() for i in range(3)]
+        h = Handler.aggregate(handlers)
+        cb = h.on_result = Mock()
+        eb = h.on_exception = Mock()
+        exc = ZeroDivisionError()
+        handlers[0].set_result(1)
+        handlers[1].set_exception(exc)
+        eb.assert_called_once_with(exc)
+        # Further outcomes are ignored
+        handlers[2].set_exception(KeyError())
+        eb.assert_called_once_with(exc)
+        self.assertEqual(cb.call_count, 0)
+
+    def test_aggregate_return_exceptions(self):
+        handlers = [Handler() for i in range(3)]
+        h = Handler.aggregate(handlers, return_exceptions=True)
+        cb = h.on_result = Mock()
+        eb = h.on_exception = Mock()
+        exc = ZeroDivisionError()
+        handlers[0].set_result(1)
+        handlers[1].set_exception(exc)
+        self.assertEqual(cb.call_count, 0)
+        handlers[2].set_result(3)
+        cb.assert_called_once_with([1, exc, 3])
+        self.assertEqual(eb.call_count, 0)
 
 
 if __name__ == "__main__":
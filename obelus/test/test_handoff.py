@@ -0,0 +1,83 @@
+
+import os
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from obelus.agi import handoff
+from . import main
+
+
+try:
+    handoff._check_supported()
+except NotImplementedError:
+    supported = False
+else:
+    supported = True
+
+
+@unittest.skipUnless(supported, "socket handoff not supported")
+class HandoffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'handoff.sock')
+
+    def test_send_recv_fds(self):
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        r, w = os.pipe()
+        try:
+            handoff.send_fds(a, [w])
+            fds = handoff.recv_fds(b)
+            self.assertEqual(len(fds), 1)
+            os.write(fds[0], b"x")
+            os.close(fds[0])
+            self.assertEqual(os.read(r, 1), b"x")
+        finally:
+            for s in (a, b):
+                s.close()
+            for fd in (r, w):
+                os.close(fd)
+
+    def test_handoff_listening_socket(self):
+        lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        lsock.bind(('127.0.0.1', 0))
+        lsock.listen(5)
+        self.addCleanup(lsock.close)
+        listener = handoff.HandoffListener(self.path, lsock)
+        self.addCleanup(listener.close)
+        results = []
+        t = threading.Thread(target=lambda: results.append(
+            handoff.request_listening_socket(self.path)))
+        t.start()
+        select.select([listener], [], [], 5.0)
+        self.assertTrue(listener.handle_request())
+        t.join()
+        received, = results
+        try:
+            self.assertEqual(received.getsockname(), lsock.getsockname())
+            # The received socket accepts connections made to the original
+            # address
+            c = socket.create_connection(lsock.getsockname())
+            received.setblocking(True)
+            conn, _ = received.accept()
+            conn.close()
+            c.close()
+        finally:
+            received.close()
+        listener.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_stale_path(self):
+        open(self.path, 'w').close()
+        listener = handoff.HandoffListener(self.path, None)
+        listener.close(unlink=False)
+        self.assertTrue(os.path.exists(self.path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+
+import unittest
+
+from obelus.ami.calls import Call
+from obelus.ami.history import EventHistory, EventRecord
+from obelus.ami.protocol import Event
+from . import main
+
+
+def make_call(call_id, manager=None):
+    call = Call()
+    call.manager = manager
+    call._call_id = call_id
+    return call
+
+
+def hangup(cause):
+    return Event('Hangup', {'Uniqueid': '1378719573.625',
+                            'Channel': 'SIP/foo-00000001',
+                            'Cause': cause,
+                            'ConnectedLineNum': '<unknown>'})
+
+
+class EventHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = 1000.0
+
+    def clock(self):
+        self.time += 1
+        return self.time
+
+    def test_record(self):
+        h = EventHistory(clock=self.clock)
+        call = make_call('1')
+        self.assertEqual(h.events(call), [])
+        h.record(call, hangup('16'))
+        self.assertEqual(len(h), 1)
+        self.assertEqual(h.events(call),
+                         [EventRecord('Hangup', 1001.0,
+                                      (('Uniqueid', '1378719573.625'),
+                                       ('Channel', 'SIP/foo-00000001'),
+                                       ('Cause', '16')))])
+        self.assertEqual(h.events(make_call('2')), [])
+
+    def test_custom_headers(self):
+        h = EventHistory(headers=['Cause'], clock=self.clock)
+        call = make_call('1')
+        h.record(call, hangup('16'))
+        (rec,) = h.events(call)
+        self.assertEqual(rec.headers, (('Cause', '16'),))
+
+    def test_events_per_call(self):
+        h = EventHistory(events_per_call=3, clock=self.clock)
+        call = make_call('1')
+        for i in range(5):
+            h.record(call, hangup(str(i)))
+        self.assertEqual(len(h), 3)
+        self.assertEqual([dict(rec.headers)['Cause']
+                          for rec in h.events(call)], ['2', '3', '4'])
+
+    def test_max_events(self):
+        h = EventHistory(events_per_call=3, max_events=5, clock=self.clock)
+        calls = [make_call(str(i)) for i in range(3)]
+        for call in calls:
+            h.record(call, hangup('0'))
+            h.record(call, hangup('1'))
+        # Oldest call was evicted
+        self.assertEqual(len(h), 4)
+        self.assertEqual(h.events(calls[0]), [])
+        self.assertEqual(len(h.events(calls[1])), 2)
+        self.assertEqual(len(h.events(calls[2])), 2)
+
+    def test_several_managers(self):
+        # Call ids are only unique for a given manager
+        h = EventHistory(clock=self.clock)
+        call1 = make_call('1', manager=object())
+        call2 = make_call('1', manager=object())
+        h.record(call1, hangup('16'))
+        h.record(call2, hangup('17'))
+        h.record(call2, hangup('18'))
+        self.assertEqual(len(h.events(call1)), 1)
+        self.assertEqual(len(h.events(call2)), 2)
+        h.discard(call1)
+        self.assertEqual(len(h), 2)
+
+    def test_discard(self):
+        h = EventHistory(clock=self.clock)
+        call = make_call('1')
+        h.record(call, hangup('0'))
+        h.record(make_call('2'), hangup('0'))
+        h.discard(call)
+        h.discard(call)
+        self.assertEqual(len(h), 1)
+        self.assertEqual(h.events(call), [])
+        h.clear()
+        self.assertEqual(len(h), 0)
+
+    def test_invalid_sizes(self):
+        with self.assertRaises(ValueError):
+            EventHistory(events_per_call=0)
+        with self.assertRaises(ValueError):
+            EventHistory(max_events=0)
+
+
+if __name__ == "__main__":
+    main()
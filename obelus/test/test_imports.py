@@ -0,0 +1,68 @@
+
+import subprocess
+import sys
+import unittest
+
+import obelus.agi
+import obelus.ami
+from . import main
+
+
+# Names exported by the packages' former star imports
+BASELINE_AGI_NAMES = [
+    'AGIChannel', 'AGICommandFailure', 'AGIError', 'AGIForbiddenCommand',
+    'AGIProtocol', 'AGISyntaxError', 'AGIUnknownCommand', 'AsyncAGIExecutor',
+    'Handler', 'LineReceiver', 'ProtocolAGIChannel', 'Response',
+    ]
+
+BASELINE_AMI_NAMES = [
+    'AMIProtocol', 'ActionError', 'BaseAMIProtocol', 'Call', 'CallManager',
+    'CaseDict', 'Event', 'EventList', 'Handler', 'LineReceiver',
+    'OriginateError', 'Response',
+    ]
+
+
+class LazyImportTest(unittest.TestCase):
+
+    def check_package(self, package):
+        for name in package.__all__:
+            value = getattr(package, name)
+            self.assertIs(value, getattr(package, name))
+            self.assertIn(name, dir(package))
+        with self.assertRaises(AttributeError):
+            package.nonexistent_name
+
+    def test_agi(self):
+        self.check_package(obelus.agi)
+        self.assertIs(obelus.agi.AGIProtocol,
+                      obelus.agi.protocol.AGIProtocol)
+
+    def test_ami(self):
+        self.check_package(obelus.ami)
+        self.assertIs(obelus.ami.CallManager, obelus.ami.calls.CallManager)
+
+    def test_baseline_names(self):
+        for package, names in [(obelus.agi, BASELINE_AGI_NAMES),
+                               (obelus.ami, BASELINE_AMI_NAMES)]:
+            for name in names:
+                self.assertIn(name, package.__all__)
+                self.assertTrue(getattr(package, name))
+        from obelus.common import Handler, LineReceiver
+        from obelus.casedict import CaseDict
+        self.assertIs(obelus.agi.Handler, Handler)
+        self.assertIs(obelus.agi.LineReceiver, LineReceiver)
+        self.assertIs(obelus.ami.Handler, Handler)
+        self.assertIs(obelus.ami.LineReceiver, LineReceiver)
+        self.assertIs(obelus.ami.CaseDict, CaseDict)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "requires PEP 562")
+    def test_submodules_not_imported(self):
+        code = ("import sys, obelus.agi, obelus.ami; "
+                "print(sorted(m for m in sys.modules "
+                "if m.startswith('obelus.')))")
+        out = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(out.strip(), b"['obelus.agi', 'obelus.ami']")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+
+import unittest
+
+from obelus.metrics import Histogram
+from . import main
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_empty(self):
+        h = Histogram()
+        self.assertEqual(h.count, 0)
+        self.assertIs(h.mean, None)
+        self.assertIs(h.percentile(50), None)
+
+    def test_invalid_layout(self):
+        with self.assertRaises(ValueError):
+            Histogram(0, 1)
+        with self.assertRaises(ValueError):
+            Histogram(2, 1)
+
+    def test_add(self):
+        h = Histogram()
+        for v in (0.01, 0.02, 0.03, 0.5):
+            h.add(v)
+        self.assertEqual(h.count, 4)
+        self.assertAlmostEqual(h.sum, 0.56)
+        self.assertAlmostEqual(h.mean, 0.14)
+        self.assertEqual(h.min, 0.01)
+        self.assertEqual(h.max, 0.5)
+
+    def test_percentile(self):
+        h = Histogram(buckets_per_decade=20)
+        for i in range(1, 101):
+            h.add(i / 100.0)
+        # Within bucket resolution (~12%)
+        self.assertAlmostEqual(h.percentile(50), 0.5, delta=0.06)
+        self.assertAlmostEqual(h.percentile(90), 0.9, delta=0.11)
+        self.assertEqual(h.percentile(100), 1.0)
+        self.assertEqual(h.percentile(0), 0.01)
+        with self.assertRaises(ValueError):
+            h.percentile(101)
+
+    def test_out_of_range(self):
+        h = Histogram(0.1, 10)
+        h.add(0.001)
+        h.add(1000)
+        self.assertEqual(h.count, 2)
+        self.assertEqual(h.percentile(0), 0.001)
+        self.assertEqual(h.percentile(100), 1000)
+
+    def test_merge(self):
+        h = Histogram()
+        g = Histogram()
+        h.add(0.1)
+        g.add(0.2)
+        g.add(0.01)
+        h.merge(g)
+        self.assertEqual(h.count, 3)
+        self.assertEqual(h.min, 0.01)
+        self.assertEqual(h.max, 0.2)
+        self.assertEqual(g.count, 2)
+        with self.assertRaises(ValueError):
+            h.merge(Histogram(buckets_per_decade=5))
+
+    def test_copy(self):
+        h = Histogram()
+        h.add(0.1)
+        g = h.copy()
+        g.add(0.2)
+        self.assertEqual(h.count, 1)
+        self.assertEqual(g.count, 2)
+
+
+if __name__ == "__main__":
+    main()
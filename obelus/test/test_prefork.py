@@ -0,0 +1,112 @@
+
+import collections
+import os
+import signal
+import unittest
+
+try:
+    from obelus.agi import preforkfastagi
+except ImportError:
+    # No asyncio
+    preforkfastagi = None
+else:
+    from obelus.agi.preforkfastagi import (
+        PreforkServer, create_listening_socket)
+from . import main, watch_logging
+
+
+@unittest.skipIf(preforkfastagi is None, "asyncio is not available")
+class PreforkServerTest(unittest.TestCase):
+
+    def make_server(self, **kwargs):
+        kwargs.setdefault('workers', 2)
+        return PreforkServer(lambda loop: None, **kwargs)
+
+    def add_worker(self, server, pid, slot):
+        worker = preforkfastagi._Worker(pid, slot, None)
+        server._workers[pid] = worker
+        return worker
+
+    def test_aggregated_stats(self):
+        s = self.make_server()
+        w1 = self.add_worker(s, 100, 0)
+        w2 = self.add_worker(s, 101, 1)
+        s._handle_report(w1, b'{"stats": {"connections": 3}, '
+                             b'"gauges": {"active_sessions": 2}}')
+        s._handle_report(w2, b'{"stats": {"connections": 4, '
+                             b'"command_timeouts": 1}, '
+                             b'"gauges": {"active_sessions": 1, "queued_sessions": 2}}')
+        # Later reports replace earlier ones
+        s._handle_report(w1, b'{"stats": {"connections": 5}, '
+                             b'"gauges": {"active_sessions": 0}}')
+        stats = s.aggregated_stats()
+        self.assertEqual(stats['connections'], 9)
+        self.assertEqual(stats['command_timeouts'], 1)
+        self.assertEqual(stats['active_sessions'], 1)
+        self.assertEqual(stats['queued_sessions'], 2)
+        self.assertEqual(stats['workers'], 2)
+
+    def test_invalid_report(self):
+        s = self.make_server()
+        w = self.add_worker(s, 100, 0)
+        with watch_logging('obelus.agi', level='WARN') as cm:
+            s._handle_report(w, b'garbage')
+        self.assertEqual(len(cm.output), 1)
+        self.assertEqual(w.stats, collections.Counter())
+
+    def test_worker_restart(self):
+        s = self.make_server(restart_delay=10)
+        w = self.add_worker(s, 100, 1)
+        s._handle_report(w, b'{"stats": {"connections": 3}, '
+                            b'"gauges": {"active_sessions": 2}}')
+        del s._workers[100]
+        with watch_logging('obelus.agi', level='ERROR'):
+            s._worker_exited(w, signal.SIGKILL)
+        # Stats of dead workers are kept, gauges aren't
+        stats = s.aggregated_stats()
+        self.assertEqual(stats['connections'], 3)
+        self.assertEqual(stats['active_sessions'], 0)
+        self.assertEqual(stats['worker_restarts'], 1)
+        # Restart is throttled
+        self.assertEqual(list(s._pending_slots), [1])
+        self.assertGreaterEqual(s._pending_slots[1], w.started_at + 10)
+
+    def test_worker_exit_when_stopping(self):
+        s = self.make_server()
+        w = self.add_worker(s, 100, 0)
+        s.stop()
+        del s._workers[100]
+        s._worker_exited(w, 0)
+        self.assertEqual(s._pending_slots, {})
+        self.assertEqual(s.aggregated_stats()['worker_restarts'], 0)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "needs fork()")
+    def test_spawn_after_report_pipe_closed(self):
+        # A worker whose report pipe hit EOF has no read_fd: the child
+        # process of a new worker mustn't try to close it
+        s = self.make_server()
+        self.add_worker(s, 100, 0)
+        s._run_worker = lambda write_fd: None
+        with watch_logging('obelus.agi'):
+            s._spawn_worker(1)
+        del s._workers[100]
+        (pid, worker), = s._workers.items()
+        self.addCleanup(os.close, worker.read_fd)
+        _, status = os.waitpid(pid, 0)
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+    @unittest.skipUnless(getattr(preforkfastagi, 'HAS_REUSEPORT', False),
+                         "needs SO_REUSEPORT")
+    def test_reuse_port(self):
+        s1 = create_listening_socket('127.0.0.1', 0, reuse_port=True)
+        try:
+            port = s1.getsockname()[1]
+            s2 = create_listening_socket('127.0.0.1', port, reuse_port=True)
+            s2.close()
+        finally:
+            s1.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+
+import unittest
+
+from obelus.agi.routing import Router, RouteMatch
+from . import main
+
+
+class RouterTest(unittest.TestCase):
+
+    def resolve_factory(self, router, script):
+        match = router.resolve(script)
+        return match.session_factory if match is not None else None
+
+    def test_exact(self):
+        r = Router()
+        r.add_route('ivr/menu', 'menu')
+        r.add_route('/ivr/menu/fr/', 'menu-fr')
+        self.assertEqual(r.resolve('ivr/menu'),
+                         RouteMatch('menu', 'ivr/menu', {}))
+        self.assertEqual(self.resolve_factory(r, '/ivr/menu/'), 'menu')
+        self.assertEqual(self.resolve_factory(r, 'ivr/menu/fr'), 'menu-fr')
+        self.assertIsNone(r.resolve('ivr'))
+        self.assertIsNone(r.resolve('ivr/menu/de'))
+        self.assertIsNone(r.resolve(''))
+
+    def test_prefix(self):
+        r = Router()
+        r.add_route('ivr', 'ivr', prefix=True)
+        r.add_route('ivr/admin', 'admin', prefix=True)
+        r.add_route('ivr/admin/login', 'login')
+        self.assertEqual(self.resolve_factory(r, 'ivr'), 'ivr')
+        self.assertEqual(self.resolve_factory(r, 'ivr/menu/fr'), 'ivr')
+        self.assertEqual(self.resolve_factory(r, 'ivr/admin'), 'admin')
+        self.assertEqual(self.resolve_factory(r, 'ivr/admin/x'), 'admin')
+        self.assertEqual(self.resolve_factory(r, 'ivr/admin/login'), 'login')
+        self.assertEqual(self.resolve_factory(r, 'ivr/admin/login/x'),
+                         'admin')
+        self.assertIsNone(r.resolve('other'))
+
+    def test_root_prefix(self):
+        r = Router()
+        r.add_route('', 'root', prefix=True)
+        self.assertEqual(self.resolve_factory(r, 'a/b'), 'root')
+        self.assertEqual(self.resolve_factory(r, ''), 'root')
+
+    def test_query(self):
+        r = Router()
+        r.add_route('ivr', 'ivr')
+        r.add_route('ivr', 'ivr-fr', query={'lang': 'fr'})
+        r.add_route('ivr', 'ivr-debug', query={'debug': None, 'lang': 'fr'})
+        self.assertEqual(r.resolve('ivr?lang=fr&x=1'),
+                         RouteMatch('ivr-fr', 'ivr', {'lang': 'fr', 'x': '1'}))
+        self.assertEqual(self.resolve_factory(r, 'ivr?lang=de'), 'ivr')
+        self.assertEqual(self.resolve_factory(r, 'ivr?debug&lang=fr'),
+                         'ivr-debug')
+        self.assertEqual(self.resolve_factory(r, 'ivr?debug'), 'ivr')
+
+    def test_quoted_segments(self):
+        r = Router()
+        r.add_route('a b/c', 'ab')
+        self.assertEqual(self.resolve_factory(r, 'a%20b/c'), 'ab')
+
+    def test_default(self):
+        r = Router(default='default')
+        r.add_route('ivr', 'ivr')
+        self.assertEqual(r.resolve('other?x=1'),
+                         RouteMatch('default', 'other', {'x': '1'}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from obelus.agi import handoff, scriptagi
+from obelus.agi.session import AGISession
+from . import main
+
+
+try:
+    handoff._check_supported()
+except NotImplementedError:
+    supported = False
+else:
+    supported = True
+
+
+class AnswerSession(AGISession):
+    """
+    Answer the call and finish the session.
+    """
+
+    results = None
+
+    def session_established(self):
+        proto = self.proto
+        h = proto.send_command(("answer",))
+        def _on_result(resp):
+            if self.results is not None:
+                self.results.append(resp.result)
+            proto.transport.close()
+        h.on_result = _on_result
+
+
+class RunSessionTest(unittest.TestCase):
+
+    def pipe(self, data=None):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        if data is None:
+            self.addCleanup(os.close, w)
+        else:
+            os.write(w, data)
+            os.close(w)
+        return r, w
+
+    def test_session(self):
+        stdin, _ = self.pipe(b"agi_channel: SIP/foo\n\n200 result=1\n")
+        stdout_r, stdout_w = self.pipe()
+        results = []
+        class Session(AnswerSession):
+            pass
+        Session.results = results
+        proto = scriptagi.run_session(Session, stdin_fd=stdin,
+                                      stdout_fd=stdout_w)
+        self.assertEqual(proto.env, {'channel': 'SIP/foo'})
+        self.assertEqual(results, [1])
+        self.assertEqual(os.read(stdout_r, 100), b"answer\n")
+
+    def test_eof(self):
+        finished = []
+        class Session(AGISession):
+            def session_finished(self):
+                finished.append(True)
+        stdin, _ = self.pipe(b"agi_channel: SIP/foo\n")
+        _, stdout_w = self.pipe()
+        proto = scriptagi.run_session(Session, stdin_fd=stdin,
+                                      stdout_fd=stdout_w)
+        self.assertEqual(proto._state, 'init')
+        self.assertEqual(finished, [True])
+
+
+@unittest.skipUnless(supported, "socket handoff not supported")
+class ZygoteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'zygote.sock')
+
+    def test_run_in_zygote(self):
+        zygote = scriptagi.Zygote(self.path, AnswerSession)
+        self.addCleanup(zygote.close)
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        os.write(stdin_w, b"agi_channel: SIP/foo\n\n200 result=1\n")
+        os.close(stdin_w)
+        statuses = []
+        def client():
+            statuses.append(scriptagi.run_in_zygote(self.path, stdin_r,
+                                                    stdout_w))
+        t = threading.Thread(target=client)
+        t.start()
+        try:
+            zygote.handle_request()
+        finally:
+            t.join(10)
+        os.close(stdin_r)
+        os.close(stdout_w)
+        self.assertEqual(statuses, [0])
+        self.assertEqual(os.read(stdout_r, 100), b"answer\n")
+        os.close(stdout_r)
+        # The child may already have been reaped by handle_request()
+        deadline = time.time() + 10
+        while zygote._children and time.time() < deadline:
+            time.sleep(0.01)
+            zygote.reap_children()
+        self.assertEqual(zygote._children, set())
+        zygote.close()
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+
+import unittest
+
+from mock import Mock, ANY
+
+from obelus.agi.protocol import AGIProtocol, ProtocolAGIChannel, Response
+from obelus.agi.session import AGISession
+from obelus.cache import LookupCache
+from obelus.common import Handler, CoroutineRunner, CoroutineCancelled
+from . import main
+from .test_agiprotocol import HEADER
+
+
+class SessionTestBase(object):
+
+    def setUp(self):
+        class MyProtocol(AGIProtocol):
+            session_factory = AGISession
+        self.proto = MyProtocol(ProtocolAGIChannel())
+        self.proto.transport = Mock()
+        self.session = self.proto.bind_session()
+        self.proto.data_received(HEADER + b"\n")
+
+    def run_coroutine(self, coro):
+        h = self.session.run_coroutine(coro)
+        h.on_result = Mock()
+        h.on_exception = Mock()
+        return h
+
+
+class GeneratorSessionTest(SessionTestBase, unittest.TestCase):
+
+    def test_run_generator(self):
+        p = self.proto
+        results = []
+        def gen():
+            resp = yield p.send_command(("foo",))
+            results.append(resp.result)
+            resp = yield p.send_command(("bar",))
+            results.append(resp.result)
+        h = self.run_coroutine(gen())
+        p.transport.write.assert_called_once_with(b"foo\n")
+        p.line_received(b"200 result=1\n")
+        p.transport.write.assert_called_with(b"bar\n")
+        self.assertEqual(h.on_result.call_count, 0)
+        p.line_received(b"200 result=2\n")
+        self.assertEqual(results, [1, 2])
+        h.on_result.assert_called_once_with(None)
+        self.assertEqual(h.on_exception.call_count, 0)
+        self.assertFalse(self.session._runners)
+
+    def test_generator_exception(self):
+        p = self.proto
+        caught = []
+        def gen():
+            try:
+                yield p.send_command(("foo",))
+            except Exception as e:
+                caught.append(e)
+                raise ZeroDivisionError
+        h = self.run_coroutine(gen())
+        p.line_received(b"510 Invalid or unknown command\n")
+        self.assertEqual(len(caught), 1)
+        h.on_exception.assert_called_once_with(ANY)
+        (exc,), _ = h.on_exception.call_args
+        self.assertIsInstance(exc, ZeroDivisionError)
+
+    def test_cancel_on_session_end(self):
+        p = self.proto
+        closed = []
+        def gen():
+            try:
+                yield p.send_command(("foo",))
+            finally:
+                closed.append(True)
+        h = self.run_coroutine(gen())
+        p.unbind_session()
+        self.assertEqual(closed, [True])
+        h.on_exception.assert_called_once_with(ANY)
+        (exc,), _ = h.on_exception.call_args
+        self.assertIsInstance(exc, CoroutineCancelled)
+        # A late response doesn't resume the coroutine
+        p.line_received(b"200 result=1\n")
+        self.assertEqual(closed, [True])
+
+
+    def test_synchronous_completion(self):
+        def gen():
+            if False:
+                yield
+            return 42
+        h = self.session.run_coroutine(gen())
+        h.on_result = Mock()
+        h.on_result.assert_called_once_with(42)
+        self.assertFalse(self.session._runners)
+
+    def test_cancel_before_callbacks(self):
+        p = self.proto
+        def gen():
+            yield p.send_command(("foo",))
+        h = self.session.run_coroutine(gen())
+        p.unbind_session()
+        h.on_exception = Mock()
+        h.on_exception.assert_called_once_with(ANY)
+        (exc,), _ = h.on_exception.call_args
+        self.assertIsInstance(exc, CoroutineCancelled)
+
+    def test_cancel_with_result_callback_only(self):
+        p = self.proto
+        def gen():
+            yield p.send_command(("foo",))
+        h = self.session.run_coroutine(gen())
+        h.on_result = Mock()
+        # Doesn't raise
+        p.unbind_session()
+        self.assertEqual(h.on_result.call_count, 0)
+
+
+class RunBlockingTest(SessionTestBase, unittest.TestCase):
+
+    def test_run_blocking(self):
+        pool = self.session.blocking_pool = Mock()
+        pool.run.return_value = Handler()
+        results = []
+        def gen():
+            results.append((yield self.session.run_blocking(len, "abc")))
+        h = self.run_coroutine(gen())
+        pool.run.assert_called_once_with(len, "abc")
+        pool.run.return_value.set_result(3)
+        self.assertEqual(results, [3])
+        h.on_result.assert_called_once_with(None)
+
+    def test_no_pool(self):
+        with self.assertRaises(ValueError):
+            self.session.run_blocking(len, "abc")
+
+
+class LookupTest(SessionTestBase, unittest.TestCase):
+
+    def setUp(self):
+        SessionTestBase.setUp(self)
+        self.loads = []
+        def loader(key):
+            self.loads.append(key)
+            h = Handler()
+            h.set_result(key.upper())
+            return h
+        self.session.caches = {'names': LookupCache(loader)}
+
+    def test_lookup(self):
+        p = self.proto
+        results = []
+        def gen():
+            results.append((yield self.session.lookup('names', 'foo')))
+            results.append((yield self.session.lookup('names', 'foo')))
+            yield p.send_command(("foo",))
+        h = self.run_coroutine(gen())
+        self.assertEqual(results, ['FOO', 'FOO'])
+        self.assertEqual(self.loads, ['foo'])
+        p.line_received(b"200 result=1\n")
+        h.on_result.assert_called_once_with(None)
+
+    def test_unknown_cache(self):
+        with self.assertRaises(ValueError):
+            self.session.lookup('other', 'foo')
+        self.session.caches = None
+        with self.assertRaises(ValueError):
+            self.session.lookup('names', 'foo')
+
+
+class CoroutineRunnerTest(unittest.TestCase):
+
+    def run_coroutine(self, coro):
+        runner = CoroutineRunner(coro)
+        runner.handler.on_result = Mock()
+        runner.handler.on_exception = Mock()
+        return runner.start().handler
+
+    def test_bad_yield(self):
+        caught = []
+        def gen():
+            try:
+                yield 42
+            except TypeError as e:
+                caught.append(e)
+        h = self.run_coroutine(gen())
+        self.assertEqual(len(caught), 1)
+        h.on_result.assert_called_once_with(None)
+
+    def test_triggered_handler(self):
+        done = Handler()
+        done.set_result(5)
+        results = []
+        def gen():
+            results.append((yield done))
+        h = self.run_coroutine(gen())
+        self.assertEqual(results, [5])
+        h.on_result.assert_called_once_with(None)
+
+    def test_done_callback(self):
+        handler = Handler()
+        def gen():
+            yield handler
+        cb = Mock()
+        runner = CoroutineRunner(gen(), cb).start()
+        self.assertFalse(runner.done())
+        self.assertEqual(cb.call_count, 0)
+        handler.set_result(1)
+        self.assertTrue(runner.done())
+        cb.assert_called_once_with(runner)
+
+    def test_awaiter_outside_driver(self):
+        # Awaiting a Handler outside of any coroutine driver is an error
+        with self.assertRaises(RuntimeError):
+            next(Handler().__await__())
+
+
+if __name__ == "__main__":
+    main()
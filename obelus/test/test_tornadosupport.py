@@ -0,0 +1,172 @@
+
+import unittest
+
+from mock import Mock
+
+try:
+    import asyncio
+    from tornado.iostream import StreamClosedError
+except ImportError:
+    StreamClosedError = None
+else:
+    from obelus.tornadosupport import TornadoAdapter
+
+from obelus.common import FlowControlMixin
+from . import main, watch_logging
+
+
+class FakeStream(object):
+    """
+    An IOStream-like object whose reads and writes complete on demand.
+    """
+
+    error = None
+
+    def __init__(self, loop):
+        self.loop = loop
+        # (size, future) for each read_bytes() call
+        self.reads = []
+        # (data, future) for each write() call
+        self.writes = []
+        self._closed = False
+        self._close_callback = None
+
+    def read_bytes(self, num_bytes, partial=False):
+        assert partial
+        if self._closed:
+            raise StreamClosedError()
+        fut = self.loop.create_future()
+        self.reads.append((num_bytes, fut))
+        return fut
+
+    def write(self, data):
+        fut = self.loop.create_future()
+        self.writes.append((data, fut))
+        return fut
+
+    def set_close_callback(self, callback):
+        self._close_callback = callback
+
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            for _, fut in self.reads:
+                if not fut.done():
+                    fut.set_exception(StreamClosedError())
+            if self._close_callback is not None:
+                self.loop.call_soon(self._close_callback)
+
+
+class FlowControlProtocol(FlowControlMixin):
+
+    def __init__(self):
+        self.connection_made = Mock()
+        self.connection_lost = Mock()
+        self.data_received = Mock()
+
+
+@unittest.skipIf(StreamClosedError is None, "Tornado is not installed")
+class TornadoAdapterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.stream = FakeStream(self.loop)
+        self.proto = FlowControlProtocol()
+
+    def run_loop(self, func):
+        def run():
+            func()
+        self.loop.call_soon(run)
+        # Let callbacks run
+        for i in range(5):
+            self.loop.run_until_complete(asyncio.sleep(0))
+
+    def bound_adapter(self, **kwargs):
+        adapter = TornadoAdapter(self.proto, **kwargs)
+        self.run_loop(lambda: adapter.bind_stream(self.stream))
+        return adapter
+
+    def test_read_loop(self):
+        a = self.bound_adapter(chunk_size=100)
+        self.proto.connection_made.assert_called_once_with(a)
+        self.assertEqual(len(self.stream.reads), 1)
+        size, fut = self.stream.reads[-1]
+        self.assertEqual(size, 100)
+        self.run_loop(lambda: fut.set_result(b"foo"))
+        self.proto.data_received.assert_called_once_with(b"foo")
+        # The next read was issued
+        self.assertEqual(len(self.stream.reads), 2)
+
+    def test_stream_closed(self):
+        a = self.bound_adapter()
+        self.run_loop(self.stream.close)
+        self.proto.connection_lost.assert_called_once_with(None)
+        self.assertIsNone(a.stream)
+        with self.assertRaises(ValueError):
+            a.write(b"foo")
+
+    def test_read_error(self):
+        a = self.bound_adapter()
+        exc = OSError("boom")
+        _, fut = self.stream.reads[-1]
+        with watch_logging('obelus', level='ERROR') as w:
+            self.run_loop(lambda: fut.set_exception(exc))
+        self.assertEqual(len(w.output), 1)
+        self.assertTrue(self.stream.closed())
+        self.proto.connection_lost.assert_called_once_with(exc)
+        self.assertIsNone(a.stream)
+
+    def test_data_received_error(self):
+        a = self.bound_adapter()
+        exc = ValueError("bad line")
+        self.proto.data_received.side_effect = exc
+        _, fut = self.stream.reads[-1]
+        with watch_logging('obelus', level='ERROR'):
+            self.run_loop(lambda: fut.set_result(b"foo"))
+        self.assertTrue(self.stream.closed())
+        self.proto.connection_lost.assert_called_once_with(exc)
+        self.assertEqual(len(self.stream.reads), 1)
+
+    def test_write_buffer(self):
+        a = self.bound_adapter(high_water=10, low_water=4)
+        p = self.proto
+        self.run_loop(lambda: a.write(b"123456"))
+        self.assertEqual(a.write_buffer_size(), 6)
+        self.assertFalse(p.writing_paused)
+        self.run_loop(lambda: a.write(b"12345"))
+        self.assertEqual(a.write_buffer_size(), 11)
+        self.assertTrue(p.writing_paused)
+        h = p.wait_writable()
+        h.on_result = Mock()
+        (_, fut1), (_, fut2) = self.stream.writes
+        # Still above the low-water mark
+        self.run_loop(lambda: fut1.set_result(None))
+        self.assertEqual(a.write_buffer_size(), 5)
+        self.assertTrue(p.writing_paused)
+        self.run_loop(lambda: fut2.set_result(None))
+        self.assertEqual(a.write_buffer_size(), 0)
+        self.assertFalse(p.writing_paused)
+        h.on_result.assert_called_once_with(None)
+
+    def test_close_while_paused(self):
+        a = self.bound_adapter(high_water=2)
+        p = self.proto
+        self.run_loop(lambda: a.write(b"12345"))
+        self.assertTrue(p.writing_paused)
+        h = p.wait_writable()
+        _, fut = self.stream.writes[0]
+        def close():
+            self.stream.close()
+            fut.set_exception(StreamClosedError())
+        self.run_loop(close)
+        self.assertTrue(h._triggered)
+        self.assertEqual(a.write_buffer_size(), 0)
+        p.connection_lost.assert_called_once_with(None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+
+import unittest
+
+from mock import Mock
+
+try:
+    from twisted.internet.error import ConnectionDone
+    from twisted.python.failure import Failure
+    try:
+        from twisted.internet.testing import StringTransport
+    except ImportError:
+        from twisted.test.proto_helpers import StringTransport
+except ImportError:
+    StringTransport = None
+else:
+    from obelus.twistedsupport import TwistedAdapter
+
+from obelus.ami.protocol import AMIProtocol
+from . import main
+
+
+@unittest.skipIf(StringTransport is None, "Twisted is not installed")
+class TwistedAdapterTest(unittest.TestCase):
+
+    def make_adapter(self, **kwargs):
+        self.proto = AMIProtocol()
+        self.transport = StringTransport()
+        adapter = TwistedAdapter(self.proto, **kwargs)
+        adapter.makeConnection(self.transport)
+        return adapter
+
+    def test_connection(self):
+        a = self.make_adapter()
+        self.assertIs(self.proto.transport, a)
+        a.write(b"foo")
+        self.assertEqual(self.transport.value(), b"foo")
+        a.close()
+        self.assertTrue(self.transport.disconnecting)
+        self.assertIsNone(self.transport.producer)
+
+    def test_producer_registered(self):
+        a = self.make_adapter()
+        self.assertIs(self.transport.producer, a)
+        self.assertTrue(self.transport.streaming)
+
+    def test_high_water(self):
+        self.make_adapter(high_water=1024)
+        self.assertEqual(self.transport.bufferSize, 1024)
+
+    def test_pause_resume(self):
+        a = self.make_adapter()
+        p = self.proto
+        a.pauseProducing()
+        self.assertTrue(p.writing_paused)
+        h = p.wait_writable()
+        h.on_result = Mock()
+        # Repeated notifications are harmless
+        a.pauseProducing()
+        a.resumeProducing()
+        self.assertFalse(p.writing_paused)
+        h.on_result.assert_called_once_with(None)
+        a.resumeProducing()
+
+    def test_connection_lost_while_paused(self):
+        a = self.make_adapter()
+        p = self.proto
+        p.connection_lost = Mock()
+        a.pauseProducing()
+        h = p.wait_writable()
+        h.on_result = Mock()
+        a.connectionLost(Failure(ConnectionDone()))
+        h.on_result.assert_called_once_with(None)
+        (exc,), _ = p.connection_lost.call_args
+        self.assertIsInstance(exc, ConnectionDone)
+
+    def test_stop_producing(self):
+        a = self.make_adapter()
+        a.pauseProducing()
+        h = self.proto.wait_writable()
+        a.stopProducing()
+        self.assertTrue(h._triggered)
+
+    def test_protocol_without_flow_control(self):
+        proto = Mock(spec=['connection_made', 'connection_lost',
+                           'data_received'])
+        a = TwistedAdapter(proto)
+        a.makeConnection(StringTransport())
+        a.pauseProducing()
+        a.resumeProducing()
+        a.dataReceived(b"x")
+        proto.data_received.assert_called_once_with(b"x")
+
+
+if __name__ == "__main__":
+    main()
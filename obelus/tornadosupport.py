@@ -1,4 +1,9 @@
 
+import logging
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+
 
 class TornadoAdapter(object):
     """
@@ -7,12 +12,25 @@ class TornadoAdapter(object):
     Pass a *protocol* instance to create the adapter, then call
     :meth:`bind_stream` when you need to wire the protocol to a Tornado
     :class:`~tornado.iostream.IOStream` instance.
+
+    Data is read in chunks of at most *chunk_size* bytes.  When more
+    than *high_water* bytes are waiting in the stream's write buffer,
+    the protocol's pause_writing() method is called, and resume_writing()
+    once the buffer has drained below *low_water* bytes (see
+    :class:`~obelus.common.FlowControlMixin`).
     """
 
     stream = None
+    logger = logging.getLogger(__name__)
 
-    def __init__(self, protocol):
+    def __init__(self, protocol, chunk_size=65536, high_water=65536,
+                 low_water=None):
         self.protocol = protocol
+        self.chunk_size = chunk_size
+        self.high_water = high_water
+        self.low_water = high_water // 4 if low_water is None else low_water
+        self._buffered = 0
+        self._paused = False
 
     def bind_stream(self, stream):
         """
@@ -21,33 +39,85 @@ class TornadoAdapter(object):
         be called immediately.
         """
         self.stream = stream
-        self.stream.read_until_close(self._final_cb, self._streaming_cb)
         self.stream.set_close_callback(self._close_cb)
         self.protocol.connection_made(self)
+        self._read_next()
 
-    def _streaming_cb(self, data):
-        if data:
-            self.protocol.data_received(data)
+    def _read_next(self):
+        stream = self.stream
+        if stream is None or stream.closed():
+            return
+        try:
+            future = stream.read_bytes(self.chunk_size, partial=True)
+        except StreamClosedError:
+            self._close_cb()
+            return
+        IOLoop.current().add_future(future, self._read_cb)
 
-    def _final_cb(self, data):
-        # This is called when reading is finished, either because
-        # of a regular EOF or because of an error.
-        self._streaming_cb(data)
-        self._close_cb()
+    def _read_cb(self, future):
+        try:
+            data = future.result()
+            if data:
+                self.protocol.data_received(data)
+        except StreamClosedError:
+            # The close callback takes care of notifying the protocol
+            return
+        except Exception as e:
+            # Don't leave the connection half-dead
+            self.logger.error("Error while reading from stream: %r", e)
+            if self.stream is not None:
+                self._stream_lost(e, close=True)
+            return
+        self._read_next()
 
     def _close_cb(self, *args):
         if self.stream is not None:
-            stream = self.stream
-            self.stream = None
-            self.protocol.connection_lost(stream.error)
+            self._stream_lost(self.stream.error)
+
+    def _stream_lost(self, exc, close=False):
+        stream = self.stream
+        self.stream = None
+        if close:
+            stream.close()
+        self._buffered = 0
+        if self._paused:
+            # Don't leave senders waiting forever
+            self._set_paused(False)
+        self.protocol.connection_lost(exc)
+
+    def write_buffer_size(self):
+        """
+        The number of bytes written but not yet sent on the stream.
+        """
+        return self._buffered
+
+    def _set_paused(self, paused):
+        self._paused = paused
+        name = 'pause_writing' if paused else 'resume_writing'
+        method = getattr(self.protocol, name, None)
+        if method is not None:
+            method()
+
+    def _write_cb(self, nbytes, future):
+        # Retrieve any exception, so that it doesn't get logged
+        future.exception()
+        if self.stream is None:
+            return
+        self._buffered -= nbytes
+        if self._paused and self._buffered <= self.low_water:
+            self._set_paused(False)
 
     def write(self, data):
         if self.stream is None:
             raise ValueError("write() on a non-connected protocol")
-        self.stream.write(data)
+        future = self.stream.write(data)
+        nbytes = len(data)
+        self._buffered += nbytes
+        IOLoop.current().add_future(
+            future, lambda future: self._write_cb(nbytes, future))
+        if not self._paused and self._buffered > self.high_water:
+            self._set_paused(True)
 
     def close(self):
         if self.stream is not None:
             self.stream.close()
-
-
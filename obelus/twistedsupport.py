@@ -7,9 +7,12 @@ if not twisted:
     raise ImportError("Twisted is required for this module to work: "
                       "https://twistedmatrix.com/")
 
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import Protocol
+from zope.interface import implementer
 
 
+@implementer(IPushProducer)
 class TwistedAdapter(Protocol):
     """
     Twisted adapter for Obelus protocols (e.g. AMIProtocol, AGIProtocol),
@@ -17,17 +20,51 @@ class TwistedAdapter(Protocol):
 
     Pass a *protocol* instance to create the adapter, which you can
     e.g. return from your Twisted Factory implementation.
+
+    The adapter registers itself as a streaming producer on the
+    transport: when the transport's write buffer goes over *high_water*
+    bytes (Twisted's default if None), the protocol's pause_writing()
+    method is called, and resume_writing() once the buffer has drained
+    (see :class:`~obelus.common.FlowControlMixin`).
     """
 
-    def __init__(self, protocol):
+    def __init__(self, protocol, high_water=None):
         self.protocol = protocol
+        self.high_water = high_water
+        self._paused = False
 
     def connectionMade(self):
+        if self.high_water is not None:
+            self.transport.bufferSize = self.high_water
+        self.transport.registerProducer(self, True)
         self.protocol.connection_made(self)
 
     def connectionLost(self, failure):
+        if self._paused:
+            # Don't leave senders waiting forever
+            self.resumeProducing()
         self.protocol.connection_lost(failure.value)
 
+    # IPushProducer methods, called by the transport
+    def pauseProducing(self):
+        if self._paused:
+            return
+        self._paused = True
+        pause_writing = getattr(self.protocol, 'pause_writing', None)
+        if pause_writing is not None:
+            pause_writing()
+
+    def resumeProducing(self):
+        if not self._paused:
+            return
+        self._paused = False
+        resume_writing = getattr(self.protocol, 'resume_writing', None)
+        if resume_writing is not None:
+            resume_writing()
+
+    def stopProducing(self):
+        self.resumeProducing()
+
     def dataReceived(self, data):
         self.protocol.data_received(data)
 
@@ -42,4 +79,6 @@ class TwistedAdapter(Protocol):
         """
         Close the transport's underlying connection.
         """
+        if getattr(self.transport, 'producer', None) is self:
+            self.transport.unregisterProducer()
         self.transport.loseConnection()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Measure the import time of Obelus modules, using the interpreter's
+"-X importtime" option (Python 3.7+), to track startup regressions.
+
+Each module is imported in a fresh interpreter several times, and the
+best cumulative import time is reported, along with the Obelus modules
+it pulled in.  With --max-ms, exit with a non-zero status if any module
+is slower to import than that.
+
+With --check-client, also check that the classic AGI script handing its
+session over to a zygote (``python -m obelus.agi.scriptagi --connect``)
+doesn't import any of the CLIENT_FORBIDDEN modules.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+
+DEFAULT_MODULES = [
+    'obelus',
+    'obelus.ami',
+    'obelus.agi',
+    'obelus.ami.protocol',
+    'obelus.agi.protocol',
+    'obelus.agi.scriptagi',
+    ]
+
+# Modules the zygote client path must not import
+CLIENT_FORBIDDEN = [
+    'argparse',
+    'logging',
+    'obelus.agi.protocol',
+    ]
+
+
+def _run_importtime(args, python=sys.executable):
+    """
+    Run the interpreter with "-X importtime" and *args*, and return its
+    return code and a list of (module name, cumulative time in
+    microseconds) tuples.
+    """
+    proc = subprocess.Popen(
+        [python, '-X', 'importtime'] + args,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    _, err = proc.communicate()
+    err = err.decode('utf-8', 'replace')
+    imported = []
+    for line in err.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3:
+            continue
+        try:
+            cumulative = int(parts[1])
+        except ValueError:
+            # Header line
+            continue
+        imported.append((parts[2].strip(), cumulative))
+    return proc.returncode, err, imported
+
+
+def measure(module, python=sys.executable):
+    """
+    Import *module* in a fresh interpreter, and return a (cumulative
+    time in microseconds, list of imported obelus modules) tuple.
+    """
+    returncode, err, imported = _run_importtime(['-c', 'import ' + module],
+                                                python)
+    if returncode != 0:
+        raise RuntimeError("Importing %r failed:\n%s" % (module, err))
+    total = None
+    loaded = []
+    for name, cumulative in imported:
+        if name.startswith('obelus'):
+            loaded.append(name)
+        if name == module:
+            total = cumulative
+    if total is None:
+        # Already imported at startup
+        total = 0
+    return total, loaded
+
+
+def check_client(python=sys.executable):
+    """
+    Run the zygote client path of obelus.agi.scriptagi (against a
+    non-existent zygote), and return the CLIENT_FORBIDDEN modules it
+    imported.
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'no-zygote')
+    try:
+        # Connecting fails, but the imports are done by then
+        _, _, imported = _run_importtime(
+            ['-m', 'obelus.agi.scriptagi', '--connect', path], python)
+    finally:
+        os.rmdir(os.path.dirname(path))
+    return [name for name, _ in imported if name in CLIENT_FORBIDDEN]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES,
+                        help='modules to measure')
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='number of measurements per module')
+    parser.add_argument('--max-ms', type=float,
+                        help='fail if a module takes longer to import')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='list the obelus modules pulled in')
+    parser.add_argument('--check-client', action='store_true',
+                        help='check the imports of the zygote client path')
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        results = [measure(module) for i in range(args.repeat)]
+        best = min(total for total, _ in results)
+        loaded = results[0][1]
+        print("%-28s %8.2f ms  (%d obelus modules)"
+              % (module, best / 1000.0, len(loaded)))
+        if args.verbose:
+            for name in loaded:
+                print("    %s" % name)
+        if args.max_ms is not None and best / 1000.0 > args.max_ms:
+            failed = True
+    if args.check_client:
+        forbidden = check_client()
+        if forbidden:
+            print("zygote client path imports: %s" % ", ".join(forbidden))
+            failed = True
+        else:
+            print("zygote client path imports: OK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())